@@ -1,18 +1,35 @@
 import streamlit as st
-import random
 import pandas as pd
+import altair as alt
 import numpy as np
-import sqlalchemy
-from sqlalchemy import create_engine, text
 import os
 import time
-import math
 import json
+import copy
+import hashlib
+import logging
+import functools
+import contextlib
+import cProfile
+import pstats
+import io
 from datetime import datetime
+import db
+from journal import journal_count, account_balance, append_journal_trade, iter_import_chunks
+from sim_engine import (
+    RULE_DEFAULTS, SWEEP_PARAMS, SWEEP_METRICS, SimResultCache, EmpiricalPnL, empirical_params, parametric_params,
+    sim_cache_key, iter_portfolio_simulation, run_account_markov, run_portfolio_adaptive, run_parameter_sweep, run_portfolio_joint,
+    load_catalog, markov_supported, OPT_PARAMS, OPT_METRICS, run_optimizer, simulate_purchases, PURCHASE_MAX_ATTEMPTS,
+    HORIZON_MONTHS, HORIZON_PAYOUTS, run_portfolio_horizon, make_worker_pool
+)
 
 # --- CONFIGURACIÓN ---
 st.set_page_config(page_title="Prop Firm Portfolio Pro", page_icon="📈", layout="wide")
 
+PNL_SOURCES = ["Paramétrica (WR/RR)", "Diario: bootstrap por trade", "Diario: bootstrap por día"]
+FALLBACK_MC_SIMS = 5000  # sims de Montecarlo cuando el modo elegido no aplica (bootstrap o reglas dependientes del camino con Markov, simulación conjunta)
+DEFAULT_SEED = 42  # semilla fija por defecto: las proyecciones repetidas salen de la caché (0 = aleatoria, sin caché)
+
 # --- ESTADO ---
 if 'logged_in' not in st.session_state: st.session_state['logged_in'] = False
 if 'username' not in st.session_state: st.session_state['username'] = ''
@@ -20,255 +37,239 @@ if 'portfolio' not in st.session_state: st.session_state['portfolio'] = []
 if 'sim_results_theoretical' not in st.session_state: st.session_state['sim_results_theoretical'] = None
 if 'sim_results_real' not in st.session_state: st.session_state['sim_results_real'] = None
 
+# --- DIAGNÓSTICO ---
+logger = logging.getLogger("propfirm")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(os.getenv("PROPFIRM_LOG_LEVEL", "INFO"))
+DIAG_MAX_TIMINGS = 100
+
+def log_event(event, **fields):
+    # Logs estructurados: una línea JSON por evento
+    logger.info(json.dumps({"event": event, "user": st.session_state.get('username', ''), **fields}, default=str))
+
+@contextlib.contextmanager
+def timed(label, kind="ui"):
+    t0 = time.perf_counter()
+    try: yield
+    finally:
+        ms = (time.perf_counter() - t0) * 1000
+        timings = st.session_state.setdefault('diag_timings', [])
+        timings.append({"kind": kind, "label": label, "ms": ms, "at": datetime.now().strftime("%H:%M:%S")})
+        del timings[:-DIAG_MAX_TIMINGS]
+        log_event("timing", kind=kind, label=label, ms=round(ms, 2))
+
+def db_timed(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not engine: return fn(*args, **kwargs)
+        with timed(fn.__name__, kind="db"): return fn(*args, **kwargs)
+    return wrapper
+
+def record_run_diag(title, mode, jobs, stats, wall_s):
+    rows = []; causes_total = {}; sims = 0; trades = 0
+    for (acc, params, bal), s in zip(jobs, stats):
+        if (s or {}).get('cached'): continue  # servida desde caché: no se simuló en esta corrida
+        diag = (s or {}).get('diag') or {}
+        sims += diag.get('p1', {}).get('paths', 0)
+        for ph, d in diag.items():
+            trades += d['trades']
+            row = {"Cuenta": f"{acc['size']/1000:.0f}K @ ${bal:,.0f}", "Fase": ph, "CPU ms": d['time'] * 1000, "Caminos": d['paths'],
+                   "Trades": d['trades'], "Trades/s": d['trades'] / d['time'] if d['time'] > 0 else 0.0}
+            for cause, n in d['causes'].items():
+                if n: row[cause] = n; causes_total[cause] = causes_total.get(cause, 0) + n
+            rows.append(row)
+    run = {"title": title, "mode": mode, "wall_s": wall_s, "accounts": sum(1 for s in stats if not (s or {}).get('cached')), "sims": sims, "trades": trades,
+           "sims_per_s": sims / wall_s if wall_s > 0 else 0.0, "causes": causes_total}
+    log_event("simulation", **run)
+    st.session_state['last_run_diag'] = dict(run, rows=rows)
+
 # --- DB ---
+# La capa de BD vive en db.py; aquí solo se crea una vez por proceso y se cronometra por sesión
+@st.cache_resource
+def get_engine(url):
+    # Un engine (y su pool) por proceso, no por reejecución del script; el esquema se crea una vez
+    return db.make_engine(url)
+
 db_url = os.getenv("DATABASE_URL")
 engine = None
 if db_url:
-    try:
-        if db_url.startswith("postgres://"):
-            db_url = db_url.replace("postgres://", "postgresql://", 1)
-        engine = create_engine(db_url)
+    try: engine = get_engine(db_url)
     except: pass
 
-def init_db():
-    if engine:
-        with engine.connect() as conn:
-            conn.execute(text("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT, auth_type TEXT DEFAULT 'manual');"))
-            conn.execute(text("CREATE TABLE IF NOT EXISTS user_portfolios (username TEXT PRIMARY KEY, portfolio_json TEXT);"))
-            conn.commit()
+@st.cache_resource
+def get_read_cache():
+    return db.ReadCache(db.READ_CACHE_TTL)
 
 # --- PERSISTENCIA ---
+@st.cache_resource
+def get_autosaver():
+    return db.WriteBehind(lambda username, snapshot: db.write_portfolio(engine, get_read_cache(), username, snapshot), db.AUTOSAVE_DELAY, db.AUTOSAVE_MAX_DELAY)
+
+@db_timed
 def save_portfolio_db(username, portfolio_data):
     if not engine: return False
-    try:
-        json_data = json.dumps(portfolio_data, default=str)
-        with engine.connect() as conn:
-            conn.execute(text("DELETE FROM user_portfolios WHERE username = :u"), {"u": username})
-            conn.execute(text("INSERT INTO user_portfolios (username, portfolio_json) VALUES (:u, :d)"), {"u": username, "d": json_data})
-            conn.commit()
-        return True
-    except Exception as e: return False
+    return get_autosaver().write_now(username, copy.deepcopy(portfolio_data))
+
+def portfolio_fingerprint(portfolio):
+    # Lo que write_portfolio persiste: config, balance y nº de trades de cada cuenta
+    rows = [(item['id'], item['full_name'], item['data'], item['params'], account_balance(item), journal_count(item)) for item in portfolio]
+    return hashlib.sha1(json.dumps(rows, sort_keys=True, default=str).encode()).hexdigest()
+
+def autosave_portfolio():
+    # Al final de cada ejecución: si el portafolio cambió, se encola una instantánea (no bloquea)
+    if not (engine and st.session_state.get('autosave', True) and st.session_state.get('autosave_ready')): return
+    fp = portfolio_fingerprint(st.session_state['portfolio'])
+    if st.session_state.get('saved_fp') == fp: return
+    st.session_state['saved_fp'] = fp
+    get_autosaver().submit(st.session_state['username'], copy.deepcopy(st.session_state['portfolio']))
 
+@db_timed
 def load_portfolio_db(username):
+    # Lectura a través de la caché corta; antes se escribe lo pendiente del autoguardado de este usuario
     if not engine: return []
-    try:
-        with engine.connect() as conn:
-            res = conn.execute(text("SELECT portfolio_json FROM user_portfolios WHERE username = :u"), {"u": username}).fetchone()
-            if res: return json.loads(res[0])
-            return []
-    except: return []
+    get_autosaver().flush(username)
+    portfolio = get_read_cache().get(("portfolio", username), lambda: db.fetch_portfolio(engine, username))
+    return copy.deepcopy(portfolio)
+
+@db_timed
+def import_journal_db(username, item, chunks, on_progress=None):
+    imported, dups, skipped = db.import_journal_db(engine, get_read_cache(), username, item, chunks, on_progress)
+    log_event("journal_import", account=item['full_name'], imported=imported, duplicates=dups, skipped=skipped, total=journal_count(item))
+    return imported, dups, skipped
+
+@db_timed
+def load_journal_net(username, account_id, upto):
+    if not engine: return [], []
+    return db.load_journal_net(engine, username, account_id, upto)
+
+@db_timed
+def load_sim_cache_db(key):
+    if not engine: return None
+    return db.load_sim_cache(engine, key)
+
+@db_timed
+def save_sim_cache_db(key, result):
+    if not engine: return False
+    return db.save_sim_cache(engine, key, result)
 
 # --- AUTH ---
+@db_timed
 def register_user(u, p):
     if not engine: return "Error BD Local"
-    try:
-        with engine.connect() as conn:
-            if conn.execute(text("SELECT username FROM users WHERE username = :u"), {"u": u}).fetchone(): return "Usuario existe"
-            conn.execute(text("INSERT INTO users (username, password) VALUES (:u, :p)"), {"u": u, "p": p})
-            conn.commit()
-            return "OK"
-    except Exception as e: return str(e)
+    return db.register_user(engine, get_read_cache(), u, p)
 
+@db_timed
 def login_user(u, p):
     if not engine: return False
-    try:
-        with engine.connect() as conn:
-            res = conn.execute(text("SELECT password FROM users WHERE username = :u"), {"u": u}).fetchone()
-            return res and res[0] == p
-    except: return False
-
-if engine: init_db()
-
-# --- DATOS ---
-FIRMS_DATA = {
-    "The5ers": {
-        "High Stakes (2 Step)": {
-            "5K":   {"cost": 39,  "size": 5000,   "daily_dd": 5.0, "total_dd": 10.0, "profit_p1": 8.0, "profit_p2": 5.0, "p1_bonus": 5},
-            "10K":  {"cost": 78,  "size": 10000,  "daily_dd": 5.0, "total_dd": 10.0, "profit_p1": 8.0, "profit_p2": 5.0, "p1_bonus": 10},
-            "20K":  {"cost": 165, "size": 20000,  "daily_dd": 5.0, "total_dd": 10.0, "profit_p1": 8.0, "profit_p2": 5.0, "p1_bonus": 15},
-            "60K":  {"cost": 329, "size": 60000,  "daily_dd": 5.0, "total_dd": 10.0, "profit_p1": 8.0, "profit_p2": 5.0, "p1_bonus": 25},
-            "100K": {"cost": 545, "size": 100000, "daily_dd": 5.0, "total_dd": 10.0, "profit_p1": 8.0, "profit_p2": 5.0, "p1_bonus": 40}
-        }
-    }
-}
-
-# --- MOTOR DE SIMULACIÓN ---
-def simulate_phase(initial_balance, current_balance, risk_pct, win_rate, rr, target_pct, max_dd_pct, daily_dd_pct, comm, sl_min, sl_max, trades_per_day, is_funded=False):
-    curr = current_balance
-    target_equity = initial_balance + (initial_balance * (target_pct/100))
-    static_limit = initial_balance - (initial_balance * (max_dd_pct/100))
-    
-    if curr <= static_limit: return False, 0, curr, "Ya perdida (Real)"
-    if curr >= target_equity: return True, 0, curr, "Ya ganada (Real)"
+    stored = get_read_cache().get(("user", u), lambda: db.fetch_password(engine, u))
+    return stored is not None and stored == p
 
-    trades = 0
-    max_trades = 1500 
-    pip_val = 10
-    
-    day_start_equity = curr 
-    trades_today = 0
-    fixed_daily_loss_amount = initial_balance * (daily_dd_pct / 100)
-    
-    while curr > static_limit and curr < target_equity and trades < max_trades:
-        trades += 1
-        trades_today += 1
-        
-        if trades_today > trades_per_day:
-            day_start_equity = curr 
-            trades_today = 1        
-            
-        current_sl = random.uniform(sl_min, sl_max)
-        risk_money = initial_balance * (risk_pct / 100) 
-        
-        lot_size = risk_money / (current_sl * pip_val)
-        trade_comm = lot_size * comm
-        
-        slippage = random.uniform(0.95, 1.05) 
-        is_error = random.random() < 0.01 
-        
-        if random.random() < (win_rate/100):
-            profit = (risk_money * rr * slippage) - trade_comm
-            curr += profit
-        else:
-            loss = (risk_money * slippage) + trade_comm
-            if is_error: loss *= 1.5 
-            curr -= loss
-            
-        if curr <= static_limit:
-            return False, trades, curr, "Max Drawdown"
-            
-        if (day_start_equity - curr) >= fixed_daily_loss_amount:
-            return False, trades, curr, "Daily Drawdown"
-            
-    if curr >= target_equity: return True, trades, curr, "Success"
-    else: return False, trades, curr, "Timeout"
-
-def calculate_time_metrics(trades_list, trades_per_day):
-    if not trades_list: return 0.0
-    avg_trades = sum(trades_list) / len(trades_list)
-    trading_days = avg_trades / trades_per_day
-    months = trading_days / 20.0
-    return months
-
-def run_account_simulation(account_data, strategy_params, n_sims, current_balance_real):
-    wr = strategy_params['win_rate']; rr = strategy_params['rr']
-    risk = strategy_params['risk']; w_target = strategy_params['withdrawal_target']
-    comm = strategy_params['comm']; trades_day = strategy_params['trades_day']
-    sl_min = 5; sl_max = 15; daily_dd = account_data.get('daily_dd', 100.0)
-    
-    initial_size = account_data['size']
-    
-    pass_c1 = 0; pass_c2 = 0; pass_c3 = 0
-    sum_pay1 = 0; sum_pay2 = 0; sum_pay3 = 0
-    fail_reasons = {"Max Drawdown": 0, "Daily Drawdown": 0, "Timeout": 0, "Ya perdida (Real)": 0}
-    
-    trades_p1 = []; trades_p2 = []; trades_c1 = []; trades_c2 = []; trades_c3 = []
-    
-    target_profit_amount = initial_size * (w_target / 100)
-    split_share = target_profit_amount * 0.80
-    pay_val_1 = split_share + account_data['cost'] + account_data.get('p1_bonus', 0)
-    pay_val_2 = split_share
-    pay_val_3 = split_share
-    
-    is_2step = account_data.get('profit_p2', 0) > 0
-    pass_p1_count = 0; pass_p2_count = 0
-    
-    for _ in range(n_sims):
-        # 1. FASE 1
-        ok1, t1, _, cause1 = simulate_phase(initial_size, current_balance_real, risk, wr, rr, account_data['profit_p1'], account_data['total_dd'], daily_dd, comm, sl_min, sl_max, trades_day)
-        if ok1:
-            pass_p1_count += 1
-            trades_p1.append(t1)
-        else:
-            if cause1 in fail_reasons: fail_reasons[cause1] += 1
-            continue
-        
-        # 2. FASE 2
-        if is_2step:
-            ok2, t2, _, cause2 = simulate_phase(initial_size, initial_size, risk, wr, rr, account_data['profit_p2'], account_data['total_dd'], daily_dd, comm, sl_min, sl_max, trades_day)
-            if ok2:
-                pass_p2_count += 1
-                trades_p2.append(t2)
-            else:
-                if cause2 in fail_reasons: fail_reasons[cause2] += 1
-                continue
-        else:
-            pass_p2_count += 1
-            
-        # COBRO 1
-        ok_c1, tc1, _, cause3 = simulate_phase(initial_size, initial_size, risk, wr, rr, w_target, account_data['total_dd'], daily_dd, comm, sl_min, sl_max, trades_day, is_funded=True)
-        if ok_c1:
-            pass_c1 += 1
-            trades_c1.append(tc1)
-            sum_pay1 += pay_val_1 
-            
-            # COBRO 2
-            ok_c2, tc2, _, _ = simulate_phase(initial_size, initial_size, risk, wr, rr, w_target, account_data['total_dd'], daily_dd, comm, sl_min, sl_max, trades_day, is_funded=True)
-            if ok_c2:
-                pass_c2 += 1
-                trades_c2.append(tc2)
-                sum_pay2 += pay_val_2
-                
-                # COBRO 3
-                ok_c3, tc3, _, _ = simulate_phase(initial_size, initial_size, risk, wr, rr, w_target, account_data['total_dd'], daily_dd, comm, sl_min, sl_max, trades_day, is_funded=True)
-                if ok_c3:
-                    pass_c3 += 1
-                    trades_c3.append(tc3)
-                    sum_pay3 += pay_val_3
-        else:
-            if cause3 in fail_reasons: fail_reasons[cause3] += 1
-
-    prob_p1 = (pass_p1_count/n_sims)*100
-    prob_p2 = (pass_p2_count/n_sims)*100 if is_2step else 100.0
-    prob_c1 = (pass_c1/n_sims)*100
-    prob_c2 = (pass_c2/n_sims)*100
-    prob_c3 = (pass_c3/n_sims)*100
-    
-    avg_pay1 = sum_pay1 / pass_c1 if pass_c1 > 0 else 0
-    avg_pay2 = sum_pay2 / pass_c2 if pass_c2 > 0 else 0
-    avg_pay3 = sum_pay3 / pass_c3 if pass_c3 > 0 else 0
-    
-    time_p1 = calculate_time_metrics(trades_p1, trades_day)
-    time_p2 = calculate_time_metrics(trades_p2, trades_day) if is_2step else 0
-    time_c1 = calculate_time_metrics(trades_c1, trades_day)
-    time_c2 = calculate_time_metrics(trades_c2, trades_day)
-    time_c3 = calculate_time_metrics(trades_c3, trades_day)
-    
-    # --- LOGICA DE STOCK AJUSTADA (Umbral 85%) ---
-    if prob_c1 >= 85.0: 
-        attempts = 1.0
-        reason = f"¡Probabilidad Alta ({prob_c1:.1f}%)! Con este nivel de seguridad, 1 sola cuenta es suficiente."
-    elif prob_c1 <= 0.5: 
-        attempts = 100.0
-        reason = "Probabilidad nula. Estrategia no viable."
-    else: 
-        attempts = 100/prob_c1
-        reason = f"Con {prob_c1:.1f}% de éxito, la estadística sugiere cubrir {math.ceil(attempts)} intentos secuenciales para garantizar el cobro."
-    
-    inv_req = math.ceil(attempts) * account_data['cost']
-    salary = avg_pay1 - inv_req
-    
-    est_breakdown = {
-        "split": split_share, "refund": account_data['cost'], "bonus": account_data.get('p1_bonus', 0), "total": pay_val_1
-    }
-    
-    total_failures = n_sims - pass_c1
-    fail_stats = {}
-    if total_failures > 0:
-        for k, v in fail_reasons.items(): fail_stats[k] = (v/total_failures)*100
-            
-    return {
-        "prob_p1": prob_p1, "prob_p2": prob_p2,
-        "prob_c1": prob_c1, "prob_c2": prob_c2, "prob_c3": prob_c3,
-        "avg_pay1": avg_pay1, "avg_pay2": avg_pay2, "avg_pay3": avg_pay3,
-        "time_p1": time_p1, "time_p2": time_p2, "time_c1": time_c1, "time_c2": time_c2, "time_c3": time_c3,
-        "inventory": math.ceil(attempts), "investment": inv_req, "net_profit": salary,
-        "stock_reason": reason, "first_pay_est": est_breakdown, "fail_stats": fail_stats, "total_failures": total_failures,
-        "is_2step": is_2step
-    }
+# --- CACHÉ DE RESULTADOS ---
+SIM_CACHE_MAX_BYTES = int(os.getenv("SIM_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+
+@st.cache_resource
+def get_sim_cache():
+    # Compartida entre todas las sesiones del servidor
+    return SimResultCache(SIM_CACHE_MAX_BYTES)
+
+@st.cache_resource
+def get_worker_pool():
+    # Un pool de procesos por proceso del servidor, compartido entre sesiones: el modo Paralelo no
+    # paga el arranque de los workers (ni importar numpy en cada uno) en cada clic
+    return make_worker_pool()
+
+def stream_portfolio_cached(jobs, n_sims, seed=None, n_workers=1, pool=None):
+    # Rinde (fracción, stats por cuenta); las cuentas en caché salen completas desde el principio.
+    # Sin semilla (aleatoria) no se usa la caché: cada corrida debe dar números nuevos
+    if seed is None:
+        st.session_state['diag_cache'] = {"hits": 0, "misses": len(jobs)}
+        yield from iter_portfolio_simulation(jobs, n_sims, seed=None, n_workers=n_workers, pool=pool)
+        return
+    cache = get_sim_cache()
+    keys = [sim_cache_key(acc, params, n_sims, bal, seed) for acc, params, bal in jobs]
+    results = [cache.get(k) for k in keys]
+    for i, k in enumerate(keys):
+        if results[i] is None:
+            results[i] = load_sim_cache_db(k)
+            if results[i] is not None: cache.put(k, results[i])
+        if results[i] is not None: results[i]['cached'] = True  # copia propia (get/BD devuelven JSON nuevo)
+    miss = [i for i, r in enumerate(results) if r is None]
+    st.session_state['diag_cache'] = {"hits": len(jobs) - len(miss), "misses": len(miss)}
+    if not miss:
+        yield 1.0, results
+        return
+    for frac, fresh in iter_portfolio_simulation([jobs[i] for i in miss], n_sims, seed=seed, n_workers=n_workers, pool=pool):
+        for i, s in zip(miss, fresh): results[i] = s
+        yield frac, list(results)
+    for i in miss:
+        cache.put(keys[i], results[i])
+        save_sim_cache_db(keys[i], results[i])
+
+def run_portfolio_cached(jobs, n_sims, seed=None, n_workers=1, pool=None):
+    for _, results in stream_portfolio_cached(jobs, n_sims, seed=seed, n_workers=n_workers, pool=pool): pass
+    return results
+
+@st.cache_resource(max_entries=64)
+def journal_pnl_cached(username, account_id, base, tail):
+    # Se construye una vez por cuenta y estado del diario; las reejecuciones reutilizan el array
+    days, net = load_journal_net(username, account_id, base)
+    return EmpiricalPnL(net + [n for _, n in tail], days + [d for d, _ in tail])
+
+def journal_pnl(item):
+    tail = tuple((str(t.get('date', ''))[:10], float(t['net'])) for t in item.get('journal', []))
+    return journal_pnl_cached(st.session_state['username'], int(item['id']), item.get('journal_base', 0), tail)
+
+def sweep_heatmap(grid, x_name, x_values, y_name, y_values, metric, stride):
+    # Las celdas aún no calculadas toman el valor del punto grueso más cercano
+    rows = []
+    for iy, yv in enumerate(y_values):
+        for ix, xv in enumerate(x_values):
+            cell = grid[iy][ix] or grid[iy - iy % stride][ix - ix % stride]
+            rows.append({SWEEP_PARAMS[x_name]: round(float(xv), 4), SWEEP_PARAMS[y_name]: round(float(yv), 4), SWEEP_METRICS[metric]: cell[metric]})
+    df = pd.DataFrame(rows)
+    return alt.Chart(df).mark_rect().encode(
+        x=alt.X(f"{SWEEP_PARAMS[x_name]}:O"), y=alt.Y(f"{SWEEP_PARAMS[y_name]}:O", sort="descending"),
+        color=alt.Color(f"{SWEEP_METRICS[metric]}:Q", scale=alt.Scale(scheme="viridis")),
+        tooltip=list(df.columns))
+
+DIST_CHART_BARS = 60
+PURCHASE_SIMS = 5000  # sorteos de la compra secuencial (sobre el resultado ya calculado)
+
+def dist_chart(series, x_title):
+    # series: {etiqueta: resumen de histograma (lo, width, counts)}; se reagrupa a ~DIST_CHART_BARS barras
+    rows = []
+    for label, h in series.items():
+        if not h: continue
+        counts = np.asarray(h['counts']); g = max(int(np.ceil(counts.size / DIST_CHART_BARS)), 1)
+        grouped = np.add.reduceat(counts, np.arange(0, counts.size, g))
+        for i, c in enumerate(grouped):
+            rows.append({x_title: h['lo'] + i * g * h['width'], "% de caminos": c / counts.sum() * 100, "Serie": label})
+    df = pd.DataFrame(rows)
+    return alt.Chart(df).mark_line(interpolate="step-after").encode(
+        x=alt.X(f"{x_title}:Q"), y=alt.Y("% de caminos:Q"), color=alt.Color("Serie:N"), tooltip=list(df.columns)).properties(height=220)
+
+def horizon_chart(months, curve):
+    # Caja acumulada: media y banda P10-P90 por mes, más el flujo medio de cada mes en barras
+    df = pd.DataFrame({"Mes": months, "Flujo medio $": curve['flow'], "Acumulado medio $": curve['cum'], "P10 $": curve['p10'], "P50 $": curve['p50'], "P90 $": curve['p90']})
+    base = alt.Chart(df).encode(x=alt.X("Mes:O"))
+    band = base.mark_area(opacity=0.25).encode(y=alt.Y("P10 $:Q", title="Caja neta acumulada ($)"), y2="P90 $:Q")
+    bars = base.mark_bar(opacity=0.5).encode(y="Flujo medio $:Q", tooltip=list(df.columns))
+    line = base.mark_line(point=True).encode(y="Acumulado medio $:Q", tooltip=list(df.columns))
+    return (band + bars + line).properties(height=280)
 
 # --- VISUALIZADORA ---
-def display_rich_results(results_list, title_prefix=""):
+def purchase_summary(res, concurrent):
+    # Compra secuencial sobre un resultado ya calculado: una vez por resultado y nº de cuentas simultáneas
+    # (se guarda en el propio resultado de session_state; las reejecuciones solo lo leen)
+    done = res.setdefault('purchase', {})
+    if concurrent not in done: done[concurrent] = simulate_purchases(res['data'], res['params'], res['stats'], PURCHASE_SIMS, concurrent, np.random.default_rng(0))
+    return done[concurrent]
+
+def display_rich_results(results_list, title_prefix="", joint=None, concurrent=1, live=False):
+    # live=True: redibujado parcial durante el streaming (sin la compra secuencial, que se calcula al terminar)
     g_inv = 0; g_pay1 = 0; g_pay2 = 0; g_pay3 = 0
     for res in results_list:
         g_inv += res['stats']['investment']
@@ -289,6 +290,24 @@ def display_rich_results(results_list, title_prefix=""):
     fc1.metric("Retiro 1 (Recuperación)", f"${g_pay1:,.0f}")
     fc2.metric("Retiro 2 (Beneficio)", f"${g_pay2:,.0f}")
     fc3.metric("Retiro 3 (Consistencia)", f"${g_pay3:,.0f}")
+
+    if joint:
+        # Simulación conjunta: la suma de esperados no cambia, pero el riesgo de portafolio sí
+        st.markdown(f"### 🔗 Resultado Conjunto del Portafolio (correlación {joint['rho']:.2f})")
+        j1, j2, j3, j4 = st.columns(4)
+        j1.metric("Todas fallan antes del Retiro 1", f"{joint['prob_all_fail']:.1f}%", delta=f"{joint['prob_all_fail'] - joint['prob_all_fail_indep']:+.1f}% vs independientes",
+                  delta_color="inverse", help=f"Con cuentas independientes sería {joint['prob_all_fail_indep']:.2f}%.")
+        j2.metric("Todas cobran el Retiro 1", f"{joint['prob_all_paid']:.1f}%")
+        j3.metric("Cobro total < coste de cuentas", f"{joint['prob_loss']:.1f}%", help=f"Coste total: ${joint['total_cost']:,.0f}")
+        pay = joint['payout']
+        if pay: j4.metric("Cobro total P50", f"${pay['p50']:,.0f}", help=f"P10 ${pay['p10']:,.0f} · P90 ${pay['p90']:,.0f} · media ${pay['mean']:,.0f}")
+        cj1, cj2 = st.columns(2)
+        with cj1:
+            df_paid = pd.DataFrame({"Cuentas que cobran el Retiro 1": range(len(joint['paid_accounts'])), "% de simulaciones": joint['paid_accounts']})
+            st.altair_chart(alt.Chart(df_paid).mark_bar().encode(x=alt.X("Cuentas que cobran el Retiro 1:O"), y="% de simulaciones:Q",
+                                                                 tooltip=list(df_paid.columns)).properties(height=220), use_container_width=True)
+        with cj2:
+            if pay: st.altair_chart(dist_chart({"Cobro total": pay}, "Cobro total del portafolio ($)"), use_container_width=True)
     
     st.divider()
     st.subheader("🔍 Desglose Detallado por Cuenta")
@@ -314,7 +333,17 @@ def display_rich_results(results_list, title_prefix=""):
         header_text = f"📈 {res['name']}"
         if 'start_bal' in res: header_text += f" (Desde: ${res['start_bal']:,.0f})"
         
-        with st.expander(f"{header_text} | Prob. Cobro: {s['prob_c1']:.1f}%"):
+        ci_text = f" ± {s['prob_c1_ci']:.1f}%" if 'prob_c1_ci' in s else ""
+        with st.expander(f"{header_text} | Prob. Cobro: {s['prob_c1']:.1f}%{ci_text}"):
+            if s.get('exact'):
+                st.caption("🧮 Motor exacto (cadena de Markov): sin ruido de muestreo.")
+                exp = s.get('exp_trades') or {}
+                if exp:
+                    labels = {"p1": "Fase 1", "p2": "Fase 2", "c1": "Retiro 1", "c2": "Retiro 2", "c3": "Retiro 3"}
+                    st.caption("🔢 **Trades esperados por fase** (por intento · si la pasa): " + " | ".join(f"{labels[k]} {e['attempt']:.0f} · {e['success']:.0f}" for k, e in exp.items()))
+                    st.caption("🔢 **Trades acumulados hasta cada retiro** (si se cobra): " + " | ".join(f"{labels[k]} {v:.0f}" for k, v in s['exp_trades_payout'].items()))
+            if 'n_sims_used' in s:
+                st.caption(f"🎯 Adaptativo: {s['n_sims_used']:,} sims | IC95% Prob. Cobro ± {s['prob_c1_ci']:.2f}% | Ganancia Neta ± ${s['net_profit_ci']:,.0f}")
             cols = st.columns(6)
             cols[0].metric("1. Fase 1", f"{s['prob_p1']:.1f}%", delta=deltas['p1']); cols[0].caption(f"⏱ {s['time_p1']:.1f} m")
             p2_val = f"{s['prob_p2']:.1f}%" if s['is_2step'] else "N/A"
@@ -323,6 +352,24 @@ def display_rich_results(results_list, title_prefix=""):
             cols[3].metric("4. Retiro 1", f"{s['prob_c1']:.1f}%", delta=deltas['c1']); cols[3].caption(f"${s['avg_pay1']:,.0f} | {s['time_c1']:.1f} m")
             cols[4].metric("5. Retiro 2", f"{s['prob_c2']:.1f}%", delta=deltas['c2']); cols[4].caption(f"${s['avg_pay2']:,.0f} | {s['time_c2']:.1f} m")
             cols[5].metric("6. Retiro 3", f"{s['prob_c3']:.1f}%", delta=deltas['c3']); cols[5].caption(f"${s['avg_pay3']:,.0f} | {s['time_c3']:.1f} m")
+
+            # Distribuciones (histogramas de tamaño fijo, independientes del nº de simulaciones)
+            timeline = s.get('timeline') or {}
+            if timeline:
+                st.caption("⏳ **Meses hasta cada retiro** (P10 · P50 · P90, entre los caminos que llegan):")
+                t_cols = st.columns(3)
+                for col, key, label in zip(t_cols, ("c1", "c2", "c3"), ("Retiro 1", "Retiro 2", "Retiro 3")):
+                    h = timeline.get(key)
+                    col.caption(f"{label}: {h['p10']:.1f} · **{h['p50']:.1f}** · {h['p90']:.1f} m" if h else f"{label}: -")
+                phases = {"p1": "Fase 1", "p2": "Fase 2", "c1": "Retiro 1", "c2": "Retiro 2", "c3": "Retiro 3"}
+                dist = s.get('dist') or {}
+                charts = [("Meses a retiro", {phases[k]: h for k, h in timeline.items() if k in phases}, "Meses desde hoy")]
+                if any('equity' in d for d in dist.values()):
+                    charts.append(("Equity final", {phases[k]: d.get('equity') for k, d in dist.items()}, "Equity final (% s/ tamaño)"))
+                    charts.append(("Peor DD intradía", {phases[k]: d.get('daily_dd') for k, d in dist.items()}, "Peor DD diario (% s/ tamaño)"))
+                charts = [c for c in charts if any(c[1].values())]
+                for tab, (_, series, x_title) in zip(st.tabs([c[0] for c in charts]), charts) if charts else ():
+                    with tab: st.altair_chart(dist_chart(series, x_title), use_container_width=True)
             
             st.markdown("---")
             if s['total_failures'] > 0:
@@ -335,11 +382,62 @@ def display_rich_results(results_list, title_prefix=""):
             
             st.markdown("---")
             st.info(f"**Estrategia:** {s['stock_reason']}")
+            buy = purchase_summary(res, concurrent) if 'data' in res and not live else None
+            if buy:
+                st.caption(f"🛒 **Compra secuencial** ({concurrent} cuenta{'s' if concurrent > 1 else ''} a la vez, recomprando cada una al perderla hasta su Retiro 1):")
+                fees, months, peak = buy['fees'], buy['months'], buy['peak']
+                bc = st.columns(3)
+                bc[0].metric("Comisiones pagadas (P50)", f"${fees['p50']:,.0f}", help=f"P10 ${fees['p10']:,.0f} · P90 ${fees['p90']:,.0f} · media ${fees['mean']:,.0f} ({buy['avg_accounts']:.1f} cuentas)")
+                if months: bc[1].metric("Meses al 1er cobro (P50)", f"{months['p50']:.1f}", help=f"P10 {months['p10']:.1f} · P90 {months['p90']:.1f} · media {months['mean']:.1f}")
+                bc[2].metric("Capital máximo (P50)", f"${peak['p50']:,.0f}", help=f"P10 ${peak['p10']:,.0f} · P90 ${peak['p90']:,.0f}. Pico de comisiones pagadas menos retiros 1 ya cobrados.")
+                if buy['prob_no_payout'] > 0: st.caption(f"⚠️ {buy['prob_no_payout']:.1f}% de los sorteos no cobran en {PURCHASE_MAX_ATTEMPTS} intentos por cuenta.")
             st.caption("💰 **Desglose 1er Pago:**")
             cp = st.columns(4)
             cp[0].metric("Split", f"${bk['split']:,.0f}"); cp[1].metric("Refund", f"+${bk['refund']}")
             cp[2].metric("Bonus", f"+${bk['bonus']}"); cp[3].metric("TOTAL", f"${bk['total']:,.0f}", delta=deltas['money'])
 
+def display_horizon(names, h):
+    p = h['portfolio']
+    st.markdown(f"### 📅 Caja del Portafolio ({h['months'][0]} a {h['months'][-1]}, {h['n_sims']:,} sims)")
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("Caja neta media al final", f"${p['cum'][-1]:,.0f}", help=f"Coste de las cuentas: ${p['total_cost']:,.0f}")
+    m2.metric("Caja neta P10 · P90", f"${p['p10'][-1]:,.0f} · ${p['p90'][-1]:,.0f}")
+    m3.metric("Retiros esperados", f"{p['exp_payouts']:.1f}", help=f"Suma entre cuentas, con un máximo de {h['n_payouts']} por cuenta.")
+    recovered = next((m for m, v in zip(h['months'], p['cum']) if v >= 0), None)
+    m4.metric("Mes de recuperación (media)", recovered or "-", help="Primer mes en que la caja acumulada media deja de ser negativa.")
+    st.altair_chart(horizon_chart(h['months'], p), use_container_width=True)
+    rows = []
+    for name, a in zip(names, h['accounts']):
+        rows.append({"Cuenta": name, "Fondeada %": round(a['prob_funded'], 1), "≥1 retiro %": round(a['prob_payouts'][0], 1),
+                     f"{h['n_payouts']} retiros %": round(a['prob_payouts'][-1], 1), "Retiros esperados": round(a['exp_payouts'], 2),
+                     "Perdida %": round(a['prob_failed'][-1], 1), "Caja media $": round(a['cum'][-1]), "P10 $": round(a['p10'][-1]), "P90 $": round(a['p90'][-1])})
+    st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+    for tab, (name, a) in zip(st.tabs(names), zip(names, h['accounts'])):
+        with tab: st.altair_chart(horizon_chart(h['months'], a), use_container_width=True)
+
+def display_diagnostics():
+    with st.expander("🩺 Diagnóstico de rendimiento", expanded=True):
+        run = st.session_state.get('last_run_diag')
+        if run:
+            d1, d2, d3, d4 = st.columns(4)
+            d1.metric("Tiempo total", f"{run['wall_s']:.2f} s", help=f"{run['title']} | modo {run['mode']}")
+            d2.metric("Sims/s", f"{run['sims_per_s']:,.0f}", help=f"{run['sims']:,} simulaciones nuevas en {run['accounts']} cuentas")
+            d3.metric("Trades simulados", f"{run['trades']:,}")
+            cache = st.session_state.get('diag_cache')
+            d4.metric("Caché", f"{cache['hits']}/{cache['hits'] + cache['misses']}" if cache else "-", help="Cuentas servidas desde caché en la última corrida.")
+            if run['rows']:
+                st.caption("Por cuenta y fase (CPU sumada entre procesos; caminos por causa de fin):")
+                st.dataframe(pd.DataFrame(run['rows']).fillna(0), use_container_width=True, hide_index=True)
+        else: st.caption("Aún no hay simulaciones en esta sesión.")
+        timings = st.session_state.get('diag_timings', [])
+        if timings:
+            df_t = pd.DataFrame(timings)
+            st.caption("Latencias (BD y UI), últimas llamadas:")
+            st.dataframe(df_t.groupby(["kind", "label"])["ms"].agg(["count", "mean", "max"]).round(2), use_container_width=True)
+        if st.session_state.get('profile_text'):
+            st.caption("cProfile de la última simulación perfilada:")
+            st.code(st.session_state['profile_text'], language="text")
+
 # --- UI ---
 if not st.session_state['logged_in']:
     st.title("💼 Prop Firm Portfolio Manager")
@@ -353,6 +451,9 @@ if not st.session_state['logged_in']:
                     st.session_state['logged_in'] = True; st.session_state['username'] = u
                     saved = load_portfolio_db(u)
                     if saved: st.session_state['portfolio'] = saved
+                    # Sin lectura válida no se autoguarda: un portafolio vacío por error borraría las cuentas en BD
+                    st.session_state['autosave_ready'] = saved is not None
+                    st.session_state['saved_fp'] = portfolio_fingerprint(st.session_state['portfolio'])
                     st.rerun()
                 else: st.error("Error")
         with tab2:
@@ -368,17 +469,102 @@ else:
     
     with st.sidebar:
         st.header("1. Global")
-        sim_precision = st.select_slider("Simulaciones", options=[500, 1000, 5000], value=1000)
+        sim_engine = st.radio("Motor", ["Montecarlo", "Markov (exacto)"], horizontal=True, help="Markov resuelve las probabilidades de forma analítica, sin ruido de muestreo.")
+        if sim_engine == "Montecarlo":
+            sim_mode = st.radio("Precisión", ["Fija", "Adaptativa"], horizontal=True)
+            if sim_mode == "Fija":
+                sim_precision = st.select_slider("Simulaciones", options=[500, 1000, 5000], value=1000)
+            else:
+                c_hw, c_tb = st.columns(2)
+                target_hw = c_hw.number_input("Error ± %", 0.1, 10.0, 1.0, step=0.1, help="Semiancho objetivo del IC95% de la Prob. de Cobro.")
+                time_budget = c_tb.number_input("Tiempo máx. (s)", 1.0, 120.0, 10.0, step=1.0)
+                use_net_target = st.checkbox("Exigir también precisión en Ganancia Neta")
+                net_target = st.number_input("Error Ganancia ± $", 1.0, 10000.0, 50.0, step=10.0) if use_net_target else None
+        else: sim_mode = "Exacto"
+        c_par, c_seed = st.columns(2)
+        par_mode = c_par.toggle("⚡ Paralelo", value=False, help="Reparte cuentas y bloques de simulaciones entre los núcleos del servidor.")
+        sim_seed = c_seed.number_input("Semilla", 0, 2**31 - 1, DEFAULT_SEED, help="Con la misma semilla el resultado es idéntico, en paralelo o no, y se reutiliza desde la caché. 0 = aleatoria (sin caché).")
+        seed_val = int(sim_seed) if sim_seed else None
+        n_workers = None if par_mode else 1
+        sim_pool = get_worker_pool() if par_mode else None
+        joint_mode = st.toggle("🔗 Simulación conjunta", value=False, help="Simula todas las cuentas del portafolio a la vez operando los mismos trades: fallos correlacionados y resultados de portafolio.")
+        joint_rho = st.slider("Correlación entre cuentas", 0.0, 1.0, 1.0, step=0.05, help="1 = mismos trades en todas las cuentas (copy trading); 0 = independientes.") if joint_mode else None
+        concurrent = st.number_input("Cuentas simultáneas", 1, 10, 1, help="Compra secuencial: cuántas cuentas se mantienen activas a la vez, recomprando cada una al perderla.")
+        c_diag, c_prof = st.columns(2)
+        show_diag = c_diag.toggle("🩺 Diagnóstico", value=False)
+        # Un solo perfil por activación: tras capturarlo se desmarca antes de la siguiente ejecución
+        if st.session_state.pop('profile_done', False): st.session_state['profile_next'] = False
+        profile_next = c_prof.checkbox("cProfile", value=False, key="profile_next", help="Perfila la próxima simulación (solo el proceso principal).") if show_diag else False
+
+        def run_jobs(jobs):
+            if sim_mode == "Exacto":
+                # El bootstrap del diario y las reglas dependientes del camino no tienen solver exacto: van por Montecarlo
+                boot = [j for j, (acc, params, _) in enumerate(jobs) if not markov_supported(acc, params)]
+                mc = dict(zip(boot, run_portfolio_cached([jobs[j] for j in boot], FALLBACK_MC_SIMS, seed=seed_val, n_workers=n_workers, pool=sim_pool))) if boot else {}
+                return [mc[j] if j in mc else run_account_markov(acc, params, bal) for j, (acc, params, bal) in enumerate(jobs)]
+            if sim_mode == "Adaptativa":
+                return run_portfolio_adaptive(jobs, target_hw, time_budget, seed=seed_val, net_target=net_target)
+            return run_portfolio_cached(jobs, sim_precision, seed=seed_val, n_workers=n_workers, pool=sim_pool)
+
+        def run_jobs_live(jobs, build, state_key, title_prefix, spinner_text, n_portfolio=None):
+            # build(stats) -> lista de resultados para display_rich_results (stats puede tener None).
+            # n_portfolio: nº de jobs iniciales que forman el portafolio (el resto son baselines aparte)
+            st.session_state[state_key + '_progress'] = 1.0
+            st.session_state[state_key + '_joint'] = None
+            profiler = cProfile.Profile() if profile_next else None
+            t0 = time.perf_counter()
+            if profiler: profiler.enable()
+            try:
+                if joint_mode:
+                    n_port = len(jobs) if n_portfolio is None else n_portfolio
+                    # El motor conjunto usa el modelo WR/RR (el bootstrap del diario es por cuenta)
+                    port_jobs = [(acc, parametric_params(params), bal) for acc, params, bal in jobs[:n_port]]
+                    with st.spinner(spinner_text):
+                        stats, joint = run_portfolio_joint(port_jobs, sim_precision if sim_mode == "Fija" else FALLBACK_MC_SIMS, rho=joint_rho, seed=seed_val, n_workers=n_workers, pool=sim_pool)
+                        if len(jobs) > n_port: stats = stats + run_jobs(jobs[n_port:])
+                        st.session_state[state_key] = build(stats)
+                        st.session_state[state_key + '_joint'] = joint
+                elif sim_mode != "Fija":
+                    with st.spinner(spinner_text):
+                        stats = run_jobs(jobs)
+                        st.session_state[state_key] = build(stats)
+                else:
+                    # Cualquier clic relanza el script y corta el cálculo; se conserva la última estimación parcial
+                    st.button("⏹ Cancelar", key=f"cancel_{state_key}", help="Detiene la simulación y conserva la estimación parcial.")
+                    bar = st.progress(0.0, text=spinner_text); live = st.empty()
+                    last_draw = 0.0
+                    for frac, stats in stream_portfolio_cached(jobs, sim_precision, seed=seed_val, n_workers=n_workers, pool=sim_pool):
+                        st.session_state[state_key] = build(stats)
+                        st.session_state[state_key + '_progress'] = frac
+                        bar.progress(frac, text=f"{spinner_text} {frac*100:.0f}%")
+                        if frac < 1.0 and time.perf_counter() - last_draw > 0.25:
+                            with live.container(): display_rich_results(st.session_state[state_key], title_prefix=f"{title_prefix} (parcial {frac*100:.0f}%)", concurrent=concurrent, live=True)
+                            last_draw = time.perf_counter()
+                    bar.empty(); live.empty()
+            finally:
+                if profiler:
+                    profiler.disable()
+                    out = io.StringIO()
+                    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(30)
+                    st.session_state['profile_text'] = out.getvalue()
+                    st.session_state['profile_done'] = True
+            record_run_diag(title_prefix, "Conjunta" if joint_mode else sim_mode, jobs, stats, time.perf_counter() - t0)
+
+        def partial_title(state_key, title_prefix):
+            frac = st.session_state.get(state_key + '_progress', 1.0)
+            return title_prefix if frac >= 1.0 else f"{title_prefix} (parcial {frac*100:.0f}%)"
         
         c_save, c_load = st.columns(2)
         with c_save:
             if st.button("💾 Guardar", type="secondary", use_container_width=True):
-                if save_portfolio_db(st.session_state['username'], st.session_state['portfolio']): st.toast("Guardado")
+                if save_portfolio_db(st.session_state['username'], st.session_state['portfolio']):
+                    st.session_state['autosave_ready'] = True; st.toast("Guardado")
         with c_load:
             if st.button("🔄 Restaurar", type="secondary", use_container_width=True):
                 saved = load_portfolio_db(st.session_state['username'])
                 if saved:
                     st.session_state['portfolio'] = saved
+                    st.session_state['autosave_ready'] = True; st.session_state['saved_fp'] = portfolio_fingerprint(saved)
                     # FIX: Actualizar estado de widgets
                     for item in saved:
                         k = str(item['id'])
@@ -390,13 +576,20 @@ else:
                         if f"cm{k}" in st.session_state: st.session_state[f"cm{k}"] = item['params']['comm']
                     st.rerun()
                 else: st.warning("No hay datos guardados.")
+        if engine:
+            st.toggle("Autoguardado", value=True, key="autosave", help=f"Guarda en segundo plano tras {db.AUTOSAVE_DELAY:.0f}s sin cambios, sin bloquear la app.")
+            last_save = get_autosaver().status.get(st.session_state['username'])
+            if last_save: st.caption(f"{'✅' if last_save[1] else '⚠️'} Último guardado {last_save[0]}" + ("" if last_save[1] else " (falló)"))
         
         st.divider()
         st.header("2. Catálogo")
-        s_firm = st.selectbox("Empresa", list(FIRMS_DATA.keys()))
-        s_prog = st.selectbox("Programa", list(FIRMS_DATA[s_firm].keys()))
-        s_size = st.selectbox("Capital", list(FIRMS_DATA[s_firm][s_prog].keys()))
-        d = FIRMS_DATA[s_firm][s_prog][s_size]
+        catalog = load_catalog()
+        s_firm = st.selectbox("Empresa", list(catalog.keys()))
+        s_prog = st.selectbox("Programa", list(catalog[s_firm].keys()))
+        s_size = st.selectbox("Capital", list(catalog[s_firm][s_prog].keys()))
+        d = catalog[s_firm][s_prog][s_size]
+        firm_rules = {k: v for k, v in d.items() if k in RULE_DEFAULTS}
+        if firm_rules: st.caption("Reglas: " + ", ".join(f"{k}={v}" for k, v in firm_rules.items()))
         
         if st.button("➕ Agregar Cuenta", use_container_width=True):
             st.session_state['portfolio'].append({
@@ -411,7 +604,17 @@ else:
     if not st.session_state['portfolio']:
         st.info("Portafolio vacío. Agrega una cuenta para comenzar.")
     else:
-        tab_teorica, tab_journal, tab_real = st.tabs(["Proyección Teórica Portafolio", "Diario / Ejecución", "Proyección Real Portafolio"])
+        # Valores elegidos por el optimizador: se aplican antes de crear los widgets rk/wt
+        opt_apply = st.session_state.pop('opt_apply', None)
+        if opt_apply:
+            for item in st.session_state['portfolio']:
+                if item['id'] not in opt_apply: continue
+                k = str(item['id'])
+                item['params'].update(opt_apply[item['id']])
+                st.session_state[f"rk{k}"] = item['params']['risk']; st.session_state[f"wt{k}"] = item['params']['withdrawal_target']
+            st.toast("Parámetros optimizados aplicados")
+
+        tab_teorica, tab_journal, tab_real, tab_sweep, tab_opt, tab_horizon = st.tabs(["Proyección Teórica Portafolio", "Diario / Ejecución", "Proyección Real Portafolio", "Barrido de Parámetros", "Optimizador", "Horizonte"])
         
         with tab_teorica:
             st.subheader("Parametrización y Escenarios Ideales")
@@ -432,16 +635,16 @@ else:
             
             st.markdown("---")
             if st.button("🚀 Simular Portafolio (TEÓRICO)", type="secondary", use_container_width=True):
-                with st.spinner("Calculando Escenario Ideal..."):
+                jobs = [(item['data'], item['params'], item['data']['size']) for item in st.session_state['portfolio']]
+                def build_theoretical(stats):
                     results = []
-                    for item in st.session_state['portfolio']:
-                        start_bal = item['data']['size']
-                        s = run_account_simulation(item['data'], item['params'], sim_precision, start_bal)
-                        results.append({"name": item['full_name'], "stats": s, "start_bal": start_bal})
-                    st.session_state['sim_results_theoretical'] = results
+                    for item, s in zip(st.session_state['portfolio'], stats):
+                        if s is not None: results.append({"name": item['full_name'], "stats": s, "start_bal": item['data']['size'], "data": item['data'], "params": item['params']})
+                    return results
+                run_jobs_live(jobs, build_theoretical, 'sim_results_theoretical', "TEÓRICO", "Calculando Escenario Ideal...")
             
             if st.session_state['sim_results_theoretical']:
-                display_rich_results(st.session_state['sim_results_theoretical'], title_prefix="TEÓRICO")
+                display_rich_results(st.session_state['sim_results_theoretical'], title_prefix=partial_title('sim_results_theoretical', "TEÓRICO"), joint=st.session_state.get('sim_results_theoretical_joint'), concurrent=concurrent)
 
         with tab_journal:
             st.subheader("📓 Registro de Operaciones Reales")
@@ -456,54 +659,172 @@ else:
                         t_swap = f4.number_input("Swap ($)", value=0.0, step=1.0)
                         if st.form_submit_button("💾 Registrar Trade"):
                             net = t_gross - t_comm - t_swap
-                            item['journal'].append({"date": str(t_date), "gross": t_gross, "comm": t_comm, "swap": t_swap, "net": net})
+                            append_journal_trade(item, {"date": str(t_date), "gross": t_gross, "comm": t_comm, "swap": t_swap, "net": net})
                             st.success(f"Trade guardado: ${net:.2f}"); st.rerun()
 
+                    up = st.file_uploader("📥 Importar historial (CSV / informe MT4-MT5)", type=["csv", "txt", "htm", "html"], key=f"imp_{item['id']}")
+                    if up is not None and st.button("Importar trades", key=f"impb_{item['id']}"):
+                        # Se guarda antes para que la BD tenga la cuenta y los trades manuales pendientes
+                        if not save_portfolio_db(st.session_state['username'], st.session_state['portfolio']): st.error("No se pudo guardar el portafolio antes de importar.")
+                        else:
+                            bar = st.progress(0.0, text="Importando...")
+                            size = max(up.size, 1)
+                            progress = lambda n, d: bar.progress(min(up.tell() / size, 1.0), text=f"{n:,} trades importados · {d:,} duplicados")
+                            try:
+                                with timed(f"journal_import {item['full_name']}", kind="db"):
+                                    n_new, n_dup, n_bad = import_journal_db(st.session_state['username'], item, iter_import_chunks(up), progress)
+                                bar.empty(); st.success(f"{n_new:,} trades importados ({n_dup:,} duplicados omitidos).")
+                                if n_bad: st.warning(f"{n_bad:,} filas omitidas: su beneficio no es un número válido.")
+                            except Exception as e:
+                                bar.empty(); st.error(f"Error al importar: {e}")
+
                     if item['journal']:
-                        df_j = pd.DataFrame(item['journal'])
-                        total_pnl = df_j['net'].sum()
-                        current_bal = item['data']['size'] + total_pnl
+                        current_bal = account_balance(item)
+                        total_pnl = current_bal - item['data']['size']
                         c1, c2, c3 = st.columns(3)
                         c1.metric("Balance Inicial", f"${item['data']['size']:,.0f}")
                         c2.metric("P&L Acumulado", f"${total_pnl:,.2f}", delta_color="normal")
-                        c3.metric("Balance ACTUAL", f"${current_bal:,.2f}")
-                        st.dataframe(df_j.tail(5), use_container_width=True)
+                        c3.metric("Balance ACTUAL", f"${current_bal:,.2f}", help=f"{journal_count(item):,} trades registrados")
+                        with timed(f"journal_df {item['full_name']}"): df_j = pd.DataFrame(item['journal'][-5:])
+                        st.dataframe(df_j, use_container_width=True)
                     else: st.info("Sin trades registrados.")
 
         with tab_real:
-            total_trades_count = sum(len(item.get('journal', [])) for item in st.session_state['portfolio'])
+            total_trades_count = sum(journal_count(item) for item in st.session_state['portfolio'])
             
             if total_trades_count == 0:
                 st.info("⚠️ Para generar una Proyección Real, primero debes registrar al menos una operación en la pestaña 'Diario / Ejecución'.")
                 st.caption("Esta sección compara tu realidad vs el plan ideal.")
             else:
+                pnl_source = st.radio("Distribución de P&L", PNL_SOURCES, horizontal=True,
+                                      help="Bootstrap: remuestrea el P&L neto real del diario (trade a trade o por días completos) en vez de usar WR/RR.")
+                if pnl_source != PNL_SOURCES[0] and joint_mode: st.caption("🔗 La simulación conjunta comparte trades entre cuentas: usa el modelo WR/RR, no el bootstrap del diario.")
+                elif pnl_source != PNL_SOURCES[0] and sim_mode == "Exacto": st.caption(f"🧮 El bootstrap no tiene versión exacta: se simula con Montecarlo ({FALLBACK_MC_SIMS:,} sims).")
                 if st.button("🚀 Proyectar desde Balance Actual (REAL)", type="primary", use_container_width=True):
-                    with st.spinner("Ejecutando Montecarlo desde tu realidad..."):
+                    theoretical_cache = {}
+                    if st.session_state.get('sim_results_theoretical') and st.session_state.get('sim_results_theoretical_progress', 1.0) >= 1.0:
+                        for t_res in st.session_state['sim_results_theoretical']:
+                            theoretical_cache[t_res['name']] = t_res['stats']
+                    
+                    # Reales + baselines teóricos que falten, todos en una sola tanda
+                    portfolio = list(st.session_state['portfolio'])
+                    jobs = []; start_bals = []; baseline_idx = {}
+                    for item in portfolio:
+                        if 'journal' not in item: item['journal'] = []
+                        start_bal_real = account_balance(item)
+                        start_bals.append(start_bal_real)
+                        params = item['params']
+                        if pnl_source != PNL_SOURCES[0] and journal_count(item) > 0:
+                            params = empirical_params(params, journal_pnl(item), by_day=pnl_source == PNL_SOURCES[2])
+                        jobs.append((item['data'], params, start_bal_real))
+                    for item in portfolio:
+                        if item['full_name'] not in theoretical_cache and item['full_name'] not in baseline_idx:
+                            baseline_idx[item['full_name']] = len(jobs)
+                            jobs.append((item['data'], item['params'], item['data']['size']))
+                    
+                    def build_real(stats):
                         results = []
-                        theoretical_cache = {}
-                        if st.session_state.get('sim_results_theoretical'):
-                            for t_res in st.session_state['sim_results_theoretical']:
-                                theoretical_cache[t_res['name']] = t_res['stats']
-                        
-                        for item in st.session_state['portfolio']:
-                            if 'journal' not in item: item['journal'] = []
-                            start_bal_real = item['data']['size'] + sum(t['net'] for t in item['journal'])
-                            s_real = run_account_simulation(item['data'], item['params'], sim_precision, start_bal_real)
-                            
+                        for item, s_real, start_bal_real in zip(portfolio, stats, start_bals):
+                            if s_real is None: continue
                             # Baseline check
-                            if item['full_name'] in theoretical_cache:
-                                s_theory = theoretical_cache[item['full_name']]
-                            else:
-                                s_theory = run_account_simulation(item['data'], item['params'], sim_precision, item['data']['size'])
-                            
-                            results.append({
-                                "name": item['full_name'], 
-                                "stats": s_real, 
-                                "start_bal": start_bal_real,
-                                "baseline": s_theory
-                            })
-                        
-                        st.session_state['sim_results_real'] = results
+                            name = item['full_name']
+                            s_theory = theoretical_cache[name] if name in theoretical_cache else stats[baseline_idx[name]]
+                            res = {"name": name, "stats": s_real, "start_bal": start_bal_real, "data": item['data'], "params": item['params']}
+                            if s_theory is not None: res["baseline"] = s_theory
+                            results.append(res)
+                        return results
+                    run_jobs_live(jobs, build_real, 'sim_results_real', "REAL", "Ejecutando Montecarlo desde tu realidad...", n_portfolio=len(portfolio))
                 
                 if st.session_state['sim_results_real']:
-                    display_rich_results(st.session_state['sim_results_real'], title_prefix="REAL")
\ No newline at end of file
+                    display_rich_results(st.session_state['sim_results_real'], title_prefix=partial_title('sim_results_real', "REAL"), joint=st.session_state.get('sim_results_real_joint'), concurrent=concurrent)
+
+        with tab_sweep:
+            st.subheader("🔥 Mapa de Calor de Parámetros")
+            names = [item['full_name'] for item in st.session_state['portfolio']]
+            sw_idx = st.selectbox("Cuenta", range(len(names)), format_func=lambda i: names[i], key="sw_acc")
+            sw_item = st.session_state['portfolio'][sw_idx]
+            param_keys = list(SWEEP_PARAMS.keys())
+            sx1, sx2, sx3, sx4 = st.columns(4)
+            x_name = sx1.selectbox("Eje X", param_keys, index=param_keys.index("risk"), format_func=SWEEP_PARAMS.get, key="sw_x")
+            x_min = sx2.number_input("X mín", value=0.25, step=0.05, key="sw_xmin")
+            x_max = sx3.number_input("X máx", value=2.5, step=0.05, key="sw_xmax")
+            x_n = sx4.number_input("Puntos X", 2, 40, 20, key="sw_xn")
+            sy1, sy2, sy3, sy4 = st.columns(4)
+            y_name = sy1.selectbox("Eje Y", param_keys, index=param_keys.index("win_rate"), format_func=SWEEP_PARAMS.get, key="sw_y")
+            y_min = sy2.number_input("Y mín", value=30.0, step=1.0, key="sw_ymin")
+            y_max = sy3.number_input("Y máx", value=60.0, step=1.0, key="sw_ymax")
+            y_n = sy4.number_input("Puntos Y", 2, 40, 20, key="sw_yn")
+            sm1, sm2 = st.columns(2)
+            sw_metric = sm1.selectbox("Métrica", list(SWEEP_METRICS.keys()), format_func=SWEEP_METRICS.get, key="sw_metric")
+            sw_sims = sm2.select_slider("Simulaciones por punto", options=[200, 500, 1000], value=500, key="sw_sims")
+
+            if x_name == y_name:
+                st.warning("Elige dos parámetros distintos para los ejes.")
+            elif st.button("🔥 Barrer", use_container_width=True):
+                x_values = np.linspace(x_min, x_max, int(x_n)); y_values = np.linspace(y_min, y_max, int(y_n))
+                chart_slot = st.empty(); bar = st.progress(0.0)
+                for stride, grid in run_parameter_sweep(sw_item['data'], sw_item['params'], x_name, x_values, y_name, y_values, sw_sims, sw_item['data']['size'], seed=seed_val):
+                    chart_slot.altair_chart(sweep_heatmap(grid, x_name, x_values, y_name, y_values, sw_metric, stride), use_container_width=True)
+                    bar.progress({4: 0.1, 2: 0.35, 1: 1.0}[stride], text=f"Resolución 1/{stride}")
+                st.session_state['sweep_result'] = (x_name, x_values, y_name, y_values, grid)
+            elif st.session_state.get('sweep_result'):
+                sx_name, x_values, sy_name, y_values, grid = st.session_state['sweep_result']
+                st.altair_chart(sweep_heatmap(grid, sx_name, x_values, sy_name, y_values, sw_metric, 1), use_container_width=True)
+
+        with tab_opt:
+            st.subheader("🎯 Optimizador de Riesgo y Meta de Retiro")
+            st.caption("Successive halving con números aleatorios comunes: los candidatos claramente peores dejan de simularse y el resto recibe lotes cada vez mayores.")
+            portfolio = st.session_state['portfolio']
+            names = [item['full_name'] for item in portfolio]
+            o1, o2, o3 = st.columns(3)
+            opt_scope = o1.selectbox("Cuentas", [None] + list(range(len(names))), format_func=lambda i: "Todo el portafolio" if i is None else names[i], key="opt_acc")
+            opt_metric = o2.selectbox("Maximizar", list(OPT_METRICS.keys()), format_func=OPT_METRICS.get, key="opt_metric")
+            opt_budget = o3.slider("Presupuesto (s)", 5, 120, 20, step=5, key="opt_budget")
+            r_lo, r_hi, r_step = OPT_PARAMS['risk']; w_lo, w_hi, w_step = OPT_PARAMS['withdrawal_target']
+            o4, o5, o6 = st.columns(3)
+            opt_risk = o4.slider("Rango Riesgo %", r_lo, r_hi, (0.3, 2.5), step=r_step, key="opt_risk")
+            opt_wt = o5.slider("Rango Meta Retiro %", w_lo, w_hi, (1.0, 10.0), step=w_step, key="opt_wt")
+            opt_n = o6.number_input("Candidatos", 8, 128, 32, step=8, key="opt_n")
+
+            if st.button("🎯 Optimizar y aplicar", use_container_width=True):
+                targets = list(range(len(portfolio))) if opt_scope is None else [opt_scope]
+                jobs = [(portfolio[i]['data'], portfolio[i]['params'], portfolio[i]['data']['size']) for i in targets]
+                status = st.empty(); bar = st.progress(0.0)
+                last = {}; t0 = time.perf_counter()
+                for j, info in run_optimizer(jobs, opt_metric, opt_budget, {"risk": opt_risk, "withdrawal_target": opt_wt}, int(opt_n), seed=seed_val):
+                    last[j] = info
+                    best = info['ranking'][0]
+                    status.caption(f"{names[targets[j]]}: ronda {info['round'] + 1}, {len(info['ranking'])} candidatos vivos, mejor {best['params']} ({info['sims']:,} sims)")
+                    bar.progress(min((time.perf_counter() - t0) / opt_budget, 1.0))
+                st.session_state['opt_result'] = [(portfolio[targets[j]]['full_name'], opt_metric, info) for j, info in sorted(last.items())]
+                st.session_state['opt_apply'] = {portfolio[targets[j]]['id']: info['ranking'][0]['params'] for j, info in last.items()}
+                st.rerun()
+
+            if st.session_state.get('opt_result'):
+                rows = []
+                for name, metric, info in st.session_state['opt_result']:
+                    best = info['ranking'][0]
+                    rows.append({"Cuenta": name, "Riesgo %": best['params']['risk'], "Meta Retiro %": best['params']['withdrawal_target'],
+                                 OPT_METRICS[metric]: f"{best['value']:,.1f} ± {best['ci']:,.1f}", "Prob. Cobro %": round(best['stats']['prob_c1'], 1),
+                                 "Sims del ganador": best['n_sims'], "Candidatos": info['candidates'], "Sims totales": info['sims'], "Rondas": info['round'] + 1})
+                st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+                st.caption("± = semiancho del IC95%. Los valores ya se aplicaron a Riesgo % y Meta Retiro % de cada cuenta.")
+
+        with tab_horizon:
+            st.subheader("📅 Horizonte en Calendario")
+            st.caption("Cada cuenta se compra hoy y recorre Fase 1 → Fase 2 → retiros sobre días hábiles reales, sin recompras; cada etapa empieza el día hábil siguiente a la anterior. Con la simulación conjunta activa se usa su correlación entre cuentas.")
+            h1, h2, h3 = st.columns(3)
+            hz_months = h1.slider("Meses", 1, 36, HORIZON_MONTHS, key="hz_months")
+            hz_payouts = h2.number_input("Retiros máx. por cuenta", 1, 60, HORIZON_PAYOUTS, key="hz_payouts")
+            hz_sims = h3.select_slider("Simulaciones", options=[1000, 2500, 5000, 10000, 20000], value=10000, key="hz_sims")
+            if st.button("📅 Simular horizonte", use_container_width=True):
+                portfolio = st.session_state['portfolio']
+                jobs = [(item['data'], item['params'], item['data']['size']) for item in portfolio]
+                with st.spinner("Simulando el horizonte..."), timed("horizon", kind="sim"):
+                    h = run_portfolio_horizon(jobs, hz_sims, hz_months, int(hz_payouts), rho=joint_rho or 0.0, seed=seed_val, n_workers=n_workers, pool=sim_pool)
+                st.session_state['horizon_result'] = ([item['full_name'] for item in portfolio], h)
+            if st.session_state.get('horizon_result'):
+                display_horizon(*st.session_state['horizon_result'])
+
+    if show_diag: display_diagnostics()
+    autosave_portfolio()
@@ -0,0 +1,196 @@
+# Benchmarks y regresión estadística del motor de simulación.
+#
+#   python bench.py                    # mide, valida motores contra la referencia y compara con la baseline
+#   python bench.py --update           # reescribe bench_baseline.json con las mediciones actuales
+#   python bench.py --quick -o r.json  # corrida corta, resultados a JSON
+#
+# La referencia es el bucle escalar original (simulate_phase camino a camino). Los motores
+# alternativos (batch, markov) deben reproducir prob_p1/p2/c1-c3 y las causas de fallo dentro
+# de los límites de confianza. Sale con código 1 si algún check estadístico falla.
+import argparse
+import json
+import math
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import sim_engine
+from sim_engine import load_catalog, hist_counts, simulate_phase, simulate_phase_batch, summarize_account, run_account_simulation, run_account_markov
+
+BASELINE_PATH = "bench_baseline.json"
+PROB_KEYS = ["prob_p1", "prob_p2", "prob_c1", "prob_c2", "prob_c3"]
+Z_CRIT = 3.89          # ~1e-4 bilateral por check; hay muchos checks por corrida
+MARKOV_TOL = 1.0       # puntos % extra por discretización del solver
+PERF_TOL = 0.30        # caída de rendimiento tolerada frente a la baseline
+
+def bench_configs():
+    base = {"win_rate": 45, "rr": 2.0, "risk": 1.0, "withdrawal_target": 3.0, "comm": 7.0}
+    configs = {}
+    for size in ("5K", "10K", "100K"):
+        d = load_catalog()["The5ers"]["High Stakes (2 Step)"][size]
+        for steps, acc in (("2step", d), ("1step", dict(d, profit_p1=10.0, profit_p2=0.0))):
+            for label, tpd in (("low", 2), ("high", 15)):
+                configs[f"{size}-{steps}-{label}"] = (acc, dict(base, trades_day=tpd))
+    return configs
+
+def run_account_reference(account_data, strategy_params, n_sims, current_balance_real, seed):
+    # Bucle original camino a camino con random.*; produce los mismos contadores que el motor batch
+    random.seed(seed)
+    wr = strategy_params['win_rate']; rr = strategy_params['rr']
+    risk = strategy_params['risk']; w_target = strategy_params['withdrawal_target']
+    comm = strategy_params['comm']; trades_day = strategy_params['trades_day']
+    daily_dd = account_data.get('daily_dd', 100.0); size = account_data['size']
+    is_2step = account_data.get('profit_p2', 0) > 0
+    c = {"n_sims": n_sims, "pass_p1": 0, "pass_p2": 0, "pass_c1": 0, "pass_c2": 0, "pass_c3": 0,
+         "fail_reasons": {"Max Drawdown": 0, "Daily Drawdown": 0, "Timeout": 0, "Ya perdida (Real)": 0}}
+    trades = {k: [] for k in ("p1", "p2", "c1", "c2", "c3")}
+    phase = lambda start, target: simulate_phase(size, start, risk, wr, rr, target, account_data['total_dd'], daily_dd, comm, 5, 15, trades_day)
+    def fail(cause):
+        if cause in c['fail_reasons']: c['fail_reasons'][cause] += 1
+    for _ in range(n_sims):
+        ok, t, _, cause = phase(current_balance_real, account_data['profit_p1'])
+        if not ok: fail(cause); continue
+        c['pass_p1'] += 1; trades['p1'].append(t)
+        if is_2step:
+            ok, t, _, cause = phase(size, account_data['profit_p2'])
+            if not ok: fail(cause); continue
+            trades['p2'].append(t)
+        c['pass_p2'] += 1
+        ok, t, _, cause = phase(size, w_target)
+        if not ok: fail(cause); continue
+        c['pass_c1'] += 1; trades['c1'].append(t)
+        for k in ("c2", "c3"):
+            ok, t, _, _ = phase(size, w_target)
+            if not ok: break
+            c['pass_' + k] += 1; trades[k].append(t)
+    c['dist'] = {k: {"trades": hist_counts("trades", v)} for k, v in trades.items() if v}
+    return summarize_account(account_data, strategy_params, c)
+
+def outcome_rates(stats, n):
+    # Probabilidades por simulación (0-1): pases por etapa y causa de fallo
+    rates = {k: stats[k] / 100 for k in PROB_KEYS}
+    n_fail = stats['total_failures']
+    for k, v in stats['fail_stats'].items(): rates["fail:" + k] = v / 100 * n_fail / n if n_fail else 0.0
+    return rates
+
+def compare_rates(ref, n_ref, other, n_other, tol=0.0):
+    # z-test de dos proporciones (n_other=None -> motor exacto, solo varianza de la referencia)
+    checks = {}
+    for k, p_ref in ref.items():
+        p = other.get(k, 0.0)
+        pooled = (p_ref * n_ref + p * n_other) / (n_ref + n_other) if n_other else p_ref
+        var = pooled * (1 - pooled) * (1 / n_ref + (1 / n_other if n_other else 0))
+        se = math.sqrt(max(var, 1e-12))
+        diff = p - p_ref
+        checks[k] = {"ref": p_ref, "value": p, "z": diff / se, "ok": abs(diff) <= Z_CRIT * se + tol / 100}
+    return checks
+
+def measure_perf(account_data, params, n_perf):
+    start = account_data['size']
+    rng = np.random.default_rng(0)
+    t0 = time.perf_counter()
+    ok, trades, _, _ = simulate_phase_batch(n_perf, start, start, params['risk'], params['win_rate'], params['rr'], account_data['profit_p1'],
+                                            account_data['total_dd'], account_data['daily_dd'], params['comm'], 5, 15, params['trades_day'], rng)
+    dt_phase = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    run_account_simulation(account_data, params, n_perf, start, np.random.default_rng(1))
+    dt_acc = time.perf_counter() - t0
+    # Memoria en una corrida aparte: tracemalloc ralentiza mucho la medición de tiempo
+    tracemalloc.start()
+    run_account_simulation(account_data, params, n_perf, start, np.random.default_rng(1))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    sim_engine.solve_phase_markov.cache_clear()
+    t0 = time.perf_counter()
+    run_account_markov(account_data, params, start)
+    dt_markov = time.perf_counter() - t0
+    return {"trades_per_s": float(trades.sum()) / dt_phase, "sims_per_s": n_perf / dt_acc,
+            "peak_mem_mb": peak / 1e6, "markov_ms": dt_markov * 1000}
+
+def run_bench(n_ref, n_eng, n_perf, only=None):
+    results = {}
+    for name, (acc, params) in bench_configs().items():
+        if only and only not in name: continue
+        start = acc['size']
+        t0 = time.perf_counter()
+        ref = run_account_reference(acc, params, n_ref, start, seed=12345)
+        ref_sims_s = n_ref / (time.perf_counter() - t0)
+        batch = run_account_simulation(acc, params, n_eng, start, np.random.default_rng(12345))
+        markov = run_account_markov(acc, params, start)
+        ref_rates = outcome_rates(ref, n_ref)
+        perf = measure_perf(acc, params, n_perf)
+        perf["reference_sims_per_s"] = ref_sims_s
+        results[name] = {
+            "reference": {k: ref[k] for k in PROB_KEYS},
+            "batch": {k: batch[k] for k in PROB_KEYS},
+            "markov": {k: markov[k] for k in PROB_KEYS},
+            "checks": {"batch": compare_rates(ref_rates, n_ref, outcome_rates(batch, n_eng), n_eng),
+                       "markov": compare_rates(ref_rates, n_ref, outcome_rates(markov, 1), None, tol=MARKOV_TOL)},
+            "perf": perf, "n": {"reference": n_ref, "batch": n_eng, "perf": n_perf}
+        }
+    return results
+
+def compare_baseline(results, baseline):
+    notes = []
+    version = baseline.get("engine_version")
+    if version != sim_engine.SIM_ENGINE_VERSION:
+        notes.append(f"AVISO: baseline del motor v{version}, motor actual v{sim_engine.SIM_ENGINE_VERSION}; regenerar con --update")
+    for name, r in results.items():
+        b = baseline.get("configs", {}).get(name)
+        if not b: continue
+        # El rendimiento solo es comparable con el mismo tamaño de lote
+        for k, v in (r["perf"].items() if b["n"].get("perf") == r["n"]["perf"] else ()):
+            bv = b["perf"].get(k)
+            if not bv: continue
+            worse = v > bv * (1 + PERF_TOL) if k in ("peak_mem_mb", "markov_ms") else v < bv * (1 - PERF_TOL)
+            if worse: notes.append(f"{name}: {k} {v:,.1f} vs baseline {bv:,.1f}")
+        # Deriva estadística del motor batch frente a la baseline registrada
+        drift = compare_rates({k: v / 100 for k, v in b["batch"].items()}, b["n"]["batch"], {k: v / 100 for k, v in r["batch"].items()}, r["n"]["batch"])
+        notes += [f"{name}: {k} {c['value']*100:.2f}% vs baseline {c['ref']*100:.2f}% (z={c['z']:+.1f})" for k, c in drift.items() if not c["ok"]]
+    return notes
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark y regresión estadística del motor")
+    ap.add_argument("--quick", action="store_true", help="Menos simulaciones (checks más laxos)")
+    ap.add_argument("--only", help="Filtra configuraciones por subcadena, p.ej. 100K-2step")
+    ap.add_argument("--update", action="store_true", help=f"Reescribe {BASELINE_PATH}")
+    ap.add_argument("--baseline", default=BASELINE_PATH)
+    ap.add_argument("-o", "--output", help="JSON con los resultados completos")
+    args = ap.parse_args(argv)
+
+    n_ref, n_eng, n_perf = (500, 2000, 2000) if args.quick else (3000, 10000, 5000)
+    results = run_bench(n_ref, n_eng, n_perf, args.only)
+
+    failed = []
+    print(f"{'config':<20}{'trades/s':>12}{'sims/s':>10}{'ref sims/s':>11}{'mem MB':>8}{'markov ms':>10}  c1 ref/batch/markov")
+    for name, r in results.items():
+        p = r["perf"]
+        print(f"{name:<20}{p['trades_per_s']:>12,.0f}{p['sims_per_s']:>10,.0f}{p['reference_sims_per_s']:>11,.0f}{p['peak_mem_mb']:>8.1f}{p['markov_ms']:>10.1f}"
+              f"  {r['reference']['prob_c1']:.1f}/{r['batch']['prob_c1']:.1f}/{r['markov']['prob_c1']:.1f}")
+        for engine, checks in r["checks"].items():
+            failed += [f"{name} [{engine}] {k}: {c['value']*100:.2f}% vs ref {c['ref']*100:.2f}% (z={c['z']:+.1f})" for k, c in checks.items() if not c["ok"]]
+
+    if failed:
+        print("\nFALLOS ESTADÍSTICOS:"); [print("  " + f) for f in failed]
+    try:
+        with open(args.baseline, encoding="utf-8") as f: baseline = json.load(f)
+    except FileNotFoundError: baseline = None
+    if baseline and not args.update:
+        notes = compare_baseline(results, baseline)
+        print("\nFrente a la baseline: " + ("sin regresiones" if not notes else ""))
+        for n in notes: print("  " + n)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.update:
+        keep = {name: {k: r[k] for k in ("reference", "batch", "markov", "perf", "n")} for name, r in results.items()}
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"engine_version": sim_engine.SIM_ENGINE_VERSION, "created": time.strftime("%Y-%m-%d"), "configs": keep}, f, indent=2)
+        print(f"\nBaseline escrita en {args.baseline}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
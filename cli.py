@@ -0,0 +1,103 @@
+# CLI de proyecciones por lotes, sin Streamlit ni BD.
+#
+#   python cli.py portfolio.json -o resultados.json --csv resultados.csv --sims 5000 --seed 42
+#
+# portfolio.json tiene la misma forma que devuelve load_portfolio_db (lista de cuentas)
+# o un objeto {usuario: lista de cuentas} para procesar varios usuarios de una vez.
+import argparse
+import csv
+import json
+import sys
+import time
+
+import numpy as np
+
+from journal import account_balance
+from sim_engine import HORIZON_PAYOUTS, EmpiricalPnL, empirical_params, parametric_params, markov_supported, run_portfolio_simulation, run_account_markov, run_portfolio_horizon, simulate_purchases
+
+CSV_FIELDS = ["user", "name", "start_bal", "prob_p1", "prob_p2", "prob_c1", "prob_c2", "prob_c3",
+              "avg_pay1", "avg_pay2", "avg_pay3", "time_p1", "time_p2", "time_c1", "time_c2", "time_c3",
+              "inventory", "investment", "net_profit"]
+
+def load_portfolios(path):
+    with open(path, encoding="utf-8") as f: data = json.load(f)
+    if isinstance(data, list): return {"": data}
+    return data
+
+def start_balance(item, mode):
+    if mode == "real": return account_balance(item)
+    return item['data']['size']
+
+def job_params(item, pnl):
+    # pnl: "param" (WR/RR) o bootstrap del diario del JSON ("trade" / "day")
+    journal = item.get('journal', [])
+    if pnl == "param" or not journal: return item['params']
+    emp = EmpiricalPnL([t['net'] for t in journal], [str(t.get('date', ''))[:10] for t in journal])
+    return empirical_params(item['params'], emp, by_day=pnl == "day")
+
+def run_batch(portfolios, n_sims, seed=None, n_workers=1, mode="teorico", engine="montecarlo", pnl="param", concurrent=0, horizon=0, payouts=HORIZON_PAYOUTS):
+    rows = []
+    jobs = []
+    for user, portfolio in portfolios.items():
+        for item in portfolio:
+            bal = start_balance(item, mode)
+            rows.append({"user": user, "name": item['full_name'], "start_bal": bal})
+            jobs.append((item['data'], job_params(item, pnl), bal))
+    if engine == "markov":
+        # Bootstrap y reglas dependientes del camino no tienen solver exacto: esas cuentas van por Montecarlo
+        mc = [j for j, (acc, params, _) in enumerate(jobs) if not markov_supported(acc, params)]
+        mc_stats = dict(zip(mc, run_portfolio_simulation([jobs[j] for j in mc], n_sims, seed=seed, n_workers=n_workers))) if mc else {}
+        stats = [mc_stats[j] if j in mc_stats else run_account_markov(acc, params, bal) for j, (acc, params, bal) in enumerate(jobs)]
+    else: stats = run_portfolio_simulation(jobs, n_sims, seed=seed, n_workers=n_workers)
+    for row, s in zip(rows, stats): row['stats'] = s
+    if concurrent:
+        # Compra secuencial sobre el resultado de cada cuenta (concurrent cuentas a la vez)
+        rng = np.random.default_rng(seed)
+        for row, (acc, params, _) in zip(rows, jobs): row['purchase'] = simulate_purchases(acc, params, row['stats'], n_sims, concurrent, rng)
+    if horizon:
+        # Curvas mensuales de caja por cuenta, simulando cada portafolio de usuario en calendario (modelo WR/RR)
+        first = 0
+        for user, portfolio in portfolios.items():
+            port_jobs = [(acc, parametric_params(params), bal) for acc, params, bal in jobs[first:first + len(portfolio)]]
+            if port_jobs:
+                h = run_portfolio_horizon(port_jobs, n_sims, horizon, payouts, seed=seed, n_workers=n_workers)
+                for row, curves in zip(rows[first:first + len(portfolio)], h['accounts']): row['horizon'] = dict(curves, months=h['months'])
+            first += len(portfolio)
+    return rows
+
+def write_csv(path, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        w.writeheader()
+        for r in rows:
+            w.writerow({k: r[k] if k in r else r['stats'][k] for k in CSV_FIELDS})
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Proyecciones Prop Firm por lotes")
+    ap.add_argument("portfolio", help="JSON de portafolio (lista) o {usuario: portafolio}")
+    ap.add_argument("-o", "--output", help="JSON de salida (por defecto stdout)")
+    ap.add_argument("--csv", help="CSV de salida con una fila por cuenta")
+    ap.add_argument("--sims", type=int, default=1000)
+    ap.add_argument("--seed", type=int, default=None)
+    ap.add_argument("--workers", type=int, default=1, help="Procesos (0 = todos los núcleos)")
+    ap.add_argument("--mode", choices=["teorico", "real"], default="teorico", help="real = partir del balance del diario")
+    ap.add_argument("--engine", choices=["montecarlo", "markov"], default="montecarlo")
+    ap.add_argument("--concurrent", type=int, default=0, help="Compra secuencial con N cuentas a la vez (0 = no)")
+    ap.add_argument("--horizon", type=int, default=0, help="Curvas de caja mensuales en calendario a N meses (0 = no)")
+    ap.add_argument("--payouts", type=int, default=HORIZON_PAYOUTS, help="Retiros máximos por cuenta en el horizonte")
+    ap.add_argument("--pnl", choices=["param", "trade", "day"], default="param", help="trade/day = bootstrap del P&L del diario (con markov esas cuentas van por montecarlo)")
+    args = ap.parse_args(argv)
+
+    t0 = time.perf_counter()
+    rows = run_batch(load_portfolios(args.portfolio), args.sims, seed=args.seed,
+                     n_workers=args.workers or None, mode=args.mode, engine=args.engine, pnl=args.pnl, concurrent=args.concurrent,
+                     horizon=args.horizon, payouts=args.payouts)
+    out = json.dumps(rows, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: f.write(out)
+    else: sys.stdout.write(out + "\n")
+    if args.csv: write_csv(args.csv, rows)
+    print(f"{len(rows)} cuentas en {time.perf_counter() - t0:.2f}s", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
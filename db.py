@@ -0,0 +1,267 @@
+# Capa de base de datos (sin UI): esquema, engine, caché de lecturas, autoguardado en segundo plano,
+# portafolios por cuenta, diario, caché de simulaciones y usuarios. Cada función recibe el engine
+# (y la caché de lecturas si invalida); la app los crea una vez por proceso.
+import os
+import time
+import json
+import atexit
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, text, bindparam
+from journal import JOURNAL_TAIL, journal_count, account_balance
+
+logger = logging.getLogger("propfirm")
+
+DB_POOL = {"pool_size": int(os.getenv("DB_POOL_SIZE", 5)), "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 5)),
+           "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)), "pool_timeout": 10}
+AUTOSAVE_DELAY = float(os.getenv("AUTOSAVE_DELAY", 2.0))  # s sin cambios antes de escribir
+AUTOSAVE_MAX_DELAY = 10.0  # s como máximo que espera un cambio aunque sigan llegando otros
+READ_CACHE_TTL = 30.0      # s de vida de las lecturas de login / restaurar
+SIM_CACHE_DB_DAYS = float(os.getenv("SIM_CACHE_DB_DAYS", 30))        # antigüedad máxima de un resultado en BD
+SIM_CACHE_DB_ROWS = int(os.getenv("SIM_CACHE_DB_ROWS", 5000))         # filas máximas de sim_cache (las más nuevas)
+
+def init_db(engine):
+    if engine:
+        with engine.connect() as conn:
+            conn.execute(text("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT, auth_type TEXT DEFAULT 'manual');"))
+            conn.execute(text("CREATE TABLE IF NOT EXISTS user_portfolios (username TEXT PRIMARY KEY, portfolio_json TEXT);"))
+            conn.execute(text("CREATE TABLE IF NOT EXISTS sim_cache (cache_key TEXT PRIMARY KEY, result_json TEXT, created_at TEXT);"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS sim_cache_created ON sim_cache (created_at)"))
+            conn.execute(text("CREATE TABLE IF NOT EXISTS portfolio_accounts (username TEXT NOT NULL, account_id BIGINT NOT NULL, position INTEGER, full_name TEXT, data_json TEXT, params_json TEXT, balance DOUBLE PRECISION, journal_count INTEGER DEFAULT 0, PRIMARY KEY (username, account_id));"))
+            conn.execute(text("CREATE TABLE IF NOT EXISTS journal_trades (username TEXT NOT NULL, account_id BIGINT NOT NULL, seq INTEGER NOT NULL, trade_date TEXT, gross DOUBLE PRECISION, comm DOUBLE PRECISION, swap DOUBLE PRECISION, net DOUBLE PRECISION, ext_id TEXT, PRIMARY KEY (username, account_id, seq));"))
+            conn.commit()
+        # BD creadas antes de la importación masiva: añadir ext_id (falla si ya existe)
+        try:
+            with engine.begin() as conn: conn.execute(text("ALTER TABLE journal_trades ADD COLUMN ext_id TEXT"))
+        except: pass
+        with engine.begin() as conn:
+            conn.execute(text("CREATE INDEX IF NOT EXISTS journal_trades_ext ON journal_trades (username, account_id, ext_id)"))
+
+def make_engine(url):
+    # pool_pre_ping descarta conexiones caídas (p.ej. Postgres gestionado que corta las inactivas)
+    if url.startswith("postgres://"): url = url.replace("postgres://", "postgresql://", 1)
+    opts = {"pool_pre_ping": True}
+    if not url.startswith("sqlite"): opts.update(DB_POOL)
+    eng = create_engine(url, **opts)
+    init_db(eng)
+    return eng
+
+class ReadCache:
+    # Lecturas de vida corta (login / restaurar) compartidas entre sesiones; cada escritura de un
+    # usuario invalida sus entradas. Claves: (tipo, usuario).
+    def __init__(self, ttl):
+        self.ttl = ttl; self.data = {}; self.lock = threading.Lock()
+
+    def get(self, key, load):
+        now = time.monotonic()
+        with self.lock: hit = self.data.get(key)
+        if hit and hit[0] > now: return hit[1]
+        value = load()
+        if value is not None:
+            with self.lock: self.data[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self, username):
+        with self.lock:
+            for k in [k for k in self.data if k[1] == username]: del self.data[k]
+
+class WriteBehind:
+    # Autoguardado en segundo plano: guarda la última instantánea de cada usuario y la escribe en un
+    # hilo propio cuando lleva `delay` s sin cambios (o `max_delay` desde el primero). Muchas ediciones
+    # seguidas acaban en una sola transacción. write_lock serializa con los guardados síncronos.
+    def __init__(self, write, delay, max_delay):
+        self.write = write; self.delay = delay; self.max_delay = max_delay
+        self.pending = {}  # usuario -> (instantánea, primer cambio, último cambio)
+        self.status = {}   # usuario -> (hora de la última escritura, ok)
+        self.cond = threading.Condition(); self.write_lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True, name="autosave").start()
+        atexit.register(self.flush)
+
+    def submit(self, username, snapshot):
+        now = time.monotonic()
+        with self.cond:
+            first = self.pending[username][1] if username in self.pending else now
+            self.pending[username] = (snapshot, first, now)
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    due = [u for u, (_, first, last) in self.pending.items() if now - last >= self.delay or now - first >= self.max_delay]
+                    if due: break
+                    wait = [min(last + self.delay, first + self.max_delay) - now for _, first, last in self.pending.values()]
+                    self.cond.wait(min(wait) if wait else None)
+                batch = [(u, self.pending.pop(u)[0]) for u in due]
+            self._write(batch)
+
+    def _write(self, batch):
+        ok = True
+        with self.write_lock:
+            for username, snapshot in batch:
+                done = self.write(username, snapshot)
+                self.status[username] = (datetime.now().strftime("%H:%M:%S"), done)
+                ok = ok and done
+        return ok
+
+    def flush(self, username=None):
+        # Escribe ya (síncrono) lo pendiente: antes de restaurar o al cerrar el proceso
+        with self.cond: batch = [(u, self.pending.pop(u)[0]) for u in list(self.pending) if username is None or u == username]
+        return self._write(batch)
+
+    def write_now(self, username, snapshot):
+        # Guardado explícito: reemplaza lo pendiente del usuario
+        with self.cond: self.pending.pop(username, None)
+        return self._write([(username, snapshot)])
+
+# --- PORTAFOLIOS Y DIARIO ---
+def write_portfolio(engine, read_cache, username, portfolio_data):
+    # Config con upsert por cuenta; el diario solo inserta los trades que aún no están en BD.
+    # También corre en el hilo de autoguardado.
+    if not engine: return False
+    t0 = time.perf_counter()
+    read_cache.invalidate(username)
+    try:
+        with engine.begin() as conn:
+            # Migración del formato antiguo: tras la primera escritura portfolio_accounts es la única fuente
+            # (si no, un portafolio vaciado volvería a cargar el blob antiguo)
+            conn.execute(text("DELETE FROM user_portfolios WHERE username = :u"), {"u": username})
+            stored = dict(conn.execute(text("SELECT account_id, journal_count FROM portfolio_accounts WHERE username = :u"), {"u": username}).fetchall())
+            ids = [int(item['id']) for item in portfolio_data]
+            for pos, item in enumerate(portfolio_data):
+                acc_id = int(item['id'])
+                base = item.get('journal_base', 0)
+                new_trades = item.get('journal', [])[max(stored.get(acc_id, 0) - base, 0):]
+                first_seq = base + len(item.get('journal', [])) - len(new_trades)
+                if new_trades:
+                    conn.execute(text("INSERT INTO journal_trades (username, account_id, seq, trade_date, gross, comm, swap, net) VALUES (:u, :a, :s, :d, :g, :c, :w, :n)"),
+                                 [{"u": username, "a": acc_id, "s": first_seq + i, "d": str(t.get('date', '')), "g": t.get('gross', 0.0), "c": t.get('comm', 0.0), "w": t.get('swap', 0.0), "n": t['net']} for i, t in enumerate(new_trades)])
+                conn.execute(text("""INSERT INTO portfolio_accounts (username, account_id, position, full_name, data_json, params_json, balance, journal_count)
+                                     VALUES (:u, :a, :p, :f, :d, :pr, :b, :jc)
+                                     ON CONFLICT (username, account_id) DO UPDATE SET position = excluded.position, full_name = excluded.full_name, data_json = excluded.data_json,
+                                     params_json = excluded.params_json, balance = excluded.balance, journal_count = excluded.journal_count"""),
+                             {"u": username, "a": acc_id, "p": pos, "f": item['full_name'], "d": json.dumps(item['data']), "pr": json.dumps(item['params']),
+                              "b": account_balance(item), "jc": journal_count(item)})
+            # Cuentas eliminadas del portafolio
+            removed = [a for a in stored if a not in ids]
+            if removed:
+                for table in ("journal_trades", "portfolio_accounts"):
+                    conn.execute(text(f"DELETE FROM {table} WHERE username = :u AND account_id IN :ids").bindparams(bindparam("ids", expanding=True)), {"u": username, "ids": removed})
+        ok = True
+    except Exception as e:
+        logger.warning(json.dumps({"event": "save_error", "user": username, "error": str(e)}))
+        ok = False
+    read_cache.invalidate(username)
+    logger.info(json.dumps({"event": "portfolio_write", "user": username, "accounts": len(portfolio_data), "ok": ok, "ms": round((time.perf_counter() - t0) * 1000, 2)}))
+    return ok
+
+def fetch_portfolio(engine, username):
+    # Carga config + balance acumulado y solo la cola reciente de cada diario (None si falla la BD)
+    try:
+        with engine.connect() as conn:
+            rows = conn.execute(text("SELECT account_id, full_name, data_json, params_json, balance, journal_count FROM portfolio_accounts WHERE username = :u ORDER BY position"), {"u": username}).fetchall()
+            if not rows:
+                # Formato antiguo: portafolio completo en un blob JSON (se migra al guardar)
+                res = conn.execute(text("SELECT portfolio_json FROM user_portfolios WHERE username = :u"), {"u": username}).fetchone()
+                if res: return json.loads(res[0])
+                return []
+            portfolio = []
+            for acc_id, full_name, data_json, params_json, balance, count in rows:
+                item = {"id": acc_id, "full_name": full_name, "data": json.loads(data_json), "params": json.loads(params_json)}
+                load_journal_tail(conn, username, item, balance, count)
+                portfolio.append(item)
+            return portfolio
+    except: return None
+
+def load_journal_tail(conn, username, item, balance, count):
+    base = max(count - JOURNAL_TAIL, 0)
+    tail = conn.execute(text("SELECT trade_date, gross, comm, swap, net FROM journal_trades WHERE username = :u AND account_id = :a AND seq >= :s ORDER BY seq"),
+                        {"u": username, "a": int(item['id']), "s": base}).fetchall()
+    item['journal'] = [{"date": d, "gross": g, "comm": c, "swap": w, "net": n} for d, g, c, w, n in tail]
+    item['journal_base'] = base; item['balance'] = balance
+
+def import_journal_db(engine, read_cache, username, item, chunks, on_progress=None):
+    # Importación masiva directa a journal_trades: un lote = una transacción con executemany.
+    # Dedup por ext_id (ticket del bróker o fecha|bruto) contra lo ya importado y dentro del archivo.
+    # La cuenta debe estar guardada antes (write_portfolio) para partir de su balance/contador.
+    acc_id = int(item['id']); key = {"u": username, "a": acc_id}
+    with engine.connect() as conn:
+        seen = {r[0] for r in conn.execute(text("SELECT ext_id FROM journal_trades WHERE username = :u AND account_id = :a AND ext_id IS NOT NULL"), key)}
+        balance, count = conn.execute(text("SELECT balance, journal_count FROM portfolio_accounts WHERE username = :u AND account_id = :a"), key).fetchone()
+    imported = dups = skipped = 0
+    for df in chunks:
+        skipped += df.attrs.get("skipped", 0)
+        fresh = df.drop_duplicates("ext_id")
+        fresh = fresh[~fresh["ext_id"].isin(seen)]
+        dups += len(df) - len(fresh)
+        if not fresh.empty:
+            seen.update(fresh["ext_id"])
+            rows = [{"u": username, "a": acc_id, "s": count + i, "d": d, "g": g, "c": c, "w": w, "n": n, "e": e}
+                    for i, (d, g, c, w, n, e) in enumerate(zip(fresh["date"], fresh["gross"].tolist(), fresh["comm"].tolist(), fresh["swap"].tolist(), fresh["net"].tolist(), fresh["ext_id"]))]
+            chunk_net = float(fresh["net"].sum())
+            with engine.begin() as conn:
+                conn.execute(text("INSERT INTO journal_trades (username, account_id, seq, trade_date, gross, comm, swap, net, ext_id) VALUES (:u, :a, :s, :d, :g, :c, :w, :n, :e)"), rows)
+                conn.execute(text("UPDATE portfolio_accounts SET balance = :b, journal_count = :jc WHERE username = :u AND account_id = :a"),
+                             dict(key, b=balance + chunk_net, jc=count + len(rows)))
+            balance += chunk_net; count += len(rows); imported += len(rows)
+        if on_progress: on_progress(imported, dups)
+    with engine.connect() as conn: load_journal_tail(conn, username, item, balance, count)
+    read_cache.invalidate(username)
+    return imported, dups, skipped
+
+def load_journal_net(engine, username, account_id, upto):
+    # Fecha (día) y neto de los trades persistidos con seq < upto, para el bootstrap
+    if not engine: return [], []
+    try:
+        with engine.connect() as conn:
+            rows = conn.execute(text("SELECT trade_date, net FROM journal_trades WHERE username = :u AND account_id = :a AND seq < :s ORDER BY seq"),
+                                {"u": username, "a": account_id, "s": upto}).fetchall()
+        return [str(d or "")[:10] for d, _ in rows], [n for _, n in rows]
+    except: return [], []
+
+# --- CACHÉ DE SIMULACIONES ---
+def sim_cache_cutoff():
+    return (datetime.now() - timedelta(days=SIM_CACHE_DB_DAYS)).isoformat()
+
+def load_sim_cache(engine, key):
+    if not engine: return None
+    try:
+        with engine.connect() as conn:
+            res = conn.execute(text("SELECT result_json FROM sim_cache WHERE cache_key = :k AND created_at >= :c"), {"k": key, "c": sim_cache_cutoff()}).fetchone()
+            if res: return json.loads(res[0])
+            return None
+    except: return None
+
+def save_sim_cache(engine, key, result):
+    if not engine: return False
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("INSERT INTO sim_cache (cache_key, result_json, created_at) VALUES (:k, :d, :t) ON CONFLICT (cache_key) DO UPDATE SET result_json = excluded.result_json, created_at = excluded.created_at"),
+                         {"k": key, "d": json.dumps(result), "t": datetime.now().isoformat()})
+            # Poda: caducados y todo lo que pase de SIM_CACHE_DB_ROWS filas (se quedan las más nuevas)
+            conn.execute(text("DELETE FROM sim_cache WHERE created_at < :c"), {"c": sim_cache_cutoff()})
+            conn.execute(text("DELETE FROM sim_cache WHERE created_at < (SELECT created_at FROM sim_cache ORDER BY created_at DESC LIMIT 1 OFFSET :n)"), {"n": SIM_CACHE_DB_ROWS - 1})
+            conn.commit()
+        return True
+    except: return False
+
+# --- USUARIOS ---
+def register_user(engine, read_cache, u, p):
+    if not engine: return "Error BD Local"
+    try:
+        with engine.connect() as conn:
+            if conn.execute(text("SELECT username FROM users WHERE username = :u"), {"u": u}).fetchone(): return "Usuario existe"
+            conn.execute(text("INSERT INTO users (username, password) VALUES (:u, :p)"), {"u": u, "p": p})
+            conn.commit()
+            read_cache.invalidate(u)
+            return "OK"
+    except Exception as e: return str(e)
+
+def fetch_password(engine, u):
+    try:
+        with engine.connect() as conn:
+            res = conn.execute(text("SELECT password FROM users WHERE username = :u"), {"u": u}).fetchone()
+            return res[0] if res else None
+    except: return None
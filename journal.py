@@ -0,0 +1,188 @@
+# Modelo del diario de operaciones (sin UI ni BD).
+#
+# item['journal'] guarda solo la cola reciente en memoria; item['journal_base'] es el nº de
+# trades persistidos anteriores a esa cola e item['balance'] el balance acumulado de la cuenta,
+# así el balance actual se lee en O(1) aunque el historial tenga miles de trades.
+
+import codecs
+import csv
+import io
+import re
+from html.parser import HTMLParser
+
+JOURNAL_TAIL = 200  # trades recientes que se cargan en memoria al hacer login
+
+def journal_count(item):
+    return item.get('journal_base', 0) + len(item.get('journal', []))
+
+def account_balance(item):
+    if 'balance' not in item:
+        # Cuentas antiguas (blob JSON completo): se calcula una vez y queda guardado
+        item['balance'] = item['data']['size'] + sum(t['net'] for t in item.get('journal', []))
+    return item['balance']
+
+def append_journal_trade(item, trade):
+    account_balance(item)
+    item.setdefault('journal', []).append(trade)
+    item['balance'] += trade['net']
+
+# --- IMPORTACIÓN MASIVA (CSV / estados MT4-MT5) ---
+# Cada lote sale normalizado a: ext_id, date, gross, comm, swap, net (net = gross - comm - swap).
+# Comisión y swap se leen con el signo del bróker (negativo = coste) y se guardan como coste.
+IMPORT_CHUNK = 5000
+_ID_COLS = ("ticket", "position", "deal", "order", "trade id", "trade_id", "id")
+_TIME_COLS = ("close time", "close_time", "closetime", "close date", "time", "date", "fecha")
+_PROFIT_COLS = ("profit", "gross", "p/l", "pnl", "bruto")
+_COMM_COLS = ("commission", "comm", "comisión", "comision")
+_SWAP_COLS = ("swap",)
+_TYPE_COLS = ("type", "tipo")
+
+def _detect_encoding(head):
+    if head.startswith(codecs.BOM_UTF16_LE) or head.startswith(codecs.BOM_UTF16_BE): return "utf-16"
+    if head.startswith(codecs.BOM_UTF8): return "utf-8-sig"
+    return "utf-8"
+
+def _base_name(col):
+    return re.sub(r"\.\d+$", "", str(col)).strip().lower()
+
+def _pick(columns, names, last=False):
+    # Primera columna cuyo nombre coincide (por orden de preferencia); last=True toma la última
+    # ocurrencia, p.ej. el segundo "Time" (cierre) de los informes MT5
+    for name in names:
+        hits = [c for c in columns if _base_name(c) == name]
+        if hits: return hits[-1] if last else hits[0]
+    return None
+
+def _pandas():
+    import pandas as pd  # import perezoso: la CLI no paga pandas si no importa diarios
+    return pd
+
+def _to_number(s, decimal="."):
+    # Acepta 1234.5, 1,234.50, 1.234,50 y 12,50: si aparecen los dos signos el último es el decimal; con
+    # uno solo, decimal (el del archivo) resuelve lo ambiguo ("1,234" son miles salvo en archivos con coma decimal)
+    t = s.astype(str).str.replace("[\\s\u00a0]", "", regex=True)
+    has_c = t.str.contains(",", regex=False); has_d = t.str.contains(".", regex=False)
+    comma_last = t.str.rfind(",") > t.str.rfind(".")
+    comma_dec = (has_c & has_d & comma_last) | (has_c & ~has_d & ((decimal == ",") | ~t.str.fullmatch(r"[-+]?\d{1,3}(,\d{3})+")))
+    dot_thousands = ~has_c & has_d & (decimal == ",") & t.str.fullmatch(r"[-+]?\d{1,3}(\.\d{3})+")
+    t = t.where(~(comma_dec | dot_thousands), t.str.replace(".", "", regex=False))
+    t = t.where(~comma_dec, t.str.replace(",", ".", regex=False)).str.replace(",", "", regex=False)
+    return _pandas().to_numeric(t, errors="coerce").astype(float)
+
+def normalize_trades(df, decimal="."):
+    # out.attrs["skipped"]: operaciones descartadas porque su beneficio no es un número
+    pd = _pandas()
+    cols = list(df.columns)
+    profit_col = _pick(cols, _PROFIT_COLS)
+    if profit_col is None: raise ValueError(f"No se encontró columna de beneficio en: {cols}")
+    type_col = _pick(cols, _TYPE_COLS)
+    if type_col is not None:
+        kind = df[type_col].astype(str).str.strip().str.lower()
+        df = df[kind.str.startswith("buy") | kind.str.startswith("sell")]
+    gross = _to_number(df[profit_col], decimal)
+    comm_col = _pick(cols, _COMM_COLS); swap_col = _pick(cols, _SWAP_COLS)
+    comm = _to_number(df[comm_col], decimal).fillna(0.0).abs() if comm_col else pd.Series(0.0, index=df.index)
+    swap = 0.0 - _to_number(df[swap_col], decimal).fillna(0.0) if swap_col else pd.Series(0.0, index=df.index)
+    time_col = _pick(cols, _TIME_COLS, last=True)
+    raw_date = df[time_col].astype(str).str.strip() if time_col else pd.Series("", index=df.index)
+    parsed = pd.to_datetime(raw_date.str.replace(".", "-", n=2, regex=False), errors="coerce", format="mixed")
+    date = parsed.dt.strftime("%Y-%m-%d %H:%M:%S").where(parsed.notna(), raw_date)
+    id_col = _pick(cols, _ID_COLS)
+    if id_col is not None: ext_id = "id:" + df[id_col].astype(str).str.strip()
+    else: ext_id = "t:" + date + "|" + gross.round(2).astype(str)
+    out = pd.DataFrame({"ext_id": ext_id, "date": date, "gross": gross, "comm": comm, "swap": swap})
+    skipped = int(out["gross"].isna().sum())
+    out = out[out["gross"].notna()]
+    out["net"] = out["gross"] - out["comm"] - out["swap"]
+    out.attrs["skipped"] = skipped
+    return out
+
+class _StatementParser(HTMLParser):
+    # Parser incremental de tablas HTML: acumula filas (índice de tabla, celdas) según llegan
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = []; self.table_idx = -1
+        self._row = None; self._cell = None; self._span = 1
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "table": self.table_idx += 1
+        elif tag == "tr":
+            self._flush_row(); self._row = []
+        elif tag in ("td", "th") and self._row is not None:
+            self._flush_cell(); self._cell = []
+            try: self._span = max(int(dict(attrs).get("colspan") or 1), 1)
+            except ValueError: self._span = 1
+
+    def handle_data(self, data):
+        if self._cell is not None: self._cell.append(data)
+
+    def handle_endtag(self, tag):
+        if tag in ("td", "th"): self._flush_cell()
+        elif tag in ("tr", "table"): self._flush_row()
+
+    def _flush_cell(self):
+        if self._cell is not None and self._row is not None:
+            self._row.append("".join(self._cell).strip())
+            self._row.extend([""] * (self._span - 1))
+        self._cell = None
+
+    def _flush_row(self):
+        self._flush_cell()
+        if self._row is not None: self.rows.append((self.table_idx, self._row))
+        self._row = None
+
+def _is_header(cells):
+    names = {c.strip().lower() for c in cells}
+    return bool(names & set(_PROFIT_COLS)) and bool(names & set(_ID_COLS + _TIME_COLS))
+
+def _dedupe_names(cells):
+    seen = {}; out = []
+    for c in cells:
+        n = seen.get(c, 0); seen[c] = n + 1
+        out.append(c if n == 0 else f"{c}.{n}")
+    return out
+
+def _iter_html_frames(fileobj, encoding, chunksize):
+    # Solo la primera tabla de operaciones cerradas (MT4 "Closed Transactions", MT5 "Positions")
+    pd = _pandas()
+    parser = _StatementParser(); decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    header = None; buf = []; n_rows = 0; finished = False
+    while not finished:
+        block = fileobj.read(1 << 16)
+        parser.feed(decoder.decode(block, final=not block))
+        if not block: parser.close()
+        for _, cells in parser.rows:
+            if finished: break
+            if header is None:
+                if _is_header(cells): header = _dedupe_names(cells)
+            elif len(cells) == len(header) and sum(1 for c in cells if c) > 1:
+                buf.append(cells); n_rows += 1
+            elif sum(1 for c in cells if c) <= 1 and n_rows:
+                finished = True  # fila de título: empieza otra sección del informe
+            if len(buf) >= chunksize:
+                yield pd.DataFrame(buf, columns=header); buf = []
+        parser.rows.clear()
+        if not block: break
+    if header is None: raise ValueError("No se encontró la tabla de operaciones en el informe HTML.")
+    if buf: yield pd.DataFrame(buf, columns=header)
+
+def iter_import_chunks(fileobj, chunksize=IMPORT_CHUNK):
+    # fileobj binario (archivo abierto o UploadedFile de Streamlit); rinde lotes normalizados
+    pd = _pandas()
+    head = fileobj.read(4096); fileobj.seek(0)
+    encoding = _detect_encoding(head)
+    sample = head.decode(encoding, errors="ignore"); text_stream = None; decimal = "."
+    if re.search(r"<\s*(html|table)", sample, re.IGNORECASE):
+        frames = _iter_html_frames(fileobj, encoding, chunksize)
+    else:
+        try: sep = csv.Sniffer().sniff(sample.splitlines()[0] if sample else ",", delimiters=",;\t|").delimiter
+        except csv.Error: sep = ","
+        if sep == ";": decimal = ","  # exportaciones con configuración regional europea
+        text_stream = io.TextIOWrapper(fileobj, encoding=encoding, errors="replace", newline="")
+        frames = pd.read_csv(text_stream, sep=sep, chunksize=chunksize, dtype=str, skipinitialspace=True)
+    try:
+        for df in frames:
+            df.columns = [str(c).strip() for c in df.columns]
+            yield normalize_trades(df, decimal)
+    finally:
+        if text_stream is not None: text_stream.detach()  # no cerrar el archivo del llamador
@@ -0,0 +1,1375 @@
+# Motor de simulación sin UI ni BD: se puede importar desde la app, la CLI o scripts.
+import random
+import numpy as np
+import os
+import sys
+import time
+import types
+import contextlib
+import math
+import json
+import functools
+import hashlib
+import threading
+import multiprocessing
+import collections
+from collections import OrderedDict
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+# --- DATOS ---
+# Catálogo de firmas: un JSON por firma en CATALOG_DIR con la forma
+#   {"firm": nombre, "programs": {programa: {"rules": {...}, "sizes": {tamaño: {...}}}}}
+# Las "rules" del programa valen para todos sus tamaños y cada tamaño puede sobrescribirlas.
+# Se lee la primera vez que se pide y queda en caché para todo el proceso.
+CATALOG_DIR = os.getenv("PROPFIRM_CATALOG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog"))
+ACCOUNT_FIELDS = ("cost", "size", "total_dd", "profit_p1")  # obligatorios; daily_dd, profit_p2 y p1_bonus son opcionales
+MAX_TRADES = 1500  # tope de trades por fase (después cuenta como Timeout)
+
+# Reglas opcionales por cuenta (ausentes = comportamiento clásico de The5ers):
+#   dd_type        "static" (límite fijo desde el balance inicial) o "trailing" (sigue al máximo de equity)
+#   trail_lock     con trailing, el límite deja de subir al llegar al balance inicial
+#   daily_dd_mode  "balance" (pérdida desde el balance de inicio del día) o "equity" (desde el máximo intradía)
+#   min_days       días operados mínimos para dar la fase por pasada
+#   consistency    el mejor día (beneficio al cierre) no puede superar esta fracción del beneficio de la fase (0.5 = 50%)
+#   payout_cap     tope en $ de cada retiro (sin contar reembolso ni bonus)
+#   profit_split   fracción del beneficio que cobra el trader
+#   pip_val, max_trades  max_trades por fase, como mucho MAX_TRADES (los histogramas de trades tienen ese tamaño)
+RULE_DEFAULTS = {"dd_type": "static", "trail_lock": False, "daily_dd_mode": "balance", "min_days": 0, "consistency": None,
+                 "payout_cap": None, "profit_split": 0.80, "pip_val": 10.0, "max_trades": MAX_TRADES}
+RULE_CHOICES = {"dd_type": ("static", "trailing"), "daily_dd_mode": ("balance", "equity")}
+ACCOUNT_KEYS = set(ACCOUNT_FIELDS) | {"daily_dd", "profit_p2", "p1_bonus"} | set(RULE_DEFAULTS)
+
+def validate_account(acc, where=""):
+    unknown = set(acc) - ACCOUNT_KEYS
+    if unknown: raise ValueError(f"{where}: reglas desconocidas {sorted(unknown)}")
+    missing = [k for k in ACCOUNT_FIELDS if k not in acc]
+    if missing: raise ValueError(f"{where}: faltan {missing}")
+    for k, choices in RULE_CHOICES.items():
+        if acc.get(k, RULE_DEFAULTS[k]) not in choices: raise ValueError(f"{where}: {k} debe ser uno de {choices}")
+    if int(acc.get('max_trades', MAX_TRADES)) > MAX_TRADES: raise ValueError(f"{where}: max_trades no puede superar {MAX_TRADES}")
+    return acc
+
+@functools.lru_cache(maxsize=None)
+def load_catalog(catalog_dir=None):
+    # {firma: {programa: {tamaño: account_data}}}
+    folder = catalog_dir or CATALOG_DIR
+    catalog = {}
+    for fname in sorted(os.listdir(folder)):
+        if not fname.endswith(".json"): continue
+        with open(os.path.join(folder, fname), encoding="utf-8") as f: spec = json.load(f)
+        programs = catalog.setdefault(spec['firm'], {})
+        for prog, p in spec['programs'].items():
+            programs[prog] = {size: validate_account(dict(p.get('rules', {}), **acc), f"{fname}: {prog} {size}") for size, acc in p['sizes'].items()}
+    return catalog
+
+# Reglas compiladas: flags y escalares que los motores consultan una vez por paso (no por trade)
+PhaseRules = collections.namedtuple("PhaseRules", "trailing trail_lock daily_equity min_days consistency pip_val max_trades")
+
+def compile_rules(account_data):
+    rule = lambda k: account_data.get(k, RULE_DEFAULTS[k])
+    return PhaseRules(rule('dd_type') == "trailing", bool(rule('trail_lock')), rule('daily_dd_mode') == "equity",
+                      int(rule('min_days')), float(rule('consistency')) if rule('consistency') else None,
+                      float(rule('pip_val')), min(int(rule('max_trades')), MAX_TRADES))
+
+STATIC_RULES = compile_rules({})
+
+def is_path_dependent(rules):
+    # Reglas que dependen del camino (máximos, días, mejor día) y no caben en el estado del solver Markov
+    return rules.trailing or rules.daily_equity or rules.min_days > 0 or rules.consistency is not None
+
+def markov_supported(account_data, strategy_params):
+    return 'empirical' not in strategy_params and not is_path_dependent(compile_rules(account_data))
+
+# --- MOTOR DE SIMULACIÓN ---
+def simulate_phase(initial_balance, current_balance, risk_pct, win_rate, rr, target_pct, max_dd_pct, daily_dd_pct, comm, sl_min, sl_max, trades_per_day, is_funded=False):
+    curr = current_balance
+    target_equity = initial_balance + (initial_balance * (target_pct/100))
+    static_limit = initial_balance - (initial_balance * (max_dd_pct/100))
+    
+    if curr <= static_limit: return False, 0, curr, "Ya perdida (Real)"
+    if curr >= target_equity: return True, 0, curr, "Ya ganada (Real)"
+
+    trades = 0
+    max_trades = 1500 
+    pip_val = 10
+    
+    day_start_equity = curr 
+    trades_today = 0
+    fixed_daily_loss_amount = initial_balance * (daily_dd_pct / 100)
+    
+    while curr > static_limit and curr < target_equity and trades < max_trades:
+        trades += 1
+        trades_today += 1
+        
+        if trades_today > trades_per_day:
+            day_start_equity = curr 
+            trades_today = 1        
+            
+        current_sl = random.uniform(sl_min, sl_max)
+        risk_money = initial_balance * (risk_pct / 100) 
+        
+        lot_size = risk_money / (current_sl * pip_val)
+        trade_comm = lot_size * comm
+        
+        slippage = random.uniform(0.95, 1.05) 
+        is_error = random.random() < 0.01 
+        
+        if random.random() < (win_rate/100):
+            profit = (risk_money * rr * slippage) - trade_comm
+            curr += profit
+        else:
+            loss = (risk_money * slippage) + trade_comm
+            if is_error: loss *= 1.5 
+            curr -= loss
+            
+        if curr <= static_limit:
+            return False, trades, curr, "Max Drawdown"
+            
+        if (day_start_equity - curr) >= fixed_daily_loss_amount:
+            return False, trades, curr, "Daily Drawdown"
+            
+    if curr >= target_equity: return True, trades, curr, "Success"
+    else: return False, trades, curr, "Timeout"
+
+# --- MOTOR VECTORIZADO (todos los caminos a la vez) ---
+PHASE_CAUSES = ("Success", "Max Drawdown", "Daily Drawdown", "Timeout", "Ya perdida (Real)", "Ya ganada (Real)")
+C_SUCCESS, C_MAX_DD, C_DAILY_DD, C_TIMEOUT, C_LOST, C_WON = range(len(PHASE_CAUSES))
+
+class EmpiricalPnL:
+    # P&L neto real del diario para el bootstrap: array contiguo float64 + offsets de inicio
+    # de cada día (formato CSR), calculado una vez por cuenta. Sin fechas cada trade es su día.
+    def __init__(self, net, days=None):
+        self.net = np.ascontiguousarray(net, dtype=np.float64)
+        if days is None: starts = np.arange(self.net.size)
+        else:
+            days = np.asarray(days)
+            starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]]) if days.size else np.zeros(0, dtype=np.int64)
+        self.offsets = np.append(starts, self.net.size).astype(np.int64)
+        self.n_days = len(starts)
+        self.trades_per_day = self.net.size / max(self.n_days, 1)
+        self.digest = hashlib.sha256(self.net.tobytes() + self.offsets.tobytes()).hexdigest()
+
+def empirical_params(strategy_params, pnl, by_day=False):
+    # Parámetros para simular con el bootstrap del diario: WR/RR/riesgo/comisión se ignoran
+    # y el ritmo (trades por día) pasa a ser el del propio diario (el del usuario queda en param_trades_day)
+    tpd = pnl.trades_per_day if by_day else max(int(round(pnl.trades_per_day)), 1)
+    return dict(strategy_params, empirical=pnl, bootstrap="day" if by_day else "trade", trades_day=tpd,
+                param_trades_day=strategy_params.get('param_trades_day', strategy_params['trades_day']))
+
+def parametric_params(strategy_params):
+    # Inversa de empirical_params: vuelve al modelo WR/RR con el ritmo del usuario (motores conjunto y de horizonte)
+    out = {k: v for k, v in strategy_params.items() if k not in ('empirical', 'bootstrap', 'param_trades_day')}
+    if 'param_trades_day' in strategy_params: out['trades_day'] = strategy_params['param_trades_day']
+    return out
+
+def simulate_phase_batch(n_paths, initial_balance, current_balance, risk_pct, win_rate, rr, target_pct, max_dd_pct, daily_dd_pct, comm, sl_min, sl_max, trades_per_day, rng, is_funded=False, draw_idx=None, draw_width=None, empirical=None, by_day=False, track_dd=False, rules=None):
+    # risk_pct, win_rate, rr y target_pct aceptan escalar o un valor por camino.
+    # draw_idx: nº de simulación de cada camino (en [0, draw_width)); los caminos con el mismo
+    # índice comparten los aleatorios de cada trade (números aleatorios comunes). draw_width es fijo
+    # (n_sims) para que cada trade consuma siempre lo mismo del generador, vivan los caminos que vivan.
+    # empirical (EmpiricalPnL): cada trade remuestrea el P&L neto del diario en vez de WR/RR;
+    # by_day=True remuestrea días completos en orden (conserva rachas y el DD intradía real).
+    # track_dd=True añade un 5º resultado: el peor DD intradía ($) de cada camino en la fase.
+    # rules (PhaseRules de compile_rules): las reglas activas añaden su estado por camino y su
+    # check vectorizado; las inactivas no cuestan nada dentro del bucle.
+    r = rules or STATIC_RULES
+    per_path = lambda x: np.broadcast_to(np.asarray(x, dtype=float), (n_paths,))
+    target_equity = initial_balance + (initial_balance * (per_path(target_pct)/100))
+    dd_amount = initial_balance * (max_dd_pct/100)
+    static_limit = initial_balance - dd_amount
+
+    trades = np.zeros(n_paths, dtype=np.int32)
+    final = np.full(n_paths, float(current_balance))
+    causes = np.full(n_paths, C_TIMEOUT, dtype=np.int8)
+
+    worst_dd = np.zeros(n_paths)
+    extra = (worst_dd,) if track_dd else ()
+
+    if current_balance <= static_limit:
+        causes[:] = C_LOST
+        return (np.zeros(n_paths, dtype=bool), trades, final, causes) + extra
+    already_won = current_balance >= target_equity
+    causes[already_won] = C_WON
+
+    max_trades = r.max_trades
+    pip_val = r.pip_val
+    fixed_daily_loss_amount = initial_balance * (daily_dd_pct / 100)
+
+    # Solo se avanzan los caminos vivos; los terminados se compactan fuera
+    idx = np.nonzero(~already_won)[0]
+    curr = final[idx]
+    day_start_equity = curr.copy()
+    if track_dd: wdd = np.zeros(idx.size)
+    risk_money = (initial_balance * (per_path(risk_pct) / 100))[idx]
+    win_gain = risk_money * per_path(rr)[idx]
+    p_win = (per_path(win_rate) / 100)[idx]
+    tgt = target_equity[idx]
+    if draw_idx is not None: d_col = draw_idx[idx]
+    if by_day:
+        # Posición del próximo trade y fin del día remuestreado de cada camino
+        pos = np.zeros(idx.size, dtype=np.int64); day_end = np.zeros(idx.size, dtype=np.int64)
+    # Estado por camino de las reglas activas (se compacta junto al resto)
+    state = {}
+    if r.trailing: state['hwm'] = curr.copy()
+    if r.daily_equity: state['day_peak'] = curr.copy()
+    if r.min_days: state['days'] = np.zeros(idx.size, dtype=np.int32)
+    if r.consistency is not None: state['best_day'] = np.zeros(idx.size)  # mejor cierre de los días ya terminados
+
+    for t in range(1, max_trades + 1):
+        if idx.size == 0: break
+        # Todos los caminos vivos llevan el mismo nº de trades -> el reset diario es común
+        if not by_day and (t - 1) % trades_per_day == 0:
+            if r.consistency is not None: np.maximum(state['best_day'], curr - day_start_equity, out=state['best_day'])
+            day_start_equity = curr.copy()
+            if r.daily_equity: state['day_peak'] = curr.copy()
+            if r.min_days: state['days'] += 1
+
+        n_u = 4 if empirical is None else 1
+        u = rng.random((n_u, idx.size)) if draw_idx is None else rng.random((n_u, draw_width))[:, d_col]
+        if empirical is None:
+            current_sl = sl_min + (sl_max - sl_min) * u[0]
+            trade_comm = (risk_money / (current_sl * pip_val)) * comm
+            slippage = 0.95 + 0.10 * u[1]
+            loss = (risk_money * slippage + trade_comm) * np.where(u[2] < 0.01, 1.5, 1.0)
+            curr += np.where(u[3] < p_win, win_gain * slippage - trade_comm, -loss)
+        elif by_day:
+            new_day = pos >= day_end
+            if new_day.any():
+                d = (u[0][new_day] * empirical.n_days).astype(np.int64)
+                pos[new_day] = empirical.offsets[d]; day_end[new_day] = empirical.offsets[d + 1]
+                if r.consistency is not None: state['best_day'][new_day] = np.maximum(state['best_day'], curr - day_start_equity)[new_day]
+                day_start_equity[new_day] = curr[new_day]
+                if r.daily_equity: state['day_peak'][new_day] = curr[new_day]
+                if r.min_days: state['days'][new_day] += 1
+            curr += empirical.net[pos]; pos += 1
+        else:
+            curr += empirical.net[(u[0] * empirical.net.size).astype(np.int64)]
+
+        if track_dd: np.maximum(wdd, day_start_equity - curr, out=wdd)
+        if r.trailing:
+            hwm = np.maximum(state['hwm'], curr, out=state['hwm'])
+            floor = hwm - dd_amount
+            if r.trail_lock: np.minimum(floor, initial_balance, out=floor)
+            dd_hit = curr <= floor
+        else:
+            dd_hit = curr <= static_limit
+        if r.daily_equity: day_ref = np.maximum(state['day_peak'], curr, out=state['day_peak'])
+        else: day_ref = day_start_equity
+        daily_hit = ~dd_hit & ((day_ref - curr) >= fixed_daily_loss_amount)
+        reached = curr >= tgt
+        if r.min_days: reached &= state['days'] >= r.min_days
+        if r.consistency is not None:
+            # Días cerrados + el día en curso (si la fase termina ahora, este es su cierre)
+            best = np.maximum(state['best_day'], curr - day_start_equity)
+            reached &= best <= r.consistency * (curr - current_balance)
+        done = dd_hit | daily_hit | reached
+        if done.any():
+            d_idx = idx[done]
+            trades[d_idx] = t
+            final[d_idx] = curr[done]
+            causes[d_idx] = np.where(dd_hit[done], C_MAX_DD, np.where(daily_hit[done], C_DAILY_DD, C_SUCCESS))
+            if track_dd: worst_dd[d_idx] = wdd[done]
+            keep = ~done
+            idx = idx[keep]; curr = curr[keep]; day_start_equity = day_start_equity[keep]
+            risk_money = risk_money[keep]; win_gain = win_gain[keep]; p_win = p_win[keep]; tgt = tgt[keep]
+            if draw_idx is not None: d_col = d_col[keep]
+            if by_day: pos = pos[keep]; day_end = day_end[keep]
+            if track_dd: wdd = wdd[keep]
+            for k in state: state[k] = state[k][keep]
+
+    # Timeout
+    trades[idx] = max_trades
+    final[idx] = curr
+    if track_dd: worst_dd[idx] = wdd
+    return ((causes == C_SUCCESS) | (causes == C_WON), trades, final, causes) + extra
+
+def tally_failures(fail_reasons, ok, causes):
+    counts = np.bincount(causes[~ok], minlength=len(PHASE_CAUSES))
+    for code, name in enumerate(PHASE_CAUSES):
+        if name in fail_reasons: fail_reasons[name] += int(counts[code])
+
+def calculate_time_metrics(trades_hist, trades_per_day):
+    summary = hist_summary("trades", trades_hist) if trades_hist is not None else None
+    if not summary: return 0.0
+    trading_days = summary['mean'] / trades_per_day
+    months = trading_days / 20.0
+    return months
+
+# --- DISTRIBUCIONES (memoria constante) ---
+# Histogramas de bordes fijos (lo, hi, nº de bins): se fusionan sumando en merge_counters y su
+# tamaño no depende de n_sims. "trades" es exacto (un bin por trade); "timeline" son los trades
+# acumulados desde el inicio hasta cada cobro; equity y daily_dd van en % del tamaño de la cuenta.
+HIST_SPECS = {
+    "trades": (0.0, MAX_TRADES + 1.0, MAX_TRADES + 1),
+    "timeline": (0.0, 5.0 * (MAX_TRADES + 1), MAX_TRADES + 1),
+    "equity": (-30.0, 70.0, 1000),  # % del tamaño: metas hasta 20% (Meta Retiro) + un trade ganador a riesgo 5% x R:R 10
+    "daily_dd": (0.0, 20.0, 400),
+    "share": (0.0, 100.0, 200),  # cobro total del portafolio, % del máximo posible
+    "purchases": (0.0, 1001.0, 1001),  # cuentas compradas (compra secuencial)
+    "outlay": (-0.05, 999.95, 10000),  # capital máximo desembolsado, en costes de cuenta (bins centrados en 0.1)
+    "months": (0.0, 120.0, 480),
+    "cash": (0.0, 100.0, 4000),  # caja neta acumulada (horizonte), % del rango posible [-coste, todos los retiros - coste]
+}
+INTEGER_HISTS = ("trades", "timeline", "purchases")
+CENTER_HISTS = ("outlay",)  # cuantiles en el centro del bin: interpolar dentro podría bajar del mínimo posible
+DIST_QUANTILES = (0.10, 0.50, 0.90)
+
+def hist_counts(kind, values, weights=None, groups=None, n_groups=1):
+    # Valores fuera de rango caen en el primer/último bin. groups -> una fila por grupo
+    lo, hi, n = HIST_SPECS[kind]
+    b = np.clip(np.floor((np.asarray(values, dtype=float) - lo) * n / (hi - lo)), 0, n - 1).astype(np.int64)
+    if groups is None: return np.bincount(b, weights=weights, minlength=n)
+    return np.bincount(groups * n + b, weights=weights, minlength=n_groups * n).reshape(n_groups, n)
+
+def hist_summary(kind, counts, scale=1.0):
+    # Media, P10/P50/P90 y el histograma recortado a los bins con datos, en unidades * scale
+    lo, hi, n = HIST_SPECS[kind]
+    w = (hi - lo) / n
+    counts = np.asarray(counts, dtype=float)
+    total = counts.sum()
+    if total <= 0: return None
+    integer = kind in INTEGER_HISTS
+    centers = lo + np.arange(n) * w + ((w - 1) / 2 if integer else w / 2)
+    cdf = np.cumsum(counts)
+    out = {"mean": float((counts * centers).sum() / total) * scale}
+    for q in DIST_QUANTILES:
+        i = min(int(np.searchsorted(cdf, q * total)), n - 1)
+        frac = (q * total - (cdf[i - 1] if i else 0.0)) / counts[i]
+        within = max(math.ceil(frac * w) - 1, 0) if integer else w / 2 if kind in CENTER_HISTS else frac * w
+        out[f"p{round(q * 100)}"] = float(lo + i * w + within) * scale
+    nz = np.nonzero(counts)[0]
+    out.update({"lo": float(lo + nz[0] * w) * scale, "width": w * scale, "counts": counts[nz[0]:nz[-1] + 1].tolist()})
+    return out
+
+def simulate_account_counters(account_data, strategy_params, n_sims, current_balance_real, rng=None):
+    if rng is None: rng = np.random.default_rng()
+    wr = strategy_params['win_rate']; rr = strategy_params['rr']
+    risk = strategy_params['risk']; w_target = strategy_params['withdrawal_target']
+    comm = strategy_params['comm']; trades_day = strategy_params['trades_day']
+    sl_min = 5; sl_max = 15; daily_dd = account_data.get('daily_dd', 100.0)
+    empirical = strategy_params.get('empirical'); by_day = strategy_params.get('bootstrap') == "day"
+    rules = compile_rules(account_data)
+    
+    initial_size = account_data['size']
+    is_2step = account_data.get('profit_p2', 0) > 0
+    
+    fail_reasons = {"Max Drawdown": 0, "Daily Drawdown": 0, "Timeout": 0, "Ya perdida (Real)": 0}
+    
+    # Instrumentación por fase: tiempo, caminos, trades simulados y causa de fin.
+    # Distribuciones por fase en histogramas fijos: trades hasta pasar, equity final y peor DD intradía
+    diag = {}; dist = {}; timeline = {}
+    def phase(n, start_bal, target_pct, key):
+        t0 = time.perf_counter()
+        ok, t, final, causes, worst_dd = simulate_phase_batch(n, initial_size, start_bal, risk, wr, rr, target_pct, account_data['total_dd'], daily_dd, comm, sl_min, sl_max, trades_day, rng,
+                                                              empirical=empirical, by_day=by_day, track_dd=True, rules=rules)
+        counts = np.bincount(causes, minlength=len(PHASE_CAUSES))
+        diag[key] = {"time": time.perf_counter() - t0, "paths": n, "trades": int(t.sum()),
+                     "causes": {name: int(counts[code]) for code, name in enumerate(PHASE_CAUSES)}}
+        dist[key] = {"trades": hist_counts("trades", t[ok]), "equity": hist_counts("equity", (final / initial_size - 1) * 100),
+                     "daily_dd": hist_counts("daily_dd", worst_dd / initial_size * 100)}
+        return ok, t, final, causes
+
+    # 1. FASE 1
+    ok1, t1, _, cause1 = phase(n_sims, current_balance_real, account_data['profit_p1'], "p1")
+    pass_p1_count = int(ok1.sum())
+    elapsed = t1[ok1]  # trades acumulados desde el inicio de cada camino superviviente
+    failed = [t1[~ok1]]  # trades acumulados hasta perder la cuenta antes del retiro 1
+    tally_failures(fail_reasons, ok1, cause1)
+
+    # 2. FASE 2 (solo los caminos que pasaron la fase 1)
+    if is_2step:
+        ok2, t2, _, cause2 = phase(pass_p1_count, initial_size, account_data['profit_p2'], "p2")
+        pass_p2_count = int(ok2.sum())
+        failed.append((elapsed + t2)[~ok2])
+        elapsed = (elapsed + t2)[ok2]
+        tally_failures(fail_reasons, ok2, cause2)
+    else:
+        pass_p2_count = pass_p1_count
+
+    # COBRO 1
+    ok_c1, tc1, _, cause3 = phase(pass_p2_count, initial_size, w_target, "c1")
+    pass_c1 = int(ok_c1.sum())
+    failed.append((elapsed + tc1)[~ok_c1]); timeline["fail"] = hist_counts("timeline", np.concatenate(failed))
+    elapsed = (elapsed + tc1)[ok_c1]; timeline["c1"] = hist_counts("timeline", elapsed)
+    tally_failures(fail_reasons, ok_c1, cause3)
+
+    # COBRO 2
+    ok_c2, tc2, _, _ = phase(pass_c1, initial_size, w_target, "c2")
+    pass_c2 = int(ok_c2.sum())
+    elapsed = (elapsed + tc2)[ok_c2]; timeline["c2"] = hist_counts("timeline", elapsed)
+
+    # COBRO 3
+    ok_c3, tc3, _, _ = phase(pass_c2, initial_size, w_target, "c3")
+    pass_c3 = int(ok_c3.sum())
+    elapsed = (elapsed + tc3)[ok_c3]; timeline["c3"] = hist_counts("timeline", elapsed)
+
+    return {
+        "n_sims": n_sims,
+        "pass_p1": pass_p1_count, "pass_p2": pass_p2_count,
+        "pass_c1": pass_c1, "pass_c2": pass_c2, "pass_c3": pass_c3,
+        "fail_reasons": fail_reasons,
+        "dist": dist, "timeline": timeline,
+        "diag": diag
+    }
+
+def merge_counters(a, b):
+    # Suma campo a campo (las listas se concatenan, los dicts se mezclan recursivamente)
+    out = dict(b)
+    for k, v in a.items():
+        if k not in b: out[k] = v
+        elif isinstance(v, dict): out[k] = merge_counters(v, b[k])
+        else: out[k] = v + b[k]
+    return out
+
+def payout_values(account_data, strategy_params):
+    # Importe de los retiros 1-3: profit split de la meta (con tope si la firma lo tiene); el primero suma el reembolso y el bonus
+    split_share = account_data['size'] * (strategy_params['withdrawal_target'] / 100) * account_data.get('profit_split', RULE_DEFAULTS['profit_split'])
+    if account_data.get('payout_cap'): split_share = min(split_share, float(account_data['payout_cap']))
+    return split_share + account_data['cost'] + account_data.get('p1_bonus', 0), split_share, split_share
+
+def summarize_account(account_data, strategy_params, counters):
+    trades_day = strategy_params['trades_day']
+    n_sims = counters['n_sims']
+    pass_p1_count = counters['pass_p1']; pass_p2_count = counters['pass_p2']
+    pass_c1 = counters['pass_c1']; pass_c2 = counters['pass_c2']; pass_c3 = counters['pass_c3']
+    fail_reasons = counters['fail_reasons']
+    
+    pay_val_1, pay_val_2, pay_val_3 = payout_values(account_data, strategy_params)
+    split_share = pay_val_2
+    
+    is_2step = account_data.get('profit_p2', 0) > 0
+    
+    sum_pay1 = pass_c1 * pay_val_1; sum_pay2 = pass_c2 * pay_val_2; sum_pay3 = pass_c3 * pay_val_3
+
+    prob_p1 = (pass_p1_count/n_sims)*100
+    prob_p2 = (pass_p2_count/n_sims)*100 if is_2step else 100.0
+    prob_c1 = (pass_c1/n_sims)*100
+    prob_c2 = (pass_c2/n_sims)*100
+    prob_c3 = (pass_c3/n_sims)*100
+    
+    avg_pay1 = sum_pay1 / pass_c1 if pass_c1 > 0 else 0
+    avg_pay2 = sum_pay2 / pass_c2 if pass_c2 > 0 else 0
+    avg_pay3 = sum_pay3 / pass_c3 if pass_c3 > 0 else 0
+    
+    dist = counters.get('dist', {})
+    phase_trades = lambda key: dist.get(key, {}).get('trades')
+    time_p1 = calculate_time_metrics(phase_trades('p1'), trades_day)
+    time_p2 = calculate_time_metrics(phase_trades('p2'), trades_day) if is_2step else 0
+    time_c1 = calculate_time_metrics(phase_trades('c1'), trades_day)
+    time_c2 = calculate_time_metrics(phase_trades('c2'), trades_day)
+    time_c3 = calculate_time_metrics(phase_trades('c3'), trades_day)
+
+    # Resúmenes de distribución: tiempos en meses (20 días hábiles), equity y DD en % del tamaño
+    months = 1.0 / (trades_day * 20.0)
+    units = {"trades": ("months", months), "equity": ("equity", 1.0), "daily_dd": ("daily_dd", 1.0)}
+    dist_out = {key: {units[kind][0]: hist_summary(kind, h, units[kind][1]) for kind, h in hs.items()} for key, hs in dist.items()}
+    timeline = {key: hist_summary("timeline", h, months) for key, h in counters.get('timeline', {}).items()}
+    
+    # --- LOGICA DE STOCK AJUSTADA (Umbral 85%) ---
+    if prob_c1 >= 85.0: 
+        attempts = 1.0
+        reason = f"¡Probabilidad Alta ({prob_c1:.1f}%)! Con este nivel de seguridad, 1 sola cuenta es suficiente."
+    elif prob_c1 <= 0.5: 
+        attempts = 100.0
+        reason = "Probabilidad nula. Estrategia no viable."
+    else: 
+        attempts = 100/prob_c1
+        reason = f"Con {prob_c1:.1f}% de éxito, la estadística sugiere cubrir {math.ceil(attempts)} intentos secuenciales para garantizar el cobro."
+    
+    inv_req = math.ceil(attempts) * account_data['cost']
+    salary = avg_pay1 - inv_req
+    
+    est_breakdown = {
+        "split": split_share, "refund": account_data['cost'], "bonus": account_data.get('p1_bonus', 0), "total": pay_val_1
+    }
+    
+    total_failures = n_sims - pass_c1
+    fail_stats = {}
+    if total_failures > 0:
+        for k, v in fail_reasons.items(): fail_stats[k] = (v/total_failures)*100
+            
+    return {
+        "prob_p1": prob_p1, "prob_p2": prob_p2,
+        "prob_c1": prob_c1, "prob_c2": prob_c2, "prob_c3": prob_c3,
+        "avg_pay1": avg_pay1, "avg_pay2": avg_pay2, "avg_pay3": avg_pay3,
+        "time_p1": time_p1, "time_p2": time_p2, "time_c1": time_c1, "time_c2": time_c2, "time_c3": time_c3,
+        "inventory": math.ceil(attempts), "investment": inv_req, "net_profit": salary,
+        "stock_reason": reason, "first_pay_est": est_breakdown, "fail_stats": fail_stats, "total_failures": total_failures,
+        "is_2step": is_2step, "diag": counters.get('diag'), "dist": dist_out, "timeline": timeline
+    }
+
+def run_account_simulation(account_data, strategy_params, n_sims, current_balance_real, rng=None):
+    counters = simulate_account_counters(account_data, strategy_params, n_sims, current_balance_real, rng)
+    return summarize_account(account_data, strategy_params, counters)
+
+# --- EJECUCIÓN PARALELA ---
+SIM_CHUNK = 1000
+SIM_ENGINE_VERSION = 5  # subir cuando cambie el motor para invalidar la caché
+
+def _canonical(obj):
+    if isinstance(obj, EmpiricalPnL): return obj.digest
+    if isinstance(obj, dict): return {str(k): _canonical(v) for k, v in sorted(obj.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(obj, (list, tuple)): return [_canonical(v) for v in obj]
+    if isinstance(obj, bool) or obj is None or isinstance(obj, str): return obj
+    if isinstance(obj, (int, float, np.integer, np.floating)): return round(float(obj), 9)
+    return str(obj)
+
+def sim_cache_key(account_data, strategy_params, n_sims, start_balance, seed):
+    payload = {"v": SIM_ENGINE_VERSION, "account": account_data, "params": strategy_params,
+               "n_sims": n_sims, "start": start_balance, "seed": seed}
+    return hashlib.sha256(json.dumps(_canonical(payload), sort_keys=True).encode()).hexdigest()
+
+def job_seed_sequence(account_data, strategy_params, n_sims, start_balance, seed):
+    key = sim_cache_key(account_data, strategy_params, n_sims, start_balance, None)
+    return np.random.SeedSequence([seed, int(key[:16], 16)])
+
+def _run_chunk(task):
+    j, account_data, strategy_params, n, start_bal, seed_seq = task
+    return j, simulate_account_counters(account_data, strategy_params, n, start_bal, np.random.default_rng(seed_seq))
+
+def portfolio_tasks(jobs, n_sims, seed=None):
+    # jobs: lista de (account_data, strategy_params, start_balance).
+    # Cada cuenta se parte en bloques de SIM_CHUNK con su propia semilla derivada
+    # de (semilla, contenido de la cuenta), así el resultado no depende del nº de
+    # procesos ni de la posición de la cuenta en el portafolio.
+    if seed is None: job_seqs = np.random.SeedSequence().spawn(len(jobs))
+    else: job_seqs = [job_seed_sequence(acc, params, n_sims, bal, seed) for acc, params, bal in jobs]
+    per_job = []
+    for j, (account_data, strategy_params, start_bal) in enumerate(jobs):
+        sizes = [SIM_CHUNK] * (n_sims // SIM_CHUNK)
+        if n_sims % SIM_CHUNK: sizes.append(n_sims % SIM_CHUNK)
+        per_job.append([(j, account_data, strategy_params, n, start_bal, seq) for n, seq in zip(sizes, job_seqs[j].spawn(len(sizes)))])
+    # Orden por turnos (bloque 0 de todas las cuentas, luego bloque 1...) para que
+    # todas las cuentas tengan estimación pronto al ir en streaming
+    return [t for round_ in itertools.zip_longest(*per_job) for t in round_ if t is not None]
+
+def pool_context():
+    # Sin fork() desde un proceso con hilos (servidor de Streamlit, autoguardado): un lock tomado por
+    # otro hilo queda bloqueado para siempre en el hijo. El forkserver precarga este módulo una vez.
+    if "forkserver" not in multiprocessing.get_all_start_methods(): return multiprocessing.get_context("spawn")
+    ctx = multiprocessing.get_context("forkserver")
+    ctx.set_forkserver_preload([__name__])
+    return ctx
+
+@contextlib.contextmanager
+def bare_main():
+    # forkserver/spawn vuelven a ejecutar el __main__ del padre en cada hijo; bajo Streamlit ese
+    # __main__ es el script de la app (UI, BD, autoguardado). Mientras se lanzan los procesos,
+    # __main__ es un módulo vacío: los hijos solo importan el motor (los workers viven aquí).
+    main = sys.modules.get('__main__')
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    try: yield
+    finally: sys.modules['__main__'] = main
+
+def make_worker_pool(n_workers=None):
+    # Pool de procesos reutilizable entre corridas (p.ej. uno por proceso de la app): cada worker
+    # arranca e importa numpy una sola vez. Se pasa como pool= a los run_*/iter_* del motor.
+    return ProcessPoolExecutor(max_workers=n_workers or os.cpu_count() or 1, mp_context=pool_context())
+
+def iter_chunk_results(tasks, n_workers=1, worker=_run_chunk, pool=None):
+    # Rinde worker(task) según se completa cada bloque. Al cerrar el generador (cancelación) se
+    # descartan los bloques pendientes. pool: pool compartido (make_worker_pool), no se cierra aquí;
+    # sin él se crea uno para esta corrida.
+    if n_workers is None: n_workers = os.cpu_count() or 1
+    own = None
+    if n_workers <= 1 or len(tasks) <= 1: pool = None
+    elif pool is None:
+        try: pool = own = make_worker_pool(min(n_workers, len(tasks)))
+        except Exception: pool = None
+    if pool is None:
+        for t in tasks: yield worker(t)
+        return
+    try:
+        with bare_main(): futures = [pool.submit(worker, t) for t in tasks]  # los procesos arrancan al encolar
+    except (BrokenProcessPool, RuntimeError):
+        # Pool compartido roto o cerrado: en serie
+        for t in tasks: yield worker(t)
+        return
+    try:
+        for fut in as_completed(futures): yield fut.result()
+    finally:
+        if own: own.shutdown(wait=False, cancel_futures=True)
+        else:
+            for f in futures: f.cancel()
+
+def run_portfolio_simulation(jobs, n_sims, seed=None, n_workers=1, pool=None):
+    merged = [None] * len(jobs)
+    for j, c in iter_chunk_results(portfolio_tasks(jobs, n_sims, seed), n_workers, pool=pool):
+        merged[j] = c if merged[j] is None else merge_counters(merged[j], c)
+    return [summarize_account(jobs[j][0], jobs[j][1], merged[j]) for j in range(len(jobs))]
+
+def iter_portfolio_simulation(jobs, n_sims, seed=None, n_workers=1, pool=None):
+    # Streaming: tras cada bloque rinde (fracción completada, stats por cuenta o None).
+    # El último valor coincide con run_portfolio_simulation para la misma semilla.
+    tasks = portfolio_tasks(jobs, n_sims, seed)
+    merged = [None] * len(jobs); stats = [None] * len(jobs)
+    for done, (j, c) in enumerate(iter_chunk_results(tasks, n_workers, pool=pool), 1):
+        merged[j] = c if merged[j] is None else merge_counters(merged[j], c)
+        stats[j] = summarize_account(jobs[j][0], jobs[j][1], merged[j])
+        yield done / len(tasks), list(stats)
+
+# --- CACHÉ DE RESULTADOS ---
+class SimResultCache:
+    # LRU acotada por bytes; guarda el JSON para que cada get devuelva una copia
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0; self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            blob = self.entries.get(key)
+            if blob is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return json.loads(blob)
+
+    def put(self, key, value):
+        blob = json.dumps(value)
+        if len(blob) > self.max_bytes: return
+        with self.lock:
+            if key in self.entries: self.size -= len(self.entries.pop(key))
+            self.entries[key] = blob
+            self.size += len(blob)
+            while self.size > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+
+# --- SOLVER EXACTO (Cadena de Markov absorbente) ---
+MARKOV_RESOLUTION = 20      # buckets de equity por unidad de riesgo
+MARKOV_MAX_BUCKETS = 400    # tope de estados de equity (coste ~ N^2 por día)
+MARKOV_QUAD_NODES = 16      # nodos de cuadratura para SL y slippage
+
+def trade_pnl_distribution(risk_money, win_rate, rr, comm, sl_min, sl_max, pip_val=10):
+    # Cuadratura de punto medio sobre SL ~ U(sl_min, sl_max) y slippage ~ U(0.95, 1.05)
+    u = (np.arange(MARKOV_QUAD_NODES) + 0.5) / MARKOV_QUAD_NODES
+    sl = sl_min + (sl_max - sl_min) * u
+    slip = 0.95 + 0.10 * u
+    trade_comm = (risk_money / (sl * pip_val) * comm)[:, None]
+    w_node = 1.0 / MARKOV_QUAD_NODES ** 2
+    p_win = win_rate / 100
+    wins = (risk_money * rr * slip[None, :] - trade_comm).ravel()
+    losses = -(risk_money * slip[None, :] + trade_comm).ravel()
+    values = np.concatenate([wins, losses, losses * 1.5])
+    probs = np.concatenate([np.full(wins.size, p_win * w_node), np.full(losses.size, (1 - p_win) * 0.99 * w_node), np.full(losses.size, (1 - p_win) * 0.01 * w_node)])
+    return values, probs
+
+@functools.lru_cache(maxsize=256)
+def solve_phase_markov(initial_balance, current_balance, risk_pct, win_rate, rr, target_pct, max_dd_pct, daily_dd_pct, comm, sl_min, sl_max, trades_per_day, max_trades=MAX_TRADES, pip_val=10.0):
+    target_equity = initial_balance + (initial_balance * (target_pct/100))
+    static_limit = initial_balance - (initial_balance * (max_dd_pct/100))
+    res = {"success": 0.0, "Max Drawdown": 0.0, "Daily Drawdown": 0.0, "Timeout": 0.0, "Ya perdida (Real)": 0.0, "exp_trades": 0.0, "exp_trades_success": 0.0}
+    # Masa de éxito por nº de trades: distribución exacta del tiempo hasta pasar la fase
+    success_hist = np.zeros(max(max_trades, MAX_TRADES) + 1)  # mismo tamaño que HIST_SPECS["trades"]
+    fail_hist = np.zeros_like(success_hist)  # ídem para la pérdida de la cuenta (DD, diario o Timeout)
+    if current_balance <= static_limit: res["Ya perdida (Real)"] = 1.0; fail_hist[0] = 1.0; return _markov_result(res, success_hist, fail_hist)
+    if current_balance >= target_equity: res["success"] = 1.0; success_hist[0] = 1.0; return _markov_result(res, success_hist, fail_hist)
+
+    risk_money = initial_balance * (risk_pct / 100)
+    fixed_daily_loss_amount = initial_balance * (daily_dd_pct / 100)
+    h = max(risk_money / MARKOV_RESOLUTION, (target_equity - static_limit) / MARKOV_MAX_BUCKETS)
+
+    # Rejilla anclada en el balance de partida: e_j = current + j*h, vivos si limit < e_j < target
+    lo_j = math.floor((static_limit - current_balance) / h) + 1
+    hi_j = math.ceil((target_equity - current_balance) / h) - 1
+    N = hi_j - lo_j + 1
+    start_i = -lo_j
+
+    values, probs = trade_pnl_distribution(risk_money, win_rate, rr, comm, sl_min, sl_max, pip_val)
+    # Redondeo repartido entre los dos buckets vecinos: conserva la media del P&L
+    x = values / h
+    fl = np.floor(x).astype(int)
+    frac = x - fl
+    offs = np.concatenate([fl, fl + 1])
+    omin = offs.min()
+    off_probs = np.bincount(offs - omin, weights=np.concatenate([probs * (1 - frac), probs * frac]))
+    nz = np.nonzero(off_probs)[0]
+
+    # Pérdida diaria: (e_s - e_c) = (s - c)*h >= límite
+    idx = np.arange(N)
+    daily_mask = ((idx[:, None] - idx[None, :]) * h) >= fixed_daily_loss_amount - 1e-9
+
+    # Un día completo para todos los estados de inicio a la vez: M[s, c]
+    tpd = trades_per_day
+    M = np.eye(N)
+    S = np.zeros((N, tpd)); F = np.zeros((N, tpd)); D = np.zeros((N, tpd))
+    alive_day = np.zeros((N, tpd))
+    rem = max_trades % tpd
+    M_rem = None
+    L = -omin
+    for k in range(tpd):
+        alive_day[:, k] = M.sum(axis=1)
+        P = np.zeros((N, N + off_probs.size - 1))
+        for o in nz: P[:, o:o + N] += off_probs[o] * M
+        F[:, k] = P[:, :L].sum(axis=1)
+        S[:, k] = P[:, L + N:].sum(axis=1)
+        M = P[:, L:L + N]
+        D[:, k] = (M * daily_mask).sum(axis=1)
+        M = np.where(daily_mask, 0.0, M)
+        if k + 1 == rem: M_rem = M.copy()
+    T = M
+
+    v = np.zeros(N); v[start_i] = 1.0
+    steps = np.arange(1, tpd + 1)
+    full_days = max_trades // tpd
+    for day in range(full_days + (1 if rem else 0)):
+        if v.sum() < 1e-12: break
+        last = day == full_days
+        kmax = rem if last else tpd
+        s_k = (v @ S)[:kmax]; f_k = (v @ F)[:kmax]; d_k = (v @ D)[:kmax]
+        res["success"] += s_k.sum()
+        res["Max Drawdown"] += f_k.sum()
+        res["Daily Drawdown"] += d_k.sum()
+        res["exp_trades"] += (v @ alive_day)[:kmax].sum()
+        res["exp_trades_success"] += (s_k * (day * tpd + steps[:kmax])).sum()
+        success_hist[day * tpd + steps[:kmax]] += s_k
+        fail_hist[day * tpd + steps[:kmax]] += f_k + d_k
+        v = v @ (M_rem if last else T)
+    else:
+        res["Timeout"] = float(v.sum())
+        fail_hist[max_trades] += res["Timeout"]
+    if res["success"] > 0: res["exp_trades_success"] /= res["success"]
+    return _markov_result(res, success_hist, fail_hist)
+
+def _markov_result(res, success_hist, fail_hist):
+    # Masa residual numérica (<1e-12) se considera cero; los histogramas quedan de solo lectura (lru_cache)
+    out = {k: (float(v) if v >= 1e-12 else 0.0) for k, v in res.items()}
+    for name, h in (("success_hist", success_hist), ("fail_hist", fail_hist)):
+        h[h < 1e-12] = 0.0; h.flags.writeable = False
+        out[name] = h
+    return out
+
+def _pad(a, b):
+    n = max(a.size, b.size)
+    return np.pad(a, (0, n - a.size)), np.pad(b, (0, n - b.size))
+
+def run_account_markov(account_data, strategy_params, current_balance_real):
+    wr = strategy_params['win_rate']; rr = strategy_params['rr']
+    risk = strategy_params['risk']; w_target = strategy_params['withdrawal_target']
+    comm = strategy_params['comm']; trades_day = strategy_params['trades_day']
+    sl_min = 5; sl_max = 15; daily_dd = account_data.get('daily_dd', 100.0)
+    initial_size = account_data['size']
+    is_2step = account_data.get('profit_p2', 0) > 0
+    rules = compile_rules(account_data)
+    if is_path_dependent(rules): raise ValueError("Las reglas de esta cuenta dependen del camino: usar Montecarlo (ver markov_supported)")
+
+    def phase(start_bal, target_pct):
+        return solve_phase_markov(float(initial_size), float(start_bal), float(risk), float(wr), float(rr), float(target_pct), float(account_data['total_dd']), float(daily_dd), float(comm), sl_min, sl_max, int(trades_day),
+                                  rules.max_trades, rules.pip_val)
+
+    # Contadores esperados por simulación (n_sims = 1, cuentas fraccionarias)
+    fail_reasons = {"Max Drawdown": 0.0, "Daily Drawdown": 0.0, "Timeout": 0.0, "Ya perdida (Real)": 0.0}
+    def tally(ph, weight):
+        for k in fail_reasons: fail_reasons[k] += weight * ph[k]
+
+    ph1 = phase(current_balance_real, account_data['profit_p1'])
+    p1 = ph1['success']; tally(ph1, 1.0)
+    if is_2step:
+        ph2 = phase(initial_size, account_data['profit_p2'])
+        p2 = p1 * ph2['success']; tally(ph2, p1)
+    else:
+        ph2 = None; p2 = p1
+    phc = phase(initial_size, w_target)
+    c1 = p2 * phc['success']; tally(phc, p2)
+
+    # Tiempo hasta cada cobro: convolución de las distribuciones de éxito de las fases encadenadas
+    dist = {"p1": {"trades": ph1['success_hist']}, "c1": {"trades": phc['success_hist']},
+            "c2": {"trades": phc['success_hist']}, "c3": {"trades": phc['success_hist']}}
+    elapsed = ph1['success_hist']; failed = ph1['fail_hist']
+    if ph2:
+        dist["p2"] = {"trades": ph2['success_hist']}
+        failed = np.add(*_pad(failed, np.convolve(elapsed, ph2['fail_hist'])))
+        elapsed = np.convolve(elapsed, ph2['success_hist'])
+    failed = np.add(*_pad(failed, np.convolve(elapsed, phc['fail_hist'])))
+    timeline = {"fail": hist_counts("timeline", np.arange(failed.size), weights=failed)}
+    for key in ("c1", "c2", "c3"):
+        elapsed = np.convolve(elapsed, phc['success_hist'])
+        timeline[key] = hist_counts("timeline", np.arange(elapsed.size), weights=elapsed)
+
+    counters = {
+        "n_sims": 1,
+        "pass_p1": p1, "pass_p2": p2,
+        "pass_c1": c1, "pass_c2": c1 * phc['success'], "pass_c3": c1 * phc['success'] ** 2,
+        "fail_reasons": fail_reasons,
+        "dist": dist, "timeline": timeline
+    }
+    stats = summarize_account(account_data, strategy_params, counters)
+    stats['exact'] = True
+    # Trades esperados por fase (por intento, hasta pasar o perder, y entre los que la pasan) y acumulados hasta cada cobro
+    phases = {"p1": ph1, "p2": ph2, "c1": phc, "c2": phc, "c3": phc}
+    stats['exp_trades'] = {k: {"attempt": ph['exp_trades'], "success": ph['exp_trades_success']} for k, ph in phases.items() if ph}
+    to_pay = ph1['exp_trades_success'] + (ph2['exp_trades_success'] if ph2 else 0.0)
+    stats['exp_trades_payout'] = {}
+    for k in ("c1", "c2", "c3"):
+        to_pay += phc['exp_trades_success']; stats['exp_trades_payout'][k] = to_pay
+    return stats
+
+# --- COMPRA SECUENCIAL DE CUENTAS ---
+PURCHASE_MAX_ATTEMPTS = 100  # intentos por línea antes de darla por perdida (mismo tope que el inventario)
+
+def hist_sample(summary, n, rng):
+    # Muestras de un resumen de hist_summary: bin según su peso, posición uniforme dentro del bin
+    counts = np.asarray(summary['counts'], dtype=float)
+    b = rng.choice(counts.size, n, p=counts / counts.sum())
+    return summary['lo'] + (b + rng.random(n)) * summary['width']
+
+def simulate_purchases(account_data, strategy_params, stats, n_sims=5000, concurrent=1, rng=None):
+    # Renovación sobre los resultados por intento de cualquier motor (stats de summarize_account):
+    # `concurrent` líneas en paralelo; cada una recompra la cuenta al perderla hasta cobrar su
+    # retiro 1 (intentos ~ geométrica(prob_c1), duraciones de los histogramas de fallo y de cobro).
+    # El retiro 1 de una línea financia las recompras de las demás: el capital máximo es el pico
+    # de (comisiones pagadas - retiros 1 cobrados). Todo en lotes, sin bucles por simulación.
+    p = stats['prob_c1'] / 100
+    succ = (stats.get('timeline') or {}).get('c1'); fail = (stats.get('timeline') or {}).get('fail')
+    if p <= 0 or not succ: return None
+    if rng is None: rng = np.random.default_rng()
+    cost = account_data['cost']; pay1 = payout_values(account_data, strategy_params)[0]
+    n_lines = n_sims * concurrent
+    draws = rng.geometric(min(p, 1.0), n_lines)
+    paid = draws <= PURCHASE_MAX_ATTEMPTS
+    attempts = np.minimum(draws, PURCHASE_MAX_ATTEMPTS)
+    n_fail = attempts - paid
+
+    # Duraciones de los intentos perdidos, acumuladas dentro de cada línea
+    line_of_fail = np.repeat(np.arange(n_lines), n_fail)
+    fail_t = hist_sample(fail, line_of_fail.size, rng) if line_of_fail.size and fail else np.zeros(line_of_fail.size)
+    cum = np.cumsum(fail_t)
+    first = np.cumsum(n_fail) - n_fail
+    cum -= np.concatenate([[0.0], cum])[first][line_of_fail]
+    pay_t = np.where(paid, np.bincount(line_of_fail, weights=fail_t, minlength=n_lines) + hist_sample(succ, n_lines, rng), np.inf)
+
+    # Eventos de caja: compra inicial, recompra tras cada fallo (salvo el último de una línea agotada) y retiro 1
+    rebuy = paid[line_of_fail] | (np.arange(line_of_fail.size) - first[line_of_fail] < n_fail[line_of_fail] - 1)
+    sim_of_line = np.arange(n_lines) // concurrent
+    ev_sim = np.concatenate([sim_of_line, sim_of_line[line_of_fail[rebuy]], sim_of_line[paid]])
+    ev_t = np.concatenate([np.zeros(n_lines), cum[rebuy], pay_t[paid]])
+    ev_cash = np.concatenate([np.full(n_lines + int(rebuy.sum()), float(cost)), np.full(int(paid.sum()), -pay1)])
+    order = np.lexsort((-ev_cash, ev_t, ev_sim))  # a igual tiempo, primero las compras
+    cash = np.cumsum(ev_cash[order])
+    starts = np.searchsorted(ev_sim[order], np.arange(n_sims))
+    cash -= np.concatenate([[0.0], cash])[starts][ev_sim[order]]
+    peak = np.maximum.reduceat(cash, starts)
+
+    bought = np.bincount(sim_of_line, weights=attempts, minlength=n_sims)
+    first_pay = pay_t.reshape(n_sims, concurrent).min(axis=1)
+    got_paid = np.isfinite(first_pay)
+    return {
+        "concurrent": concurrent, "n_sims": n_sims, "prob_no_payout": float((~got_paid).mean() * 100),
+        "fees": hist_summary("purchases", hist_counts("purchases", bought), cost),
+        "months": hist_summary("months", hist_counts("months", first_pay[got_paid])) if got_paid.any() else None,
+        "peak": hist_summary("outlay", hist_counts("outlay", peak / cost), cost),
+        "avg_accounts": float(bought.mean())
+    }
+
+# --- MONTECARLO ADAPTATIVO ---
+Z_95 = 1.96
+
+def wilson_interval(successes, n, z=Z_95):
+    if n == 0: return 0.0, 1.0
+    p = successes / n
+    denom = 1 + z*z/n
+    center = (p + z*z/(2*n)) / denom
+    hw = (z / denom) * math.sqrt(p*(1-p)/n + z*z/(4*n*n))
+    return max(0.0, center - hw), min(1.0, center + hw)
+
+def adaptive_errors(account_data, strategy_params, counters):
+    # Semiancho del IC95% de prob_c1 (puntos %) y rango de net_profit dentro de ese IC
+    lo, hi = wilson_interval(counters['pass_c1'], counters['n_sims'])
+    nets = []
+    for p in (lo, hi):
+        c = dict(counters, pass_c1=round(p * counters['n_sims']))
+        nets.append(summarize_account(account_data, strategy_params, c)['net_profit'])
+    return (hi - lo) * 50.0, abs(nets[1] - nets[0]) / 2.0
+
+def run_portfolio_adaptive(jobs, target_hw, time_budget, seed=None, net_target=None, min_batch=250, max_sims=100000):
+    t0 = time.perf_counter()
+    rngs = [np.random.default_rng(np.random.SeedSequence() if seed is None else job_seed_sequence(acc, params, "adaptive", bal, seed)) for acc, params, bal in jobs]
+    counters = [None] * len(jobs)
+    errors = [(100.0, float('inf'))] * len(jobs)
+    active = list(range(len(jobs)))
+    # Ronda a ronda: cada cuenta no convergida corre un lote, hasta converger o agotar el tiempo
+    while active:
+        for j in list(active):
+            acc, params, bal = jobs[j]
+            c = counters[j]
+            if c is None: batch = min_batch
+            else:
+                # Tamaño estimado para llegar al objetivo, como mucho duplicando lo ya corrido
+                p = min(max(c['pass_c1'] / c['n_sims'], 0.01), 0.99)
+                n_needed = int(Z_95 * Z_95 * p * (1 - p) / (target_hw / 100.0) ** 2)
+                batch = max(min_batch, min(n_needed - c['n_sims'], c['n_sims']))
+            batch = min(batch, max_sims - (c['n_sims'] if c else 0))
+            new = simulate_account_counters(acc, params, batch, bal, rngs[j])
+            counters[j] = new if c is None else merge_counters(c, new)
+            errors[j] = adaptive_errors(acc, params, counters[j])
+            done = errors[j][0] <= target_hw and (net_target is None or errors[j][1] <= net_target)
+            if done or counters[j]['n_sims'] >= max_sims: active.remove(j)
+        if time.perf_counter() - t0 >= time_budget: break
+
+    results = []
+    for j, (acc, params, bal) in enumerate(jobs):
+        s = summarize_account(acc, params, counters[j])
+        s['n_sims_used'] = counters[j]['n_sims']
+        s['prob_c1_ci'] = errors[j][0]
+        s['net_profit_ci'] = errors[j][1]
+        results.append(s)
+    return results
+
+# --- BARRIDO DE PARÁMETROS ---
+SWEEP_PARAMS = {"win_rate": "WR %", "rr": "R:R", "risk": "Riesgo %", "withdrawal_target": "Meta Retiro %"}
+SWEEP_METRICS = {"prob_c1": "Prob. Cobro %", "net_profit": "Ganancia Neta $", "inventory": "Intentos", "time_c1": "Meses a Retiro 1"}
+
+def simulate_grid_counters(account_data, strategy_params, grid, n_sims, current_balance_real, entropy):
+    # grid: {param: array con un valor por punto}. Todos los puntos avanzan en un solo lote
+    # de (puntos x n_sims) caminos, compartiendo los aleatorios de cada simulación.
+    n_points = len(next(iter(grid.values())))
+    phase_rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(entropy).spawn(5)]
+    sl_min = 5; sl_max = 15; daily_dd = account_data.get('daily_dd', 100.0)
+    initial_size = account_data['size']
+    is_2step = account_data.get('profit_p2', 0) > 0
+    value = lambda name, pts: grid[name][pts] if name in grid else strategy_params[name]
+    rules = compile_rules(account_data)
+
+    def phase(k, pts, sims, start_bal, target_pct):
+        return simulate_phase_batch(pts.size, initial_size, start_bal, value('risk', pts), value('win_rate', pts), value('rr', pts), target_pct,
+                                    account_data['total_dd'], daily_dd, strategy_params['comm'], sl_min, sl_max, strategy_params['trades_day'], phase_rngs[k], draw_idx=sims, draw_width=n_sims, rules=rules)
+
+    counters = [{"n_sims": n_sims, "fail_reasons": {"Max Drawdown": 0, "Daily Drawdown": 0, "Timeout": 0, "Ya perdida (Real)": 0}, "dist": {}} for _ in range(n_points)]
+    def record(pts, ok, t, causes, pass_key, phase_key, tally):
+        for c, n, h in zip(counters, np.bincount(pts[ok], minlength=n_points), hist_counts("trades", t[ok], groups=pts[ok], n_groups=n_points)):
+            c[pass_key] = int(n); c['dist'][phase_key] = {"trades": h}
+        if tally:
+            fails = np.bincount(pts[~ok] * len(PHASE_CAUSES) + causes[~ok], minlength=n_points * len(PHASE_CAUSES)).reshape(n_points, -1)
+            for c, row in zip(counters, fails):
+                for code, name in enumerate(PHASE_CAUSES):
+                    if name in c['fail_reasons']: c['fail_reasons'][name] += int(row[code])
+        return pts[ok], sims[ok]
+
+    pts = np.repeat(np.arange(n_points), n_sims); sims = np.tile(np.arange(n_sims), n_points)
+    ok, t, _, cz = phase(0, pts, sims, current_balance_real, account_data['profit_p1'])
+    pts, sims = record(pts, ok, t, cz, 'pass_p1', 'p1', True)
+    if is_2step:
+        ok, t, _, cz = phase(1, pts, sims, initial_size, account_data['profit_p2'])
+        pts, sims = record(pts, ok, t, cz, 'pass_p2', 'p2', True)
+    else:
+        for c in counters: c['pass_p2'] = c['pass_p1']
+    for k, key, tally in ((2, 'c1', True), (3, 'c2', False), (4, 'c3', False)):
+        ok, t, _, cz = phase(k, pts, sims, initial_size, value('withdrawal_target', pts))
+        pts, sims = record(pts, ok, t, cz, 'pass_' + key, key, tally)
+    return counters
+
+def run_parameter_sweep(account_data, strategy_params, x_name, x_values, y_name, y_values, n_sims, start_bal, seed=None):
+    # Generador: rellena la rejilla de grueso a fino (paso 4, 2, 1) y rinde tras cada nivel.
+    # Cada nivel reutiliza la misma semilla, así los puntos son comparables entre niveles.
+    entropy = seed if seed is not None else np.random.SeedSequence().entropy
+    nx, ny = len(x_values), len(y_values)
+    grid = [[None] * nx for _ in range(ny)]
+    for stride in (4, 2, 1):
+        sel = [(iy, ix) for iy in range(0, ny, stride) for ix in range(0, nx, stride) if grid[iy][ix] is None]
+        if not sel: continue
+        pts = {x_name: np.array([x_values[ix] for _, ix in sel], dtype=float), y_name: np.array([y_values[iy] for iy, _ in sel], dtype=float)}
+        for (iy, ix), c in zip(sel, simulate_grid_counters(account_data, strategy_params, pts, n_sims, start_bal, entropy)):
+            grid[iy][ix] = summarize_account(account_data, dict(strategy_params, **{x_name: x_values[ix], y_name: y_values[iy]}), c)
+        yield stride, grid
+
+# --- OPTIMIZADOR DE RIESGO / META DE RETIRO ---
+OPT_PARAMS = {"risk": (0.1, 5.0, 0.1), "withdrawal_target": (0.5, 20.0, 0.5)}  # mín, máx y paso de los widgets rk/wt
+OPT_METRICS = {"net_profit": "Ganancia Neta $", "prob_c1": "Prob. Cobro %"}
+
+def optimizer_candidates(ranges, n, rng):
+    # Hipercubo latino sobre los rangos, redondeado al paso del widget y sin duplicados
+    cols = []
+    for name, (lo, hi) in ranges.items():
+        p_min, p_max, step = OPT_PARAMS[name]
+        u = (rng.permutation(n) + rng.random(n)) / n
+        cols.append(np.clip(np.round((lo + (hi - lo) * u) / step) * step, p_min, p_max))
+    pts = np.unique(np.round(np.column_stack(cols), 6), axis=0)
+    return {name: pts[:, i] for i, name in enumerate(ranges)}
+
+def iter_optimize_account(account_data, strategy_params, start_bal, metric="net_profit", ranges=None, n_candidates=32, min_batch=200, max_sims=20000, seed=None):
+    # Successive halving con números aleatorios comunes: en cada ronda los candidatos vivos corren
+    # un lote nuevo compartiendo simulaciones (comparación pareada), se descartan los claramente
+    # peores que el mejor (IC95% sin solape) y como mucho se queda la mitad; el lote se duplica.
+    # Rinde tras cada ronda {"round", "candidates", "sims", "ranking"}; ranking = vivos, mejor primero.
+    ranges = ranges or {k: v[:2] for k, v in OPT_PARAMS.items()}
+    key = int(sim_cache_key(account_data, strategy_params, "optimize", start_bal, None)[:16], 16)
+    base = [np.random.SeedSequence().entropy if seed is None else seed, key]
+    pts = optimizer_candidates(ranges, n_candidates, np.random.default_rng(base))
+    n_pts = len(next(iter(pts.values())))
+    alive = np.arange(n_pts); counters = [None] * n_pts
+    batch = min_batch; sims = 0
+    for rnd in itertools.count():
+        new = simulate_grid_counters(account_data, strategy_params, {k: v[alive] for k, v in pts.items()}, batch, start_bal, base + [rnd])
+        sims += batch * alive.size
+        rows = []
+        for j, c in zip(alive, new):
+            counters[j] = c if counters[j] is None else merge_counters(counters[j], c)
+            params = dict(strategy_params, **{k: float(v[j]) for k, v in pts.items()})
+            prob_hw, net_hw = adaptive_errors(account_data, params, counters[j])
+            stats = summarize_account(account_data, params, counters[j])
+            rows.append({"index": int(j), "params": {k: float(v[j]) for k, v in pts.items()}, "value": stats[metric],
+                         "ci": prob_hw if metric == "prob_c1" else net_hw, "n_sims": counters[j]['n_sims'], "stats": stats})
+        rows.sort(key=lambda r: (-r['value'], -r['stats']['prob_c1']))  # net_profit va a escalones: desempata la prob. de cobro
+        best_lo = rows[0]['value'] - rows[0]['ci']
+        rows = [r for r in rows if r['value'] + r['ci'] >= best_lo][:max(math.ceil(len(rows) / 2), 1)]
+        yield {"round": rnd, "candidates": n_pts, "sims": sims, "ranking": rows}
+        alive = np.array([r['index'] for r in rows])
+        if alive.size == 1 or counters[alive[0]]['n_sims'] + 2 * batch > max_sims: break
+        batch *= 2
+
+def run_optimizer(jobs, metric, time_budget, ranges=None, n_candidates=32, seed=None):
+    # Optimiza cada cuenta por separado (las cuentas no comparten parámetros, así que el óptimo del
+    # portafolio es el de cada cuenta). El presupuesto se reparte entre cuentas y el tiempo que
+    # sobra de una pasa a las siguientes. Rinde (j, ronda) tras cada ronda de cada cuenta.
+    t0 = time.perf_counter()
+    for j, (acc, params, bal) in enumerate(jobs):
+        deadline = t0 + time_budget * (j + 1) / len(jobs)
+        for info in iter_optimize_account(acc, params, bal, metric, ranges, n_candidates, seed=seed):
+            yield j, info
+            if time.perf_counter() >= deadline: break
+
+# --- PORTAFOLIO CONJUNTO ---
+JOINT_PHASES = ("p1", "p2", "c1", "c2", "c3")
+
+def account_columns(jobs, n_payouts):
+    # Parámetros y reglas compiladas como columnas (una fila por cuenta) para los motores que avanzan
+    # todas las cuentas en el mismo lote; targets = metas de P1, P2 y n_payouts retiros
+    col = lambda f: np.array([f(acc, params, bal) for acc, params, bal in jobs], dtype=float)
+    tpd = col(lambda a, p, b: p['trades_day'])
+    if (tpd != np.round(tpd)).any() or (tpd < 1).any(): raise ValueError("trades_day debe ser entero >= 1 (ver parametric_params)")
+    size = col(lambda a, p, b: a['size'])
+    targets = np.array([[a['profit_p1'], a.get('profit_p2', 0)] + [p['withdrawal_target']] * n_payouts for a, p, _ in jobs], dtype=float)
+    limit = size * (1 - col(lambda a, p, b: a['total_dd']) / 100)
+    risk_money = size * col(lambda a, p, b: p['risk']) / 100
+    rules = [compile_rules(a) for a, _, _ in jobs]
+    rule_col = lambda f: np.array([f(r) for r in rules])
+    c = {"size": size, "two_step": col(lambda a, p, b: a.get('profit_p2', 0) > 0).astype(bool), "targets": size[:, None] * (1 + targets / 100),
+         "limit": limit, "daily_amt": size * col(lambda a, p, b: a.get('daily_dd', 100.0)) / 100, "risk_money": risk_money,
+         "win_gain": risk_money * col(lambda a, p, b: p['rr']), "p_win": col(lambda a, p, b: p['win_rate']) / 100, "comm": col(lambda a, p, b: p['comm']),
+         "tpd": tpd.astype(np.int64), "dd_amount": size - limit,
+         "pip_val": rule_col(lambda r: r.pip_val), "max_trades": rule_col(lambda r: r.max_trades),
+         "trailing": rule_col(lambda r: r.trailing), "trail_lock": rule_col(lambda r: r.trail_lock),
+         "daily_equity": rule_col(lambda r: r.daily_equity), "min_days": rule_col(lambda r: r.min_days),
+         "consistency": rule_col(lambda r: np.inf if r.consistency is None else r.consistency)}
+    # Cada regla solo se evalúa si alguna cuenta la usa
+    c["active"] = {"hwm": c['trailing'].any(), "day_peak": c['daily_equity'].any(), "days": bool(c['min_days'].any()), "best_day": np.isfinite(c['consistency']).any()}
+    return c
+
+def rule_state(c, curr):
+    state = {"hwm": curr.copy(), "day_peak": curr.copy(), "days": np.zeros(curr.size, dtype=np.int64), "best_day": np.zeros(curr.size)}
+    return {k: v for k, v in state.items() if c['active'][k]}
+
+def joint_trade(c, state, a, u, curr, day_start, ph_start, target, act=None):
+    # Un trade WR/RR por camino (a = cuenta de cada camino) y chequeo de reglas sobre curr (in situ).
+    # act enmascara los caminos que no operan este trade. Devuelve (dd_hit, daily_hit, success)
+    sl_min = 5; sl_max = 15
+    current_sl = sl_min + (sl_max - sl_min) * u[0]
+    risk_money = c['risk_money'][a]
+    trade_comm = (risk_money / (current_sl * c['pip_val'][a])) * c['comm'][a]
+    slippage = 0.95 + 0.10 * u[1]
+    loss = (risk_money * slippage + trade_comm) * np.where(u[2] < 0.01, 1.5, 1.0)
+    pnl = np.where(u[3] < c['p_win'][a], c['win_gain'][a] * slippage - trade_comm, -loss)
+    curr += pnl if act is None else np.where(act, pnl, 0.0)
+
+    floor = c['limit'][a]
+    if "hwm" in state:
+        hwm = np.maximum(state["hwm"], curr, out=state["hwm"])
+        trail_floor = hwm - c['dd_amount'][a]
+        trail_floor = np.where(c['trail_lock'][a], np.minimum(trail_floor, c['size'][a]), trail_floor)
+        floor = np.where(c['trailing'][a], trail_floor, floor)
+    dd_hit = curr <= floor
+    day_ref = day_start
+    if "day_peak" in state:
+        np.maximum(state["day_peak"], curr, out=state["day_peak"])
+        day_ref = np.where(c['daily_equity'][a], state["day_peak"], day_start)
+    daily_hit = ~dd_hit & ((day_ref - curr) >= c['daily_amt'][a])
+    success = curr >= target
+    if "days" in state: success &= state["days"] >= c['min_days'][a]
+    if "best_day" in state:
+        consistency = c['consistency'][a]; capped = np.isfinite(consistency)
+        best = np.maximum(state["best_day"], curr - day_start)  # días cerrados + el día en curso
+        success &= ~capped | (best <= np.where(capped, consistency, 0.0) * (curr - ph_start))
+    return dd_hit, daily_hit, success
+
+def simulate_joint_counters(jobs, n_sims, rng, rho=1.0):
+    # Todas las cuentas x simulaciones en un solo lote que avanza en tiempo de calendario: en el
+    # trade global t, las cuentas vivas de la simulación s operan el mismo trade (aleatorios
+    # compartidos por s) con probabilidad rho, o uno propio si no (correlación rho entre cuentas).
+    # Cada camino recorre su ciclo P1 -> P2 -> C1 -> C2 -> C3 dentro del lote; el reset diario y el
+    # Timeout son relativos a la fase, igual que en simulate_account_counters.
+    # Devuelve (contadores por cuenta, contadores conjuntos); ambos se fusionan con merge_counters.
+    t0 = time.perf_counter()
+    n_acc = len(jobs); n_ph = len(JOINT_PHASES); n_causes = len(PHASE_CAUSES)
+    c = account_columns(jobs, 3)
+    size = c['size']; two_step = c['two_step']; tgt_table = c['targets']; limit = c['limit']; tpd = c['tpd']; max_trades = c['max_trades']
+
+    acc_i = np.repeat(np.arange(n_acc), n_sims); sim_i = np.tile(np.arange(n_sims), n_acc)
+    curr = np.repeat(np.array([b for _, _, b in jobs], dtype=float), n_sims)
+    ph = np.zeros(acc_i.size, dtype=np.int64)
+    t_ph = np.zeros(acc_i.size, dtype=np.int64); elapsed = np.zeros(acc_i.size, dtype=np.int64)
+    day_start = curr.copy(); wdd = np.zeros(acc_i.size); ph_start = curr.copy()
+    state = rule_state(c, curr)
+    events = []  # (cuenta, sim, fase, trades en fase, equity final, peor DD, causa, trades acumulados)
+
+    def settle(ended, causes):
+        # Registra los caminos que terminan fase; los que la pasan siguen con la siguiente
+        nonlocal acc_i, sim_i, curr, ph, t_ph, elapsed, day_start, wdd, ph_start
+        events.append((acc_i[ended], sim_i[ended], ph[ended], t_ph[ended], curr[ended], wdd[ended], causes[ended], elapsed[ended]))
+        passed = ended & ((causes == C_SUCCESS) | (causes == C_WON)) & (ph < n_ph - 1)
+        nxt = ph[passed] + 1
+        ph[passed] = np.where((nxt == 1) & ~two_step[acc_i[passed]], 2, nxt)
+        curr[passed] = size[acc_i[passed]]; t_ph[passed] = 0; wdd[passed] = 0.0; ph_start[passed] = curr[passed]; day_start[passed] = curr[passed]
+        for k, v in state.items(): v[passed] = curr[passed] if k == "hwm" else 0
+        keep = ~ended | passed
+        acc_i = acc_i[keep]; sim_i = sim_i[keep]; curr = curr[keep]; ph = ph[keep]
+        t_ph = t_ph[keep]; elapsed = elapsed[keep]; day_start = day_start[keep]; wdd = wdd[keep]; ph_start = ph_start[keep]
+        for k in state: state[k] = state[k][keep]
+
+    # Fase 1 ya perdida / ya ganada desde el balance de partida
+    lost = curr <= limit[acc_i]
+    won = ~lost & (curr >= tgt_table[acc_i, 0])
+    if (lost | won).any(): settle(lost | won, np.where(lost, C_LOST, C_WON))
+
+    while acc_i.size:
+        reset = t_ph % tpd[acc_i] == 0
+        if "best_day" in state: state["best_day"] = np.where(reset, np.maximum(state["best_day"], curr - day_start), state["best_day"])
+        day_start = np.where(reset, curr, day_start)
+        if "day_peak" in state: state["day_peak"] = np.where(reset, curr, state["day_peak"])
+        if "days" in state: state["days"] += reset
+        u = rng.random((4, n_sims))[:, sim_i]
+        if rho < 1.0:
+            own = (rng.random(n_sims) >= rho)[sim_i]
+            u[:, own] = rng.random((4, int(own.sum())))
+        a = acc_i
+        dd_hit, daily_hit, success = joint_trade(c, state, a, u, curr, day_start, ph_start, tgt_table[a, ph])
+        t_ph += 1; elapsed += 1
+        np.maximum(wdd, day_start - curr, out=wdd)
+        timeout = t_ph >= max_trades[a]
+        ended = dd_hit | daily_hit | success | timeout
+        if ended.any():
+            settle(ended, np.where(dd_hit, C_MAX_DD, np.where(daily_hit, C_DAILY_DD, np.where(success, C_SUCCESS, C_TIMEOUT))))
+
+    ev_acc, ev_sim, ev_ph, ev_t, ev_final, ev_wdd, ev_cause, ev_elapsed = [np.concatenate(x) for x in zip(*events)] if events else [np.zeros(0, dtype=np.int64)] * 8
+    key = ev_acc * n_ph + ev_ph
+    ok = (ev_cause == C_SUCCESS) | (ev_cause == C_WON)
+    groups = n_acc * n_ph
+    n_pass = np.bincount(key[ok], minlength=groups).reshape(n_acc, n_ph)
+    n_ended = np.bincount(key, minlength=groups).reshape(n_acc, n_ph)
+    ph_trades = np.bincount(key, weights=ev_t, minlength=groups).reshape(n_acc, n_ph)
+    cause_counts = np.bincount(key * n_causes + ev_cause, minlength=groups * n_causes).reshape(n_acc, n_ph, n_causes).astype(np.int64)
+    trades_h = hist_counts("trades", ev_t[ok], groups=key[ok], n_groups=groups).reshape(n_acc, n_ph, -1)
+    equity_h = hist_counts("equity", (ev_final / size[ev_acc] - 1) * 100, groups=key, n_groups=groups).reshape(n_acc, n_ph, -1)
+    dd_h = hist_counts("daily_dd", ev_wdd / size[ev_acc] * 100, groups=key, n_groups=groups).reshape(n_acc, n_ph, -1)
+    paid = ok & (ev_ph >= 2)
+    timeline_h = hist_counts("timeline", ev_elapsed[paid], groups=key[paid], n_groups=groups).reshape(n_acc, n_ph, -1)
+    lost = ~ok & (ev_ph <= 2)  # intentos perdidos antes del retiro 1
+    fail_h = hist_counts("timeline", ev_elapsed[lost], groups=ev_acc[lost], n_groups=n_acc)
+
+    # El tiempo de pared se reparte entre cuentas y fases según los trades simulados
+    wall = time.perf_counter() - t0; total_trades = max(float(ph_trades.sum()), 1.0)
+    counters = []
+    for j in range(n_acc):
+        phases = range(n_ph) if two_step[j] else (0, 2, 3, 4)
+        fails = cause_counts[j, :3].sum(axis=0)
+        counters.append({
+            "n_sims": n_sims,
+            "pass_p1": int(n_pass[j, 0]), "pass_p2": int(n_pass[j, 1] if two_step[j] else n_pass[j, 0]),
+            "pass_c1": int(n_pass[j, 2]), "pass_c2": int(n_pass[j, 3]), "pass_c3": int(n_pass[j, 4]),
+            "fail_reasons": {name: int(fails[code]) for code, name in enumerate(PHASE_CAUSES) if code in (C_MAX_DD, C_DAILY_DD, C_TIMEOUT, C_LOST)},
+            "dist": {JOINT_PHASES[k]: {"trades": trades_h[j, k], "equity": equity_h[j, k], "daily_dd": dd_h[j, k]} for k in phases},
+            "timeline": dict({JOINT_PHASES[k]: timeline_h[j, k] for k in (2, 3, 4)}, fail=fail_h[j]),
+            "diag": {JOINT_PHASES[k]: {"time": wall * ph_trades[j, k] / total_trades, "paths": int(n_ended[j, k]), "trades": int(ph_trades[j, k]),
+                                       "causes": {name: int(cause_counts[j, k, code]) for code, name in enumerate(PHASE_CAUSES)}} for k in phases}
+        })
+
+    # Resultado conjunto por simulación: cobro total y nº de cuentas que llegan al retiro 1
+    pay_table = np.array([payout_values(a, p) for a, p, _ in jobs], dtype=float).reshape(n_acc, 3)
+    total_pay = np.bincount(ev_sim[paid], weights=pay_table[ev_acc[paid], ev_ph[paid] - 2], minlength=n_sims)
+    n_paid = np.bincount(ev_sim[ok & (ev_ph == 2)], minlength=n_sims)
+    max_pay = max(float(pay_table.sum()), 1e-9)
+    joint = {"n_sims": n_sims, "all_fail": int((n_paid == 0).sum()), "all_paid": int((n_paid == n_acc).sum()),
+             "loss": int((total_pay < sum(a['cost'] for a, _, _ in jobs)).sum()),
+             "paid_accounts": np.bincount(n_paid, minlength=n_acc + 1), "payout": hist_counts("share", total_pay / max_pay * 100)}
+    return counters, joint
+
+def summarize_joint(jobs, joint, stats):
+    # Métricas de portafolio; prob_all_fail_indep es lo que se supondría con cuentas independientes
+    n = joint['n_sims']
+    max_pay = sum(sum(payout_values(a, p)) for a, p, _ in jobs)
+    return {
+        "rho": joint.get('rho'), "n_sims": n, "accounts": len(jobs),
+        "prob_all_fail": joint['all_fail'] / n * 100, "prob_all_paid": joint['all_paid'] / n * 100, "prob_loss": joint['loss'] / n * 100,
+        "prob_all_fail_indep": float(np.prod([1 - s['prob_c1'] / 100 for s in stats])) * 100,
+        "paid_accounts": (np.asarray(joint['paid_accounts']) / n * 100).tolist(),
+        "payout": hist_summary("share", joint['payout'], max_pay / 100),
+        "total_cost": sum(a['cost'] for a, _, _ in jobs), "max_payout": max_pay
+    }
+
+def _run_joint_chunk(task):
+    jobs, n, rho, seed_seq = task
+    return simulate_joint_counters(jobs, n, np.random.default_rng(seed_seq), rho)
+
+def run_portfolio_joint(jobs, n_sims, rho=1.0, seed=None, n_workers=1, pool=None):
+    # Bloques de SIM_CHUNK simulaciones del portafolio completo; semilla derivada del portafolio
+    if seed is None: root = np.random.SeedSequence()
+    else: root = np.random.SeedSequence([seed, int(sim_cache_key({"jobs": jobs}, {"rho": rho}, n_sims, 0, "joint")[:16], 16)])
+    sizes = [SIM_CHUNK] * (n_sims // SIM_CHUNK) + ([n_sims % SIM_CHUNK] if n_sims % SIM_CHUNK else [])
+    tasks = [(jobs, n, rho, seq) for n, seq in zip(sizes, root.spawn(len(sizes)))]
+    merged = None
+    for c in iter_chunk_results(tasks, n_workers, worker=_run_joint_chunk, pool=pool):
+        merged = c if merged is None else ([merge_counters(a, b) for a, b in zip(merged[0], c[0])], merge_counters(merged[1], c[1]))
+    counters, joint = merged
+    stats = [summarize_account(acc, params, c) for (acc, params, _), c in zip(jobs, counters)]
+    return stats, summarize_joint(jobs, dict(joint, rho=rho), stats)
+
+# --- HORIZONTE EN CALENDARIO ---
+# Ciclo de vida P1 -> P2 -> retiros 1..n_payouts sobre días hábiles reales: cada día los caminos vivos
+# operan hasta trades_day trades y quien pasa una etapa empieza la siguiente el día hábil siguiente
+# desde el tamaño de la cuenta. Los caminos que fallan o cobran el último retiro salen del lote, así
+# cada día cuesta lo que sus caminos vivos. La caja se acumula por mes de calendario.
+HORIZON_MONTHS = 12
+HORIZON_PAYOUTS = 12
+HORIZON_CHUNK = 2500  # sims por bloque: el bucle es por trade del calendario, bloques grandes amortizan el Python
+
+def horizon_calendar(months=HORIZON_MONTHS, start=None, holidays=()):
+    # Días hábiles de [start, start + months meses) (start = hoy) y su mes del horizonte: exactamente months
+    # periodos que empiezan el mismo día del mes que start (recortado al último día en meses más cortos)
+    start = np.busday_offset(np.datetime64(start or 'today', 'D'), 0, roll='forward', holidays=holidays)
+    first = start.astype('M8[M]'); offset = start - first.astype('M8[D]')
+    month_starts = (first + np.arange(months + 1)).astype('M8[D]')
+    bounds = np.minimum(month_starts + offset, (first + np.arange(1, months + 2)).astype('M8[D]') - 1)
+    days = np.arange(bounds[0], bounds[-1], dtype='M8[D]')
+    days = days[np.is_busday(days, holidays=holidays)]
+    labels = [str(d) for d in bounds[:-1]] if offset else [str(first + m) for m in range(months)]
+    return np.searchsorted(bounds[1:-1], days, side='right').astype(np.int64), labels
+
+def horizon_cash_range(jobs, n_payouts):
+    # Caja neta acumulada posible por cuenta: de -coste (ningún retiro) a todos los retiros cobrados menos el coste
+    pays = np.array([payout_values(a, p)[:2] for a, p, _ in jobs], dtype=float).reshape(len(jobs), 2)
+    cost = np.array([a['cost'] for a, _, _ in jobs], dtype=float)
+    return -cost, pays[:, 0] + (n_payouts - 1) * pays[:, 1] - cost
+
+def simulate_horizon_counters(jobs, n_sims, rng, day_month, n_months, n_payouts=HORIZON_PAYOUTS, rho=0.0):
+    # Todas las cuentas x simulaciones avanzan por el calendario (day_month = mes de cada día hábil);
+    # rho como en simulate_joint_counters (0 = cuentas independientes). Caja por simulación: el coste
+    # de la cuenta en el mes 0 y cada retiro en el mes en que se cobra. Contadores para merge_counters.
+    n_acc = len(jobs); n_st = 2 + n_payouts
+    c = account_columns(jobs, n_payouts)
+    size = c['size']; two_step = c['two_step']; tgt_table = c['targets']; tpd = c['tpd']; max_trades = c['max_trades']
+    tpd_min = int(tpd.min()); tpd_max = int(tpd.max())
+
+    acc_i = np.repeat(np.arange(n_acc), n_sims); sim_i = np.tile(np.arange(n_sims), n_acc)
+    curr = np.repeat(np.array([b for _, _, b in jobs], dtype=float), n_sims)
+    st_i = np.zeros(acc_i.size, dtype=np.int64); t_st = np.zeros(acc_i.size, dtype=np.int64)
+    day_start = curr.copy(); ph_start = curr.copy(); waiting = np.zeros(acc_i.size, dtype=bool)
+    state = rule_state(c, curr)
+    events = []  # (cuenta, sim, etapa, día, causa)
+    day = 0
+
+    def settle(ended, causes):
+        # Los que pasan etapa esperan al día siguiente; los que fallan o terminan salen del lote
+        nonlocal acc_i, sim_i, curr, st_i, t_st, day_start, ph_start, waiting
+        events.append((acc_i[ended], sim_i[ended], st_i[ended], np.full(int(ended.sum()), day), causes[ended]))
+        passed = ended & ((causes == C_SUCCESS) | (causes == C_WON)) & (st_i < n_st - 1)
+        nxt = st_i[passed] + 1
+        st_i[passed] = np.where((nxt == 1) & ~two_step[acc_i[passed]], 2, nxt)
+        curr[passed] = size[acc_i[passed]]; t_st[passed] = 0; ph_start[passed] = curr[passed]; day_start[passed] = curr[passed]
+        waiting[passed] = True
+        for k, v in state.items(): v[passed] = curr[passed] if k == "hwm" else 0
+        keep = ~ended | passed
+        acc_i = acc_i[keep]; sim_i = sim_i[keep]; curr = curr[keep]; st_i = st_i[keep]
+        t_st = t_st[keep]; day_start = day_start[keep]; ph_start = ph_start[keep]; waiting = waiting[keep]
+        for k in state: state[k] = state[k][keep]
+
+    lost = curr <= c['limit'][acc_i]
+    won = ~lost & (curr >= tgt_table[acc_i, 0])
+    if (lost | won).any(): settle(lost | won, np.where(lost, C_LOST, C_WON))
+
+    for day in range(day_month.size):
+        if not acc_i.size: break
+        waiting[:] = False
+        if "best_day" in state: np.maximum(state["best_day"], curr - day_start, out=state["best_day"])
+        day_start = curr.copy()
+        if "day_peak" in state: state["day_peak"] = curr.copy()
+        if "days" in state: state["days"] += 1
+        for k in range(tpd_max):
+            # act = None -> operan todos los caminos vivos (caso común, sin máscara)
+            act = None if k < tpd_min else k < tpd[acc_i]
+            if waiting.any(): act = ~waiting if act is None else act & ~waiting
+            if act is not None and not act.any(): break
+            if rho > 0:
+                u = rng.random((4, n_sims))[:, sim_i]
+                if rho < 1.0:
+                    own = (rng.random(n_sims) >= rho)[sim_i]
+                    u[:, own] = rng.random((4, int(own.sum())))
+            else: u = rng.random((4, acc_i.size))
+            a = acc_i
+            dd_hit, daily_hit, success = joint_trade(c, state, a, u, curr, day_start, ph_start, tgt_table[a, st_i], act)
+            t_st += 1 if act is None else act
+            ended = dd_hit | daily_hit | success | (t_st >= max_trades[a])
+            if act is not None: ended &= act
+            if ended.any():
+                settle(ended, np.where(dd_hit, C_MAX_DD, np.where(daily_hit, C_DAILY_DD, np.where(success, C_SUCCESS, C_TIMEOUT))))
+
+    ev_acc, ev_sim, ev_st, ev_day, ev_cause = [np.concatenate(x) for x in zip(*events)] if events else [np.zeros(0, dtype=np.int64)] * 5
+    ok = (ev_cause == C_SUCCESS) | (ev_cause == C_WON)
+    ev_month = day_month[ev_day]
+    n_pass = np.bincount(ev_acc[ok] * n_st + ev_st[ok], minlength=n_acc * n_st).reshape(n_acc, n_st)
+    failed = np.bincount(ev_acc[~ok] * n_months + ev_month[~ok], minlength=n_acc * n_months).reshape(n_acc, n_months)
+
+    # Caja (cuenta, sim, mes): retiro 1 con reembolso y bonus, split en los siguientes; coste en el mes 0
+    pays = np.array([payout_values(a, p)[:2] for a, p, _ in jobs], dtype=float).reshape(n_acc, 2)
+    paid = ok & (ev_st >= 2)
+    cell = (ev_acc[paid] * n_sims + ev_sim[paid]) * n_months + ev_month[paid]
+    cash = np.bincount(cell, weights=pays[ev_acc[paid], np.minimum(ev_st[paid] - 2, 1)], minlength=n_acc * n_sims * n_months).reshape(n_acc, n_sims, n_months)
+    lo, hi = horizon_cash_range(jobs, n_payouts)
+    cash[:, :, 0] += lo[:, None]
+    cum = np.cumsum(cash, axis=2)
+    # Acumulado en % de su rango posible: el histograma fijo cubre cualquier tamaño de retiro sin recortar
+    groups = np.repeat(np.arange(n_acc * n_months), n_sims)
+    cum_h = hist_counts("cash", ((cum - lo[:, None, None]) / (hi - lo)[:, None, None] * 100).transpose(0, 2, 1).ravel(), groups=groups, n_groups=n_acc * n_months)
+    port_h = hist_counts("cash", ((cum.sum(axis=0) - lo.sum()) / (hi - lo).sum() * 100).T.ravel(), groups=groups[:n_months * n_sims], n_groups=n_months)
+    return {"n_sims": n_sims, "pass": n_pass, "failed": failed, "flow": cash.sum(axis=1),
+            "cum": cum_h.reshape(n_acc, n_months, -1), "portfolio_cum": port_h}
+
+def summarize_horizon(jobs, counters, months):
+    # Curvas mensuales medias (flujo y acumulado) y P10/P50/P90 del acumulado, por cuenta y del portafolio
+    n = counters['n_sims']
+    lo, hi = horizon_cash_range(jobs, np.shape(counters['pass'])[1] - 2)
+    def curves(flow, cum_h, lo, hi):
+        mean_flow = np.asarray(flow, dtype=float) / n
+        rows = [hist_summary("cash", h, (hi - lo) / 100) for h in cum_h]
+        out = {"flow": mean_flow.tolist(), "cum": np.cumsum(mean_flow).tolist()}
+        out.update({f"p{round(q * 100)}": [lo + r[f"p{round(q * 100)}"] for r in rows] for q in DIST_QUANTILES})
+        return out
+    accounts = []
+    for j, (acc, _, _) in enumerate(jobs):
+        passes = np.asarray(counters['pass'][j], dtype=float)
+        accounts.append(dict(curves(counters['flow'][j], counters['cum'][j], float(lo[j]), float(hi[j])),
+                             prob_funded=passes[1 if acc.get('profit_p2', 0) > 0 else 0] / n * 100,
+                             prob_payouts=(passes[2:] / n * 100).tolist(), exp_payouts=float(passes[2:].sum() / n),
+                             prob_failed=(np.cumsum(counters['failed'][j]) / n * 100).tolist()))
+    portfolio = dict(curves(np.sum(counters['flow'], axis=0), counters['portfolio_cum'], float(lo.sum()), float(hi.sum())),
+                     total_cost=sum(a['cost'] for a, _, _ in jobs), exp_payouts=sum(a['exp_payouts'] for a in accounts))
+    return {"months": months, "n_sims": n, "n_payouts": len(accounts[0]['prob_payouts']) if accounts else 0, "accounts": accounts, "portfolio": portfolio}
+
+def _run_horizon_chunk(task):
+    jobs, n, day_month, n_months, n_payouts, rho, seed_seq = task
+    return simulate_horizon_counters(jobs, n, np.random.default_rng(seed_seq), day_month, n_months, n_payouts, rho)
+
+def run_portfolio_horizon(jobs, n_sims, months=HORIZON_MONTHS, n_payouts=HORIZON_PAYOUTS, rho=0.0, seed=None, n_workers=1, start=None, holidays=(), pool=None):
+    day_month, labels = horizon_calendar(months, start, holidays)
+    if seed is None: root = np.random.SeedSequence()
+    else: root = np.random.SeedSequence([seed, int(sim_cache_key({"jobs": jobs}, {"rho": rho, "months": months, "n_payouts": n_payouts}, n_sims, 0, "horizon")[:16], 16)])
+    sizes = [HORIZON_CHUNK] * (n_sims // HORIZON_CHUNK) + ([n_sims % HORIZON_CHUNK] if n_sims % HORIZON_CHUNK else [])
+    tasks = [(jobs, n, day_month, len(labels), n_payouts, rho, seq) for n, seq in zip(sizes, root.spawn(len(sizes)))]
+    merged = None
+    for c in iter_chunk_results(tasks, n_workers, worker=_run_horizon_chunk, pool=pool):
+        merged = c if merged is None else merge_counters(merged, c)
+    return summarize_horizon(jobs, merged, labels)
@@ -0,0 +1,27 @@
+import json
+
+import pytest
+from sqlalchemy import text
+
+import db
+
+@pytest.fixture
+def engine(tmp_path):
+    eng = db.make_engine(f"sqlite:///{tmp_path / 'app.db'}")
+    yield eng
+    eng.dispose()
+
+def account(acc_id, name):
+    return {"id": acc_id, "full_name": name, "data": {"cost": 78, "size": 10000, "daily_dd": 5.0, "total_dd": 10.0, "profit_p1": 8.0, "profit_p2": 5.0},
+            "params": {"win_rate": 45, "rr": 2.0, "risk": 1.0, "withdrawal_target": 3.0, "trades_day": 3, "comm": 7.0}, "journal": []}
+
+def test_legacy_portfolio_not_restored_after_deleting_all_accounts(engine):
+    cache = db.ReadCache(db.READ_CACHE_TTL)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO user_portfolios (username, portfolio_json) VALUES (:u, :p)"), {"u": "u", "p": json.dumps([account(1, "Legacy")])})
+    portfolio = db.fetch_portfolio(engine, "u")
+    assert [item['full_name'] for item in portfolio] == ["Legacy"]
+    assert db.write_portfolio(engine, cache, "u", portfolio)
+    assert [item['full_name'] for item in db.fetch_portfolio(engine, "u")] == ["Legacy"]
+    assert db.write_portfolio(engine, cache, "u", [])
+    assert db.fetch_portfolio(engine, "u") == []
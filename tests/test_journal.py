@@ -0,0 +1,17 @@
+import io
+
+from journal import iter_import_chunks
+
+def test_semicolon_csv_with_decimal_comma():
+    # Exportación europea: ';' como separador y coma decimal; las filas ilegibles se cuentan, no se pierden en silencio
+    data = "Ticket;Time;Profit;Commission\n1;2024-01-01;12,50;-1,00\n2;2024-01-02;-40,00;0\n3;2024-01-03;n/d;0\n4;2024-01-04;1.234,56;0\n"
+    chunks = list(iter_import_chunks(io.BytesIO(data.encode())))
+    assert [g for df in chunks for g in df["gross"]] == [12.5, -40.0, 1234.56]
+    assert [n for df in chunks for n in df["net"]] == [11.5, -40.0, 1234.56]
+    assert sum(df.attrs["skipped"] for df in chunks) == 1
+
+def test_comma_thousands_with_dot_decimal():
+    data = "ticket,close time,commission,swap,profit\n1,2024-01-01,-1,0,\"1,234.50\"\n2,2024-01-02,0,0,-3.25\n"
+    df = next(iter_import_chunks(io.BytesIO(data.encode())))
+    assert df["gross"].tolist() == [1234.5, -3.25]
+    assert df.attrs["skipped"] == 0
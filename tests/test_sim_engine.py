@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+
+from sim_engine import EmpiricalPnL, account_columns, compile_rules, empirical_params, horizon_calendar, horizon_cash_range, load_catalog, make_worker_pool, parametric_params, payout_values, run_account_markov, run_account_simulation, run_portfolio_horizon, run_portfolio_simulation, simulate_grid_counters, simulate_phase_batch, simulate_purchases, validate_account
+
+PARAMS = {"win_rate": 45, "rr": 2.0, "risk": 1.0, "withdrawal_target": 3.0, "comm": 7.0, "trades_day": 3}
+
+def account(size="10K", **overrides):
+    return dict(load_catalog()["The5ers"]["High Stakes (2 Step)"][size], **overrides)
+
+def test_markov_expected_trades_match_montecarlo():
+    acc = account()
+    exact = run_account_markov(acc, PARAMS, acc['size'])
+    mc = run_account_simulation(acc, PARAMS, 20000, acc['size'], np.random.default_rng(1))
+    to_pay = 0.0
+    for ph in ("p1", "p2", "c1", "c2", "c3"):
+        mc_mean = mc['dist'][ph]['months']['mean'] * PARAMS['trades_day'] * 20
+        assert abs(exact['exp_trades'][ph]['success'] - mc_mean) <= 0.05 * mc_mean + 1
+        assert exact['exp_trades'][ph]['attempt'] > 0
+        to_pay += exact['exp_trades'][ph]['success']
+        if ph.startswith("c"): assert exact['exp_trades_payout'][ph] == to_pay
+
+def test_grid_point_does_not_depend_on_batch():
+    # Números aleatorios comunes: el resultado de un punto es el mismo con o sin otros puntos en el
+    # lote, aunque la última simulación muera antes en unos puntos que en otros (pocas sims, varias semillas)
+    acc = account()
+    for seed in range(20):
+        alone = simulate_grid_counters(acc, PARAMS, {"risk": np.array([1.0])}, 20, acc['size'], seed)[0]
+        for others in ([0.25, 1.0], [1.0, 3.0, 5.0]):
+            shared = simulate_grid_counters(acc, PARAMS, {"risk": np.array(others)}, 20, acc['size'], seed)[others.index(1.0)]
+            for key in ("pass_p1", "pass_p2", "pass_c1", "pass_c2", "pass_c3", "fail_reasons"):
+                assert shared[key] == alone[key]
+            for ph, d in alone['dist'].items():
+                assert np.array_equal(shared['dist'][ph]['trades'], d['trades'])
+
+def test_horizon_quantiles_not_clipped_by_large_payouts():
+    # 12 retiros del 20% llevan la caja acumulada muy por encima del 180% de la cuenta
+    acc = account("100K"); params = dict(PARAMS, win_rate=55, withdrawal_target=20.0)
+    jobs = [(acc, params, acc['size'])] * 2
+    h = run_portfolio_horizon(jobs, 2000, 12, 12, seed=1, start="2026-10-15")
+    _, hi = horizon_cash_range(jobs, 12)
+    for curve, top, size in ((h['accounts'][0], hi[0], acc['size']), (h['portfolio'], hi.sum(), 2 * acc['size'])):
+        assert curve['cum'][-1] > 1.8 * size
+        assert curve['p10'][-1] <= curve['p50'][-1] <= curve['p90'][-1] <= top
+        assert curve['p90'][-1] > 1.8 * size
+
+def test_horizon_calendar_has_exactly_months_buckets():
+    for start in ("2026-10-15", "2026-11-02", "2027-01-29"):
+        day_month, labels = horizon_calendar(12, start)
+        assert len(labels) == 12
+        assert np.array_equal(np.unique(day_month), np.arange(12))
+
+def test_parametric_params_restores_user_pace():
+    # 5 trades en 3 días: el bootstrap por día corre a 1.67 trades/día, los motores conjuntos al ritmo del usuario
+    pnl = EmpiricalPnL([50.0, -20.0, 30.0, -10.0, 40.0], ["2026-01-05", "2026-01-05", "2026-01-06", "2026-01-07", "2026-01-07"])
+    emp = empirical_params(PARAMS, pnl, by_day=True)
+    assert emp['trades_day'] != PARAMS['trades_day']
+    assert parametric_params(emp) == PARAMS
+    acc = account()
+    with pytest.raises(ValueError): account_columns([(acc, emp, acc['size'])], 3)
+    assert account_columns([(acc, parametric_params(emp), acc['size'])], 3)['tpd'][0] == PARAMS['trades_day']
+
+def test_payout_equity_not_clipped_at_20_percent():
+    # Con Meta Retiro 20% todo camino que cobra termina en >= +20%: el histograma no debe recortarlo
+    acc = account(); params = dict(PARAMS, win_rate=55, withdrawal_target=20.0)
+    res = run_account_simulation(acc, params, 2000, acc['size'], np.random.default_rng(1))
+    for ph in ("c1", "c2", "c3"):
+        eq = res['dist'][ph]['equity']
+        assert 20.0 <= eq['p10'] <= eq['p50'] <= eq['p90']
+
+def phase(rules, n=2000, risk=2.0, target=8.0, **kw):
+    # Fase WR/RR de 10K con aleatorios comunes: con la misma semilla cada camino ve los mismos trades
+    # sea cual sea la regla, así que una regla más estricta solo puede quitar caminos aprobados
+    args = dict(dict(risk_pct=risk, win_rate=45, rr=2.0, target_pct=target, max_dd_pct=10.0, daily_dd_pct=5.0, comm=7.0,
+                     sl_min=5, sl_max=15, trades_per_day=3), **kw)
+    return simulate_phase_batch(n, 10000.0, 10000.0, rng=np.random.default_rng(7), draw_idx=np.arange(n), draw_width=n,
+                                rules=compile_rules(rules), **args)
+
+def test_stricter_drawdown_rules_only_fail_more_paths():
+    # Meta +20% sin límite diario: el trailing sin tope sube el suelo por encima del balance inicial
+    dd = dict(target=20.0, daily_dd_pct=100.0)
+    ok_static = phase({}, **dd)[0]
+    ok_lock = phase({"dd_type": "trailing", "trail_lock": True}, **dd)[0]
+    ok_trail = phase({"dd_type": "trailing"}, **dd)[0]
+    ok_equity = phase({"daily_dd_mode": "equity"}, risk=3.0, daily_dd_pct=4.0)[0]
+    ok_balance = phase({}, risk=3.0, daily_dd_pct=4.0)[0]
+    assert not (ok_trail & ~ok_lock).any() and not (ok_lock & ~ok_static).any()
+    assert ok_trail.sum() < ok_lock.sum() < ok_static.sum()
+    assert not (ok_equity & ~ok_balance).any() and ok_equity.sum() < ok_balance.sum()
+
+def test_min_days_delays_success():
+    ok, trades, _, _ = phase({"min_days": 10})
+    ok_free, trades_free, _, _ = phase({})
+    assert trades[ok].min() > 9 * 3
+    assert trades_free[ok_free].min() <= 9 * 3
+
+def test_consistency_uses_daily_close():
+    # Día A: pico de +500 que cierra en +50; día B: +100. Con consistency 0.3 y meta +1000 el pico
+    # intradía de A no cuenta (su cierre sí): los caminos pasan cerca de la meta, no a partir de +1667
+    pnl = EmpiricalPnL([500.0, -450.0, 100.0], ["2026-01-05", "2026-01-05", "2026-01-06"])
+    ok, _, final, _ = phase({"consistency": 0.3}, n=500, target=10.0, empirical=pnl, by_day=True)
+    assert ok.mean() > 0.9
+    assert np.mean(final[ok] - 10000.0 < 1500.0) > 0.9
+    assert (final[ok] - 10000.0 >= 1000.0).all()
+
+def test_payout_cap_and_max_trades_limit():
+    acc = account(payout_cap=100.0)
+    assert payout_values(acc, PARAMS)[1:] == (100.0, 100.0)
+    with pytest.raises(ValueError): validate_account(dict(account(), max_trades=5000), "test")
+
+def test_purchase_peak_not_below_initial_outlay():
+    # Con 3 cuentas simultáneas el pico de capital es al menos el coste de las 3 compras iniciales
+    acc = account()
+    res = run_account_simulation(acc, PARAMS, 2000, acc['size'], np.random.default_rng(1))
+    peak = simulate_purchases(acc, PARAMS, res, 2000, 3, np.random.default_rng(1))['peak']
+    assert 3 * acc['cost'] <= peak['p10'] <= peak['p50'] <= peak['p90']
+
+def test_shared_worker_pool_matches_serial_and_is_reused():
+    acc = account(); jobs = [(acc, PARAMS, acc['size']), (account("5K"), PARAMS, 5000)]
+    serial = run_portfolio_simulation(jobs, 4000, seed=3)
+    pool = make_worker_pool(2)
+    try:
+        pids = set()
+        for _ in range(2):
+            par = run_portfolio_simulation(jobs, 4000, seed=3, n_workers=2, pool=pool)
+            assert [s['prob_c1'] for s in par] == [s['prob_c1'] for s in serial]
+            pids.add(frozenset(pool._processes))
+        assert len(pids) == 1  # los mismos workers en las dos corridas
+    finally: pool.shutdown()